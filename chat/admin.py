@@ -1,5 +1,6 @@
 from django.contrib import admin
 from .models import UserProfile, ChatHistory
+from . import search
 
 # Register your models here.
 
@@ -19,3 +20,10 @@ class ChatHistoryAdmin(admin.ModelAdmin):
 
     def message_preview(self, obj):
         return obj.message[:50]
+
+    def get_search_results(self, request, queryset, search_term):
+        # Use the full-text index instead of LIKE '%...%' over every message
+        if not search_term:
+            return queryset, False
+        hits = search.search(search_term, limit=500)
+        return queryset.filter(id__in=[chat.pk for chat in hits]), False
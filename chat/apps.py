@@ -4,3 +4,11 @@ from django.apps import AppConfig
 class ChatConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'chat'
+
+    def ready(self):
+        from . import context  # noqa: F401 (connects the ChatHistory signals)
+        from . import archive  # noqa: F401 (drops a deleted user's archive)
+        from . import memory  # noqa: F401 (indexes new ChatHistory rows)
+        from . import speakers  # noqa: F401 (keeps the speaker index current)
+        from . import auth  # noqa: F401 (drops cached token users on save)
+        from . import llm  # noqa: F401 (clears LLM timings per request)
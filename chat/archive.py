@@ -0,0 +1,246 @@
+import fcntl
+import functools
+import gzip
+import json
+import os
+import shutil
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+from .models import ChatHistory
+
+# Cold tier for ChatHistory: messages older than AGE_DAYS move out of the
+# table into gzip'd JSON-lines segments, one per user per month
+# (<LOCATION>/<user_id>/<YYYY-MM>.jsonl.gz). Each user's newest KEEP turns
+# always stay in the table, so the prompt context never has to look here.
+# <LOCATION>/<user_id>/index.json records each segment's lowest and highest
+# id, so a lookup by id opens only the segment that can hold it.
+DEFAULTS = {
+    'LOCATION': os.path.join(settings.BASE_DIR, '.chat_archive'),
+    'AGE_DAYS': 90,
+    'KEEP': 20,
+    'BATCH': 5000,   # rows moved per transaction
+}
+
+
+def _options():
+    return {**DEFAULTS, **getattr(settings, 'CHAT_ARCHIVE', {})}
+
+
+def _user_dir(user_id):
+    return os.path.join(str(_options()['LOCATION']), str(user_id))
+
+
+@contextmanager
+def _lock():
+    location = str(_options()['LOCATION'])
+    os.makedirs(location, exist_ok=True)
+    fd = os.open(os.path.join(location, '.lock'), os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)  # releases the lock
+
+
+def archive(age_days=None, user_ids=None):
+    '''
+    Move messages older than age_days (default AGE_DAYS) into the archive,
+    for every user or only those in user_ids. Safe to re-run after a crash:
+    rows already in a segment aren't written twice. Returns the number of
+    rows moved.
+    '''
+    options = _options()
+    cutoff = timezone.now() - timedelta(days=options['AGE_DAYS'] if age_days is None else age_days)
+    old = ChatHistory.objects.filter(timestamp__lt=cutoff)
+    if user_ids is not None:
+        old = old.filter(user_id__in=list(user_ids))
+    moved = 0
+    with _lock():
+        _index_all()
+        for user_id in list(old.order_by().values_list('user_id', flat=True).distinct()):
+            moved += _archive_user(user_id, cutoff, options)
+    return moved
+
+
+def _archive_user(user_id, cutoff, options):
+    rows = ChatHistory.objects.filter(user_id=user_id).order_by('-timestamp', '-id')
+    old = rows.filter(timestamp__lt=cutoff)
+    if options['KEEP']:
+        keep = next(iter(rows[options['KEEP'] - 1:options['KEEP']]), None)
+        if keep is None:
+            return 0
+        old = old.filter(timestamp__lte=keep.timestamp).exclude(
+            timestamp=keep.timestamp, id__gte=keep.pk)
+    old = old.order_by('timestamp', 'id').values_list('id', 'timestamp', 'is_user_message', 'message')
+
+    moved = 0
+    while True:
+        batch = list(old[:options['BATCH']])
+        if not batch:
+            return moved
+        months = {}
+        for pk, timestamp, is_user_message, message in batch:
+            months.setdefault(timestamp.strftime('%Y-%m'), []).append(
+                [pk, timestamp.isoformat(), is_user_message, message])
+        for month, records in months.items():
+            _append(user_id, month, records)
+        # Segments are on disk (fsync'd) before the rows go. Raw DELETE: these
+        # rows are outside every context window, so the per-row post_delete
+        # signals would be pure overhead.
+        with transaction.atomic(), connection.cursor() as cursor:
+            ids = [row[0] for row in batch]
+            cursor.execute(
+                f"DELETE FROM {ChatHistory._meta.db_table} WHERE id IN ({', '.join(['%s'] * len(ids))})",
+                ids)
+        moved += len(batch)
+
+
+def _append(user_id, month, records):
+    directory = _user_dir(user_id)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{month}.jsonl.gz")
+    if os.path.exists(path):
+        existing = {chat.pk for chat in _load(path, user_id)}
+        records = [r for r in records if r[0] not in existing]
+    if not records:
+        return
+    # Appending adds another gzip member; readers see one stream.
+    with open(path, 'ab') as f:
+        f.write(gzip.compress(''.join(json.dumps(r) + '\n' for r in records).encode()))
+        f.flush()
+        os.fsync(f.fileno())
+    index = dict(_index(user_id) or {})
+    low, high = index.get(month, (records[0][0], records[0][0]))
+    index[month] = [min(low, *(r[0] for r in records)), max(high, *(r[0] for r in records))]
+    _write_index(user_id, index)
+
+
+def _index_path(user_id):
+    return os.path.join(_user_dir(user_id), 'index.json')
+
+
+def _write_index(user_id, index):
+    # Called with the archive lock held; readers see the old file or the new one
+    path = _index_path(user_id)
+    with open(f"{path}.tmp", 'w') as f:
+        json.dump(index, f)
+    os.replace(f"{path}.tmp", path)
+
+
+def _index_all():
+    # Index segments written before there was an index. Called with the lock held.
+    location = str(_options()['LOCATION'])
+    for name in os.listdir(location):
+        if not name.isdigit():
+            continue
+        user_id = int(name)
+        index = dict(_index(user_id) or {})
+        missing = [(month, path) for month, path in _segments(user_id) if month not in index]
+        for month, path in missing:
+            ids = [chat.pk for chat in _load(path, user_id)]
+            if ids:
+                index[month] = [min(ids), max(ids)]
+        if missing:
+            _write_index(user_id, index)
+
+
+def _index(user_id):
+    '''
+    {month: [lowest id, highest id]} for the user's segments, or None.
+    '''
+    try:
+        stat = os.stat(_index_path(user_id))
+    except FileNotFoundError:
+        return None
+    return _load_index(_index_path(user_id), stat.st_mtime_ns, stat.st_size)
+
+
+@functools.lru_cache(maxsize=256)
+def _load_index(path, mtime_ns, size):
+    with open(path) as f:
+        return json.load(f)
+
+
+def _segments(user_id):
+    directory = _user_dir(user_id)
+    try:
+        names = sorted(n for n in os.listdir(directory) if n.endswith('.jsonl.gz'))
+    except FileNotFoundError:
+        return []
+    return [(n[:7], os.path.join(directory, n)) for n in names]
+
+
+def _load(path, user_id):
+    stat = os.stat(path)
+    return _load_segment(path, stat.st_mtime_ns, stat.st_size, user_id)
+
+
+@functools.lru_cache(maxsize=64)
+def _load_segment(path, mtime_ns, size, user_id):
+    with gzip.open(path, 'rt') as f:
+        chats = [ChatHistory(id=pk, user_id=user_id, timestamp=datetime.fromisoformat(timestamp),
+                             is_user_message=is_user_message, message=message)
+                 for pk, timestamp, is_user_message, message in map(json.loads, f)]
+    chats.sort(key=lambda chat: (chat.timestamp, chat.pk))
+    return chats
+
+
+def older(user_id, timestamp=None, pk=None, limit=50):
+    '''
+    Archived messages before (timestamp, pk), or the newest ones when no
+    cursor is given. Newest first, as unsaved ChatHistory objects.
+    '''
+    found = []
+    for month, path in reversed(_segments(user_id)):
+        if timestamp is not None and month > timestamp.strftime('%Y-%m'):
+            continue
+        for chat in reversed(_load(path, user_id)):
+            if timestamp is None or (chat.timestamp, chat.pk) < (timestamp, pk):
+                found.append(chat)
+                if len(found) == limit:
+                    return found
+    return found
+
+
+def newer(user_id, timestamp, pk, limit=50):
+    '''
+    Archived messages after (timestamp, pk), oldest first.
+    '''
+    found = []
+    for month, path in _segments(user_id):
+        if month < timestamp.strftime('%Y-%m'):
+            continue
+        for chat in _load(path, user_id):
+            if (chat.timestamp, chat.pk) > (timestamp, pk):
+                found.append(chat)
+                if len(found) == limit:
+                    return found
+    return found
+
+
+def get(user_id, pk):
+    '''
+    One archived message by id, or None. Only opens segments whose id range
+    (from index.json) covers pk, and any not indexed yet.
+    '''
+    index = _index(user_id) or {}
+    for month, path in reversed(_segments(user_id)):
+        if month in index and not index[month][0] <= pk <= index[month][1]:
+            continue
+        for chat in _load(path, user_id):
+            if chat.pk == pk:
+                return chat
+    return None
+
+
+@receiver(post_delete, sender=User)
+def _drop_user_archive(sender, instance, **kwargs):
+    # The table rows go with the user (CASCADE); the archived ones must too.
+    user_id = instance.pk
+    transaction.on_commit(lambda: shutil.rmtree(_user_dir(user_id), ignore_errors=True))
@@ -0,0 +1,120 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.utils import get_md5_hash_password
+from .models import User, UserProfile
+from . import metrics
+
+# The user a JWT names, and the profile fields chat reads on every request,
+# from the shared cache instead of the database. Saving or deleting a User or
+# UserProfile (password change, suspension, profile edit) drops the entry;
+# queryset .update()s don't, so TTL bounds how stale it can get.
+DEFAULTS = {
+    'TTL': 300,  # seconds
+}
+
+USER_FIELDS = ('username', 'first_name', 'last_name', 'email', 'is_active', 'is_staff', 'is_superuser')
+PROFILE_FIELDS = ('account_status', 'preferred_name', 'city')
+
+
+def _options():
+    return {**DEFAULTS, **getattr(settings, 'CHAT_AUTH', {})}
+
+
+def _key(user_id):
+    return f"auth_user:{user_id}"
+
+
+def _fetch(user_id):
+    # One query for the user and the profile fields; the password hash only
+    # leaves as its digest, the "token version" simplejwt's revoke claim holds
+    try:
+        user = (User.objects.select_related('profile')
+                .only('password', *USER_FIELDS, *(f'profile__{f}' for f in PROFILE_FIELDS))
+                .get(**{api_settings.USER_ID_FIELD: user_id}))
+    except User.DoesNotExist:
+        raise AuthenticationFailed(_("User not found"), code="user_not_found")
+    try:
+        profile = {'id': user.profile.id, 'user_id': user.pk,
+                   **{name: getattr(user.profile, name) for name in PROFILE_FIELDS}}
+    except UserProfile.DoesNotExist:
+        profile = None
+    entry = {
+        "user": {name: getattr(user, name) for name in ('id', *USER_FIELDS)},
+        "token_version": get_md5_hash_password(user.password),
+        "profile": profile,
+    }
+    cache.set(_key(user_id), entry, timeout=_options()['TTL'])
+    return entry
+
+
+def _revive(model, values):
+    # A model instance as if loaded with .only(*values); other fields load on access
+    names = [f.attname for f in model._meta.concrete_fields if f.attname in values]
+    return model.from_db(DEFAULT_DB_ALIAS, names, [values[name] for name in names])
+
+
+def resolve(user_id, token_version=None):
+    '''
+    The User for user_id with user.profile preloaded (account_status,
+    preferred_name and city; anything else is fetched on access). Raises
+    AuthenticationFailed if there is no such user. A cached entry whose
+    token version differs from the one given is refetched.
+    '''
+    entry = cache.get(_key(user_id))
+    metrics.inc('companion_cache_requests_total', cache="auth", result="miss" if entry is None else "hit")
+    if entry is None or (token_version is not None and entry["token_version"] != token_version):
+        entry = _fetch(user_id)
+    user = _revive(User, entry["user"])
+    user._token_version = entry["token_version"]
+    profile = _revive(UserProfile, entry["profile"]) if entry["profile"] else None
+    User.profile.related.set_cached_value(user, profile)
+    if profile is not None:
+        UserProfile.user.field.set_cached_value(profile, user)
+    return user
+
+
+def invalidate(user_id):
+    cache.delete(_key(user_id))
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    '''
+    JWTAuthentication whose user lookup usually costs no query (see resolve()).
+    Applies the same is_active and CHECK_REVOKE_TOKEN checks.
+    '''
+
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken(_("Token contained no recognizable user identification"))
+
+        revoke_claim = validated_token.get(api_settings.REVOKE_TOKEN_CLAIM) if api_settings.CHECK_REVOKE_TOKEN else None
+        user = resolve(user_id, revoke_claim)
+
+        if api_settings.CHECK_USER_IS_ACTIVE and not user.is_active:
+            raise AuthenticationFailed(_("User is inactive"), code="user_inactive")
+
+        if api_settings.CHECK_REVOKE_TOKEN and revoke_claim != user._token_version:
+            raise AuthenticationFailed(_("The user's password has been changed."), code="password_changed")
+
+        return user
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def _user_changed(sender, instance, **kwargs):
+    transaction.on_commit(lambda: invalidate(instance.pk))
+
+
+@receiver(post_save, sender=UserProfile)
+@receiver(post_delete, sender=UserProfile)
+def _profile_changed(sender, instance, **kwargs):
+    transaction.on_commit(lambda: invalidate(instance.user_id))
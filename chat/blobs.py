@@ -0,0 +1,98 @@
+import hashlib
+import os
+import re
+import tempfile
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+# Content-addressed storage for large binary values kept out of table rows
+# (UserProfile voice profiles). A blob's key is the SHA-256 of its bytes, so
+# identical uploads share one copy and a key never changes meaning: whatever
+# serves it may cache it forever.
+DEFAULTS = {
+    'BACKEND': 'chat.blobs.FileSystemStore',
+    'LOCATION': os.path.join(settings.BASE_DIR, '.blobs'),
+}
+
+KEY_RE = re.compile(r"^[0-9a-f]{64}$")
+
+_store = None
+
+
+def _options():
+    return {**DEFAULTS, **getattr(settings, 'CHAT_BLOBS', {})}
+
+
+def key_for(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+class FileSystemStore:
+    '''
+    One file per blob under LOCATION/<key[:2]>/<key>. Writes go to a temp
+    file and are renamed into place, so readers never see a partial blob.
+    '''
+
+    def __init__(self, options):
+        self.location = str(options['LOCATION'])
+
+    def path(self, key):
+        if not KEY_RE.match(key):
+            raise ValueError(f"Not a blob key: {key!r}")
+        return os.path.join(self.location, key[:2], key)
+
+    def put(self, data):
+        key = key_for(data)
+        path = self.path(key)
+        if os.path.exists(path):
+            return key
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        return key
+
+    def size(self, key):
+        '''
+        Bytes in the blob, or None if there is no such blob.
+        '''
+        try:
+            return os.path.getsize(self.path(key))
+        except FileNotFoundError:
+            return None
+
+    def read(self, key, start=0, end=None):
+        '''
+        Bytes start..end (end exclusive, default the whole blob). Raises
+        FileNotFoundError for a missing blob.
+        '''
+        with open(self.path(key), "rb") as f:
+            f.seek(start)
+            return f.read(-1 if end is None else max(0, end - start))
+
+    def delete(self, key):
+        try:
+            os.unlink(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def keys(self):
+        for entry in os.scandir(self.location) if os.path.isdir(self.location) else ():
+            if entry.is_dir():
+                yield from (name for name in os.listdir(entry.path) if KEY_RE.match(name))
+
+
+def store():
+    '''
+    The configured backend (CHAT_BLOBS['BACKEND']).
+    '''
+    global _store
+    if _store is None:
+        options = _options()
+        _store = import_string(options['BACKEND'])(options)
+    return _store
@@ -0,0 +1,213 @@
+import asyncio
+import logging
+import math
+import random
+import time
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+# Circuit breakers for upstream services (OpenAI, OpenWeatherMap). State
+# lives in the shared cache, so once one worker sees an upstream fail
+# FAILURES times in a row, every worker stops calling it for OPEN_FOR
+# seconds (jittered, doubling on each failed probe up to MAX_OPEN_FOR).
+# After that one caller at a time is let through as a probe; its success
+# closes the circuit. Calls are retried with jittered exponential backoff,
+# but only while the circuit stays closed.
+DEFAULTS = {
+    'FAILURES': 5,         # consecutive failures that open the circuit...
+    'WINDOW': 60,          # ...counted over this many seconds
+    'OPEN_FOR': 10,        # seconds, first time open
+    'MAX_OPEN_FOR': 300,
+    'RETRIES': 2,
+    'BACKOFF': 0.25,       # seconds, doubled per retry; the sleep is random in [0, backoff]
+    'MAX_BACKOFF': 4,
+    'PROBE_TIMEOUT': 60,   # a probe that never reports back frees its slot after this
+}
+STATS = ("calls", "failures", "rejected", "opened")
+
+_breakers = {}
+
+
+class CircuitOpen(Exception):
+    '''
+    Raised instead of calling an upstream whose circuit is open.
+    '''
+
+    def __init__(self, name, retry_after):
+        super().__init__(f"{name} circuit open, retry in {retry_after}s")
+        self.name = name
+        self.retry_after = retry_after
+
+
+def _options(name):
+    return {**DEFAULTS, **getattr(settings, 'CHAT_BREAKERS', {}).get(name, {})}
+
+
+class Breaker:
+    def __init__(self, name):
+        self.name = name
+        self.options = _options(name)
+        self.key = f"breaker:{name}"
+
+    def _count(self, stat):
+        key = f"{self.key}:stats:{stat}"
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.add(key, 0, timeout=None)
+            cache.incr(key)
+
+    def retry_after(self):
+        '''
+        Seconds until the circuit lets a probe through; 0 if it is closed.
+        '''
+        state = cache.get(self.key)
+        if state is None:
+            return 0
+        return max(0, math.ceil(state["opened_at"] + state["open_for"] - time.time()))
+
+    def allow(self):
+        '''
+        True if a call may go out now: the circuit is closed, or this caller
+        got the half-open probe slot.
+        '''
+        state = cache.get(self.key)
+        if state is None or (time.time() >= state["opened_at"] + state["open_for"]
+                             and cache.add(f"{self.key}:probe", 1, timeout=self.options['PROBE_TIMEOUT'])):
+            return True
+        self._count("rejected")
+        return False
+
+    def record_success(self):
+        state = cache.get_many([self.key, f"{self.key}:failures"])
+        if state:
+            cache.delete_many([self.key, f"{self.key}:failures", f"{self.key}:probe"])
+            if self.key in state:
+                logger.info("Circuit %s closed", self.name, extra={"upstream": self.name})
+
+    def record_failure(self):
+        self._count("failures")
+        state = cache.get(self.key)
+        if state is not None:
+            if time.time() >= state["opened_at"] + state["open_for"]:  # the probe failed
+                self._open(state["trips"] + 1)
+            return
+        failures_key = f"{self.key}:failures"
+        if cache.add(failures_key, 1, timeout=self.options['WINDOW']):
+            failures = 1
+        else:
+            try:
+                failures = cache.incr(failures_key)
+            except ValueError:  # expired in between
+                failures = 1
+        if failures >= self.options['FAILURES']:
+            self._open(1)
+
+    def _open(self, trips):
+        options = self.options
+        open_for = min(options['MAX_OPEN_FOR'], options['OPEN_FOR'] * 2 ** (trips - 1))
+        open_for = open_for / 2 + random.uniform(0, open_for / 2)  # spread out the probes
+        cache.set(self.key, {"opened_at": time.time(), "open_for": open_for, "trips": trips}, timeout=None)
+        cache.delete_many([f"{self.key}:failures", f"{self.key}:probe"])
+        self._count("opened")
+        logger.warning("Circuit %s open for %.1fs (trip %d)", self.name, open_for, trips,
+                       extra={"upstream": self.name, "open_for": round(open_for, 1), "trips": trips})
+
+    def _backoff(self, attempt):
+        options = self.options
+        return random.uniform(0, min(options['MAX_BACKOFF'], options['BACKOFF'] * 2 ** attempt))
+
+    def _begin(self):
+        if not self.allow():
+            raise CircuitOpen(self.name, self.retry_after())
+        self._count("calls")
+
+    def _retry(self, attempt, failed):
+        # Records the outcome; True if another attempt should follow
+        if not failed:
+            self.record_success()
+            return False
+        self.record_failure()
+        # Out of retries, or the circuit just opened: don't pile on
+        return attempt < self.options['RETRIES'] and cache.get(self.key) is None
+
+    def call(self, fn, *args, errors=(Exception,), is_failure=lambda result: False, on_retry=None, **kwargs):
+        '''
+        fn(*args, **kwargs) through the breaker. Exceptions in errors, and
+        results is_failure() flags, count as failures and are retried; the
+        last one is raised or returned. on_retry(result) disposes of a failed
+        result before the next attempt. Raises CircuitOpen if the circuit is open.
+        '''
+        for attempt in range(self.options['RETRIES'] + 1):
+            self._begin()
+            result = error = None
+            try:
+                result = fn(*args, **kwargs)
+            except errors as e:
+                error = e
+            if not self._retry(attempt, error is not None or is_failure(result)):
+                break
+            if on_retry and error is None:
+                on_retry(result)
+            time.sleep(self._backoff(attempt))
+        if error is not None:
+            raise error
+        return result
+
+    async def acall(self, fn, *args, errors=(Exception,), is_failure=lambda result: False, on_retry=None, **kwargs):
+        '''
+        call() for a coroutine function (on_retry may be one too).
+        '''
+        for attempt in range(self.options['RETRIES'] + 1):
+            self._begin()
+            result = error = None
+            try:
+                result = await fn(*args, **kwargs)
+            except errors as e:
+                error = e
+            if not self._retry(attempt, error is not None or is_failure(result)):
+                break
+            if on_retry and error is None:
+                await on_retry(result)
+            await asyncio.sleep(self._backoff(attempt))
+        if error is not None:
+            raise error
+        return result
+
+    def stats(self):
+        keys = [f"{self.key}:stats:{stat}" for stat in STATS]
+        values = cache.get_many(keys + [self.key, f"{self.key}:failures"])
+        state = values.get(self.key)
+        if state is None:
+            status = "closed"
+        elif time.time() < state["opened_at"] + state["open_for"]:
+            status = "open"
+        else:
+            status = "half-open"
+        return {
+            "state": status,
+            "retry_after": self.retry_after(),
+            "trips": state["trips"] if state else 0,
+            "recent_failures": values.get(f"{self.key}:failures", 0),
+            **{stat: values.get(key, 0) for stat, key in zip(STATS, keys)},
+        }
+
+
+def get(name):
+    '''
+    The breaker for an upstream, configured by CHAT_BREAKERS[name].
+    '''
+    if name not in _breakers:
+        _breakers[name] = Breaker(name)
+    return _breakers[name]
+
+
+def stats():
+    '''
+    State and counters of every breaker used in this process, plus those
+    configured in CHAT_BREAKERS.
+    '''
+    names = sorted(set(_breakers) | set(getattr(settings, 'CHAT_BREAKERS', {})))
+    return {name: get(name).stats() for name in names}
@@ -0,0 +1,106 @@
+import time
+from collections import deque, namedtuple
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from .models import ChatHistory
+from . import metrics
+
+DEFAULTS = {
+    'WINDOW': 20,     # turns kept per user
+    'TTL': 86400,
+}
+
+Turn = namedtuple("Turn", ["message", "is_user_message"])
+
+
+def _options():
+    return {**DEFAULTS, **getattr(settings, 'CHAT_CONTEXT', {})}
+
+
+def _key(user_id):
+    return f"chat_context:{user_id}"
+
+
+# Each user's window is stored under a version number that every append and
+# invalidate bumps with an atomic incr(). A writer only builds version v from
+# version v-1, and cache.add() never overwrites, so two appends racing on
+# the same window can't lose a turn: the loser finds v-1 not written yet and
+# leaves v to be rebuilt from the DB on the next read.
+def _version(user_id):
+    key = f"{_key(user_id)}:version"
+    version = cache.get(key)
+    if version is None:
+        # Seeded from the clock, so a counter that was evicted can't come
+        # back at a number whose old window is still cached
+        cache.add(key, int(time.time() * 1000), timeout=None)
+        version = cache.get(key)
+    return version
+
+
+def recent_turns(user, n=5):
+    '''
+    The user's last n turns, oldest first. Served from the shared cache; only
+    a miss hydrates the window from ChatHistory.
+    '''
+    key = f"{_key(user.pk)}:{_version(user.pk)}"
+    turns = cache.get(key)
+    metrics.inc('companion_cache_requests_total', cache="context", result="miss" if turns is None else "hit")
+    if turns is None:
+        from .writebehind import pending
+        options = _options()
+        rows = ChatHistory.objects.filter(user=user).order_by(
+            '-timestamp').values_list('message', 'is_user_message')[:options['WINDOW']]
+        # Rows still sitting in this process's write-behind buffer count too
+        turns = list(reversed(rows)) + [
+            (chat.message, chat.is_user_message) for chat in pending(user.pk)]
+        turns = turns[-options['WINDOW']:]
+        cache.add(key, turns, timeout=options['TTL'])
+    if n <= 0:  # turns[-0:] would be all of them
+        return []
+    return [Turn(*turn) for turn in turns[-n:]]
+
+
+def append(user_id, message, is_user_message):
+    '''
+    Write-through for a new turn. A user with no cached window is left alone;
+    the next read hydrates it from the DB anyway.
+    '''
+    key = _key(user_id)
+    try:
+        version = cache.incr(f"{key}:version")
+    except ValueError:  # nothing cached for this user
+        return
+    turns = cache.get(f"{key}:{version - 1}")
+    if turns is None:
+        return
+    options = _options()
+    window = deque(turns, maxlen=options['WINDOW'])
+    window.append((message, is_user_message))
+    cache.add(f"{key}:{version}", list(window), timeout=options['TTL'])
+    cache.delete(f"{key}:{version - 1}")
+
+
+def invalidate(user_id):
+    key = _key(user_id)
+    try:
+        version = cache.incr(f"{key}:version")
+    except ValueError:
+        return
+    cache.delete(f"{key}:{version - 1}")
+
+
+@receiver(post_save, sender=ChatHistory)
+def _chat_saved(sender, instance, created, **kwargs):
+    if created:
+        transaction.on_commit(lambda: append(
+            instance.user_id, instance.message, instance.is_user_message))
+    else:  # edited in place, e.g. through ChatHistoryViewSet
+        transaction.on_commit(lambda: invalidate(instance.user_id))
+
+
+@receiver(post_delete, sender=ChatHistory)
+def _chat_deleted(sender, instance, **kwargs):
+    transaction.on_commit(lambda: invalidate(instance.user_id))
@@ -0,0 +1,58 @@
+import logging
+import time
+from concurrent.futures import TimeoutError as FutureTimeout
+from . import jobs
+
+logger = logging.getLogger(__name__)
+
+
+class Fanout:
+    '''
+    Starts a request's independent lookups at once in the job pool, each with
+    its own deadline (seconds from start) and fallback value. result() never
+    waits past a stage's deadline; a stage that misses it keeps running, and
+    asking again later picks up its answer if it has arrived.
+    '''
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.finished = {}
+        self.results = {}  # name -> value, once a stage has succeeded or failed
+        self.timings = {}  # name -> (milliseconds, "ok" | "late" | "timeout" | "error")
+
+    def start(self, name, fn, *args, deadline, fallback=None, errors=(Exception,), **kwargs):
+        future = jobs.submit(fn, *args, **kwargs)
+        future.add_done_callback(lambda f: self.finished.setdefault(name, time.perf_counter()))
+        self.stages[name] = (future, deadline, fallback, errors)
+        return self
+
+    def result(self, name):
+        '''
+        The stage's value, or its fallback if it failed or isn't done by its
+        deadline. Once a stage has an answer or an error, later calls return
+        the same value without logging again.
+        '''
+        if name in self.results:
+            return self.results[name]
+        future, deadline, fallback, errors = self.stages[name]
+        timeout = max(0, self.started + deadline - time.perf_counter())
+        missed = self.timings.get(name, (0, None))[1] == "timeout"
+        try:
+            value, outcome = future.result(timeout=timeout), "late" if missed else "ok"
+        except FutureTimeout:
+            value, outcome = fallback, "timeout"
+        except errors as e:
+            logger.warning("Stage %s failed: %s", name, e, extra={"stage": name})
+            value, outcome = fallback, "error"
+        end = self.finished.get(name, time.perf_counter())
+        self.timings[name] = (round((end - self.started) * 1000, 1), outcome)
+        if outcome != "timeout":
+            self.results[name] = value
+        return value
+
+    def server_timing(self):
+        '''
+        Server-Timing header value with each collected stage's time.
+        '''
+        return ", ".join(f'{name};dur={ms};desc="{outcome}"' for name, (ms, outcome) in self.timings.items())
@@ -0,0 +1,196 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import close_old_connections, connection
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+# Work that doesn't belong on the request path. submit() runs a call in a
+# shared thread pool and hands back a Future, for fetches a request needs
+# but can overlap (the weather while the LLM answers). defer() queues a task
+# by dotted path with JSON arguments and returns at once; the request never
+# waits for it. ThreadQueue keeps deferred jobs in memory (lost if the
+# process is killed); DatabaseQueue keeps them in a table until they succeed.
+DEFAULTS = {
+    'BACKEND': 'chat.jobs.ThreadQueue',
+    'WORKERS': 2,         # threads running deferred jobs, per process
+    'POOL_SIZE': 16,      # threads for submit(), per process
+    'MAX_ATTEMPTS': 3,
+    'RETRY_DELAY': 1.0,   # seconds before the first retry, doubled after each
+    'POLL': 1.0,          # DatabaseQueue: seconds between checks for jobs from other processes
+    'LEASE': 60,          # DatabaseQueue: seconds before a job claimed by a dead worker is retried
+}
+
+TABLE = "chat_job"  # created by migration 0004
+
+_lock = threading.Lock()
+_pool = None
+_queue = None
+_pid = None
+
+
+def _options():
+    return {**DEFAULTS, **getattr(settings, 'CHAT_JOBS', {})}
+
+
+def _setup():
+    # Re-checks the pid so forked workers get their own threads
+    global _pool, _queue, _pid
+    with _lock:
+        if _pid != os.getpid():
+            options = _options()
+            _pool = ThreadPoolExecutor(options['POOL_SIZE'], thread_name_prefix="chat-jobs")
+            _queue = import_string(options['BACKEND'])(options)
+            _pid = os.getpid()
+
+
+def _call(fn, args, kwargs):
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        close_old_connections()
+
+
+def submit(fn, *args, **kwargs):
+    '''
+    Run fn(*args, **kwargs) in the shared thread pool. Returns a Future.
+    '''
+    _setup()
+    return _pool.submit(_call, fn, args, kwargs)
+
+
+def defer(task, *args):
+    '''
+    Queue task (dotted path to a function) to run soon with args, which must
+    be JSON-serializable. Returns immediately; failures are retried up to
+    MAX_ATTEMPTS times, then logged and dropped.
+    '''
+    payload = json.dumps(args)
+    _setup()
+    _queue.enqueue(task, payload)
+
+
+def _execute(task, payload):
+    import_string(task)(*json.loads(payload))
+
+
+class ThreadQueue:
+    '''
+    Jobs in this process's memory, run by WORKERS threads. Whatever is still
+    queued at a clean exit runs before the process ends.
+    '''
+
+    def __init__(self, options):
+        self.options = options
+        self.jobs = queue.SimpleQueue()
+        for _ in range(options['WORKERS']):
+            threading.Thread(target=self._work, daemon=True).start()
+        atexit.register(self.drain)
+
+    def enqueue(self, task, payload):
+        self.jobs.put((task, payload, 1))
+
+    def _work(self):
+        while True:
+            self._run(self.jobs.get())
+
+    def _run(self, job, retry=True):
+        task, payload, attempt = job
+        try:
+            _execute(task, payload)
+        except Exception as e:
+            if not retry or attempt >= self.options['MAX_ATTEMPTS']:
+                logger.error("Job %s failed, giving up: %s", task, e, extra={"task": task, "attempt": attempt})
+                return
+            logger.warning("Job %s failed, will retry: %s", task, e, extra={"task": task, "attempt": attempt})
+            timer = threading.Timer(self.options['RETRY_DELAY'] * 2 ** (attempt - 1),
+                                    self.jobs.put, args=((task, payload, attempt + 1),))
+            timer.daemon = True
+            timer.start()
+        finally:
+            close_old_connections()
+
+    def drain(self):
+        while True:
+            try:
+                job = self.jobs.get_nowait()
+            except queue.Empty:
+                return
+            self._run(job, retry=False)
+
+
+class DatabaseQueue:
+    '''
+    Jobs in the chat_job table, so they survive a restart and
+    any process's workers can run them. A job runs at least once: if its
+    worker dies mid-job, it is claimed again after LEASE seconds.
+    '''
+
+    def __init__(self, options):
+        self.options = options
+        self.wakeup = threading.Event()
+        for _ in range(options['WORKERS']):
+            threading.Thread(target=self._work, daemon=True).start()
+
+    def enqueue(self, task, payload):
+        with connection.cursor() as cursor:
+            cursor.execute(f"INSERT INTO {TABLE} (task, args, attempts, run_after) VALUES (%s, %s, 0, %s)",
+                           [task, payload, time.time()])
+        self.wakeup.set()
+
+    def _claim(self):
+        now = time.time()
+        skip_locked = " FOR UPDATE SKIP LOCKED" if connection.vendor == 'postgresql' else ""
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"UPDATE {TABLE} SET attempts = attempts + 1, run_after = %s WHERE id = "
+                f"(SELECT id FROM {TABLE} WHERE run_after <= %s ORDER BY id LIMIT 1{skip_locked}) "
+                "RETURNING id, task, args, attempts",
+                [now + self.options['LEASE'], now])
+            return cursor.fetchone()
+
+    def _finish(self, pk, task, attempts, error):
+        with connection.cursor() as cursor:
+            if error is None or attempts >= self.options['MAX_ATTEMPTS']:
+                if error is not None:
+                    logger.error("Job %s failed, giving up: %s", task, error,
+                                 extra={"task": task, "attempt": attempts})
+                cursor.execute(f"DELETE FROM {TABLE} WHERE id = %s", [pk])
+            else:
+                logger.warning("Job %s failed, will retry: %s", task, error,
+                               extra={"task": task, "attempt": attempts})
+                cursor.execute(f"UPDATE {TABLE} SET run_after = %s WHERE id = %s",
+                               [time.time() + self.options['RETRY_DELAY'] * 2 ** (attempts - 1), pk])
+
+    def _work(self):
+        while True:
+            try:
+                job = self._claim()
+            except Exception as e:  # e.g. table missing, database down
+                logger.warning("Job queue unavailable: %s", e)
+                job = None
+            if job is None:
+                close_old_connections()
+                self.wakeup.wait(self.options['POLL'])
+                self.wakeup.clear()
+                continue
+            pk, task, payload, attempts = job
+            error = None
+            try:
+                _execute(task, payload)
+            except Exception as e:
+                error = e
+            try:
+                self._finish(pk, task, attempts, error)
+            except Exception as e:
+                logger.warning("Job queue unavailable: %s", e)
+            finally:
+                close_old_connections()
+
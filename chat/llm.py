@@ -0,0 +1,208 @@
+import asyncio
+import contextvars
+import logging
+import threading
+import time
+import weakref
+import httpx
+from django.conf import settings
+from django.core.signals import request_started
+from django.dispatch import receiver
+from openai import OpenAI, AsyncOpenAI, DefaultHttpxClient, DefaultAsyncHttpxClient
+from . import breaker
+from . import config
+from . import metrics
+
+DEFAULTS = {
+    'MAX_CONNECTIONS': 100,
+    'MAX_KEEPALIVE_CONNECTIONS': 20,
+    'KEEPALIVE_EXPIRY': 30,
+    'CONNECT_TIMEOUT': 5,
+    'TIMEOUT': 30,
+}
+# Retries happen below the SDK, in the "openai" circuit breaker
+# (CHAT_BREAKERS['openai']), so they stop once OpenAI is known to be down.
+RETRY_STATUSES = frozenset((408, 409, 429, 500, 502, 503, 504))
+
+logger = logging.getLogger(__name__)
+
+_client = None
+_client_lock = threading.Lock()
+# httpx async connection pools belong to the event loop that opened them, so
+# keep one client per running loop (uvicorn/daphne only ever have one).
+_async_clients = weakref.WeakKeyDictionary()
+_timings = contextvars.ContextVar("llm_timings", default=None)
+
+
+def _options():
+    return {**DEFAULTS, **getattr(settings, 'LLM_CLIENT', {})}
+
+
+def _limits(options):
+    return httpx.Limits(
+        max_connections=options['MAX_CONNECTIONS'],
+        max_keepalive_connections=options['MAX_KEEPALIVE_CONNECTIONS'],
+        keepalive_expiry=options['KEEPALIVE_EXPIRY'],
+    )
+
+
+def _timeout(options):
+    return httpx.Timeout(options['TIMEOUT'], connect=options['CONNECT_TIMEOUT'])
+
+
+def _failed(response):
+    return response.status_code in RETRY_STATUSES
+
+
+class BreakerTransport(httpx.HTTPTransport):
+    '''
+    Sends every OpenAI request through the "openai" circuit breaker.
+    '''
+
+    def handle_request(self, request):
+        return breaker.get("openai").call(
+            super().handle_request, request, errors=(httpx.TransportError,),
+            is_failure=_failed, on_retry=lambda response: response.close())
+
+
+class AsyncBreakerTransport(httpx.AsyncHTTPTransport):
+    async def handle_async_request(self, request):
+        return await breaker.get("openai").acall(
+            super().handle_async_request, request, errors=(httpx.TransportError,),
+            is_failure=_failed, on_retry=lambda response: response.aclose())
+
+
+def circuit_open(error):
+    '''
+    The breaker.CircuitOpen behind an OpenAI SDK error, or None.
+    '''
+    cause = error
+    while cause is not None:
+        if isinstance(cause, breaker.CircuitOpen):
+            return cause
+        cause = cause.__cause__
+    return None
+
+
+def get_client():
+    '''
+    Process-wide OpenAI client. Connections are kept alive and reused, so only
+    the first request (or one after KEEPALIVE_EXPIRY) pays for the TLS handshake.
+    '''
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                options = _options()
+                http_client = DefaultHttpxClient(
+                    transport=BreakerTransport(limits=_limits(options)),
+                    event_hooks={"request": [_start_trace], "response": [_finish_trace]},
+                    timeout=_timeout(options),
+                )
+                _client = OpenAI(api_key=config.openai_api_key, max_retries=0,
+                                 http_client=http_client)
+    return _client
+
+
+def get_async_client():
+    '''
+    Shared AsyncOpenAI client for the current event loop.
+    '''
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        options = _options()
+        http_client = DefaultAsyncHttpxClient(
+            transport=AsyncBreakerTransport(limits=_limits(options)),
+            event_hooks={"request": [_astart_trace], "response": [_afinish_trace]},
+            timeout=_timeout(options),
+        )
+        client = AsyncOpenAI(api_key=config.openai_api_key, max_retries=0,
+                             http_client=http_client)
+        _async_clients[loop] = client
+    return client
+
+
+# Per-request timings via httpcore's "trace" extension. A reused keep-alive
+# connection emits no connect events, so connect_ms is 0 for those.
+
+def _start_trace(request):
+    marks = {"start": time.perf_counter()}
+
+    def trace(event, info):
+        marks[event] = time.perf_counter()
+
+    request.extensions["trace"] = trace
+    request.extensions["llm_marks"] = marks
+
+
+def _finish_trace(response):
+    marks = response.request.extensions.get("llm_marks")
+    if marks is None:
+        return
+    connect_start = marks.get("connection.connect_tcp.started")
+    connect_end = marks.get("connection.start_tls.complete",
+                            marks.get("connection.connect_tcp.complete"))
+    sent = marks.get("http11.send_request_headers.started",
+                     marks.get("http2.send_request_headers.started", marks["start"]))
+    first_byte = marks.get("http11.receive_response_headers.complete",
+                           marks.get("http2.receive_response_headers.complete", time.perf_counter()))
+    timings = {
+        "connect_ms": round((connect_end - connect_start) * 1000, 1) if connect_start and connect_end else 0.0,
+        "ttfb_ms": round((first_byte - sent) * 1000, 1),
+        "reused": connect_start is None,
+    }
+    _timings.set(timings)
+    metrics.observe('companion_llm_request_duration_seconds', timings['ttfb_ms'] / 1000,
+                    status=str(response.status_code))
+    logger.debug("LLM %s connect=%sms ttfb=%sms reused=%s", response.status_code,
+                 timings['connect_ms'], timings['ttfb_ms'], timings['reused'],
+                 extra={"status": response.status_code, **timings})
+
+
+async def _astart_trace(request):
+    _start_trace(request)
+    trace = request.extensions["trace"]
+
+    async def atrace(event, info):
+        trace(event, info)
+
+    request.extensions["trace"] = atrace
+
+
+async def _afinish_trace(response):
+    _finish_trace(response)
+
+
+def last_timings():
+    '''
+    connect/TTFB timings of the latest LLM HTTP request made in this context, or None.
+    '''
+    return _timings.get()
+
+
+@receiver(request_started)
+def _reset_timings(**kwargs):
+    # A worker thread keeps its context between requests; without this a
+    # request that never reaches the LLM would report the last one's timings
+    _timings.set(None)
+
+
+def record_usage(usage):
+    '''
+    Count a completion's token usage (completion.usage) in the metrics.
+    '''
+    if usage is None:
+        return
+    metrics.inc('companion_llm_tokens_total', usage.prompt_tokens, kind="prompt")
+    metrics.inc('companion_llm_tokens_total', usage.completion_tokens, kind="completion")
+
+
+def server_timing():
+    '''
+    Server-Timing header value for the latest LLM request, or None.
+    '''
+    timings = last_timings()
+    if timings is None:
+        return None
+    return f"llm-connect;dur={timings['connect_ms']}, llm-ttfb;dur={timings['ttfb_ms']}"
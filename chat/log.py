@@ -0,0 +1,57 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import time
+
+# Logging plumbing for settings.LOGGING: one JSON object per line, written
+# by a background thread so a request never waits on stderr.
+
+_RECORD_FIELDS = frozenset(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    '''
+    {"ts", "level", "logger", "msg"} plus whatever was passed as extra={...}.
+    '''
+
+    def format(self, record):
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        entry.update((k, v) for k, v in vars(record).items() if k not in _RECORD_FIELDS)
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class BackgroundHandler(logging.handlers.QueueHandler):
+    '''
+    Queues records for a listener thread that formats and writes them to
+    stderr. Forked workers start their own listener on first use.
+    '''
+
+    def __init__(self):
+        super().__init__(queue.SimpleQueue())
+        self.target = logging.StreamHandler()
+        self.listener = None
+        self.pid = None
+
+    def setFormatter(self, fmt):
+        self.target.setFormatter(fmt)  # formatting happens on the listener thread
+
+    def prepare(self, record):
+        return record
+
+    def emit(self, record):
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.listener = logging.handlers.QueueListener(self.queue, self.target)
+            self.listener.start()
+            atexit.register(self.listener.stop)
+        super().emit(record)
@@ -0,0 +1,25 @@
+import time
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from chat import archive
+
+
+class Command(BaseCommand):
+    help = ("Move old ChatHistory rows into the per-user archive. Run it from cron, "
+            "or leave it running with --every.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--age-days", type=int, default=None,
+                            help="Archive messages older than this (default: CHAT_ARCHIVE['AGE_DAYS']).")
+        parser.add_argument("--every", type=int, default=None,
+                            help="Keep running, archiving every this many seconds.")
+
+    def handle(self, *args, **options):
+        while True:
+            started = time.perf_counter()
+            moved = archive.archive(options["age_days"])
+            self.stdout.write(f"archived {moved} messages in {time.perf_counter() - started:.1f}s")
+            if not options["every"]:
+                return
+            close_old_connections()
+            time.sleep(options["every"])
@@ -0,0 +1,120 @@
+import os
+import random
+import shutil
+import statistics
+import tempfile
+import time
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import override_settings
+from django.utils import timezone
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+from chat.models import User, ChatHistory
+from chat.pagination import ChatHistoryCursorPagination
+from chat import archive
+
+
+class Command(BaseCommand):
+    help = "(user, timestamp) index size and hot-query latency before and after archiving."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=1000000)
+        parser.add_argument("--users", type=int, default=200)
+        parser.add_argument("--days", type=int, default=365, help="History spans this many days.")
+        parser.add_argument("--age-days", type=int, default=30)
+        parser.add_argument("--repeat", type=int, default=200)
+
+    def handle(self, *args, **options):
+        self.rng = random.Random(42)
+        self.repeat = options["repeat"]
+        location = tempfile.mkdtemp(prefix="chat_archive_")
+        # A throwaway database: archiving deletes rows, so never touch the real one
+        if connection.vendor == 'sqlite':
+            connection.settings_dict['TEST']['NAME'] = os.path.join(location, "bench.sqlite3")
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            users = User.objects.bulk_create([User(username=f"bench_archive_{i}")
+                                              for i in range(options["users"])])
+            with override_settings(CHAT_ARCHIVE={'LOCATION': os.path.join(location, "archive")}):
+                self.fill(users, options["rows"], options["days"])
+                self.stdout.write(f"{options['rows']} rows, {options['users']} users, "
+                                  f"{options['days']} days on {connection.vendor}")
+                self.stdout.write(f"{'':<8} {'rows':>8} {'index KB':>9} {'latest page':>12} "
+                                  f"{'context':>8} {'archived page':>14}   (ms, median)")
+                self.report("before", users)
+                started = time.perf_counter()
+                moved = archive.archive(options["age_days"], user_ids=[user.pk for user in users])
+                self.vacuum()
+                self.stdout.write(f"archived {moved} rows older than {options['age_days']} days in "
+                                  f"{time.perf_counter() - started:.1f}s, "
+                                  f"{self.archive_size(os.path.join(location, 'archive')) // 1024} KB of segments")
+                self.report("after", users)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            shutil.rmtree(location, ignore_errors=True)
+
+    def fill(self, users, rows, days):
+        now = timezone.now()
+        sql = (f"INSERT INTO {ChatHistory._meta.db_table} "
+               "(user_id, message, timestamp, is_user_message) VALUES (%s, %s, %s, %s)")
+        with transaction.atomic(), connection.cursor() as cursor:
+            for offset in range(0, rows, 10000):
+                cursor.executemany(sql, [
+                    (self.rng.choice(users).pk, f"message {i}",
+                     now - timedelta(seconds=self.rng.randrange(days * 86400)), i % 2 == 0)
+                    for i in range(offset, min(offset + 10000, rows))
+                ])
+
+    def vacuum(self):
+        # Give the freed pages back so the sizes compare like-for-like
+        with connection.cursor() as cursor:
+            if connection.vendor == 'sqlite':
+                cursor.execute("VACUUM")
+            elif connection.vendor == 'postgresql':
+                cursor.execute(f"VACUUM FULL {ChatHistory._meta.db_table}")
+
+    def index_size(self):
+        name = ChatHistory._meta.indexes[0].name
+        with connection.cursor() as cursor:
+            if connection.vendor == 'sqlite':
+                cursor.execute("SELECT SUM(pgsize) FROM dbstat WHERE name = %s", [name])
+            elif connection.vendor == 'postgresql':
+                cursor.execute("SELECT pg_relation_size(%s)", [name])
+            else:
+                return 0
+            return cursor.fetchone()[0] or 0
+
+    def archive_size(self, location):
+        return sum(os.path.getsize(os.path.join(root, f))
+                   for root, _, files in os.walk(location) for f in files)
+
+    def time_it(self, users, fn):
+        samples = []
+        for _ in range(self.repeat):
+            user = self.rng.choice(users)
+            started = time.perf_counter()
+            fn(user)
+            samples.append((time.perf_counter() - started) * 1000)
+        return statistics.median(samples)
+
+    def page(self, user, **params):
+        request = Request(APIRequestFactory().get("/api/v1/chat-history/", params))
+        request.user = user
+        return ChatHistoryCursorPagination().paginate_queryset(
+            ChatHistory.objects.filter(user=user), request)
+
+    def report(self, label, users):
+        rows = ChatHistory.objects.filter(user__in=users).count()
+        latest = self.time_it(users, lambda user: self.page(user))
+        # The query context.recent_turns runs on a cache miss
+        context = self.time_it(users, lambda user: list(
+            ChatHistory.objects.filter(user=user).order_by('-timestamp')
+            .values_list('message', 'is_user_message')[:20]))
+        # Paging back ~8 months, which after archiving is served from segments
+        cursor = ChatHistoryCursorPagination().encode_cursor(
+            ChatHistory(timestamp=timezone.now() - timedelta(days=240), pk=0))
+        older = self.time_it(users, lambda user: self.page(user, before=cursor))
+        self.stdout.write(f"{label:<8} {rows:>8} {self.index_size() // 1024:>9} {latest:>12.2f} "
+                          f"{context:>8.2f} {older:>14.2f}")
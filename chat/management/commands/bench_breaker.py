@@ -0,0 +1,121 @@
+import os
+import statistics
+import threading
+import time
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.test import Client, override_settings
+from django.test.utils import setup_test_environment
+from rest_framework_simplejwt.tokens import AccessToken
+from chat import breaker, llm
+from chat.models import User, ChatHistory
+from .bench_talk import FakeCompletionServer, FakeCompletionHandler
+
+
+class FlakyCompletionHandler(FakeCompletionHandler):
+    '''
+    FakeCompletionHandler that can be switched to failing: "error" answers
+    503 at once, "hang" stalls past the client's timeout.
+    '''
+    fault = None
+    hang = 5.0
+    hits = 0
+
+    def do_POST(self):
+        type(self).hits += 1
+        if self.fault == "hang":
+            time.sleep(self.hang)  # the client has given up by now
+            self.close_connection = True
+            return
+        if self.fault:
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            body = b'{"error": {"message": "overloaded", "type": "server_error"}}'
+            self.send_response(503)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        super().do_POST()
+
+
+class Command(BaseCommand):
+    help = ("Drive talk_api through an OpenAI outage (local fake server injecting errors or "
+            "hangs) with and without the circuit breaker; report latency, statuses and upstream load.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--fault", choices=["error", "hang"], default="hang")
+        parser.add_argument("--requests", type=int, default=30, help="Requests per phase.")
+        parser.add_argument("--latency", type=float, default=0.2, help="Healthy completion time.")
+        parser.add_argument("--timeout", type=float, default=1.0, help="OpenAI client timeout.")
+        parser.add_argument("--concurrency", type=int, default=4)
+        parser.add_argument("--think", type=float, default=0.1,
+                            help="Pause between a client's requests in seconds.")
+
+    def handle(self, *args, **options):
+        FlakyCompletionHandler.latency = options["latency"]
+        FlakyCompletionHandler.token_interval = 0
+        FlakyCompletionHandler.hang = options["timeout"] + 1
+        server = FakeCompletionServer(("127.0.0.1", 0), FlakyCompletionHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f"http://127.0.0.1:{server.server_port}/v1"
+        setup_test_environment()  # lets the test client use the 'testserver' host
+
+        # talk_api allows 120 replies per user per hour; spread the load
+        self.users = [User.objects.get_or_create(username=f"bench_breaker_{i}")[0] for i in range(20)]
+        self.turn = 0
+        self.stdout.write(f"{'breaker':<8} {'phase':<9} {'reqs':>5} {'p50 ms':>8} {'p99 ms':>8} "
+                          f"{'upstream':>8}  statuses")
+        # "off" never opens (the old behaviour: every request retries the dead upstream)
+        configs = {"off": {"FAILURES": 10 ** 9}, "on": {"FAILURES": 5, "OPEN_FOR": 2, "MAX_OPEN_FOR": 2}}
+        try:
+            for name, config in configs.items():
+                with override_settings(
+                        CHAT_BREAKERS={"openai": {"RETRIES": 2, **config}},
+                        LLM_CLIENT={**llm.DEFAULTS, "TIMEOUT": options["timeout"]}):
+                    os.environ["OPENAI_BASE_URL"] = base_url
+                    llm._client = None
+                    breaker._breakers.clear()
+                    cache.delete_many(["breaker:openai", "breaker:openai:failures", "breaker:openai:probe"])
+                    for phase, fault in (("healthy", None), ("outage", options["fault"]), ("recovery", None)):
+                        if phase == "recovery":
+                            time.sleep(2.5)  # the "on" circuit's open period runs out
+                        FlakyCompletionHandler.fault = fault
+                        self.run_phase(name, phase, options)
+        finally:
+            server.shutdown()
+            llm._client = None
+            ChatHistory.objects.filter(user__in=self.users).delete()
+
+    def run_phase(self, name, phase, options):
+        latencies, statuses = [], {}
+        lock = threading.Lock()
+        hits = FlakyCompletionHandler.hits
+        work = iter(range(options["requests"]))
+
+        def client_loop():
+            client = Client()
+            while True:
+                with lock:
+                    if next(work, None) is None:
+                        return
+                    self.turn += 1
+                    user = self.users[self.turn % len(self.users)]
+                t0 = time.perf_counter()
+                response = client.post("/api/v1/talk/", {"message": "I think I'll water the plants today"},
+                                       content_type="application/json",
+                                       headers={"authorization": f"Bearer {AccessToken.for_user(user)}"})
+                with lock:
+                    latencies.append(time.perf_counter() - t0)
+                    statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+                time.sleep(options["think"])
+
+        threads = [threading.Thread(target=client_loop) for _ in range(options["concurrency"])]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        q = statistics.quantiles(latencies, n=100)
+        self.stdout.write(f"{name:<8} {phase:<9} {len(latencies):>5} {q[49] * 1000:>8.1f} {q[98] * 1000:>8.1f} "
+                          f"{FlakyCompletionHandler.hits - hits:>8}  "
+                          + " ".join(f"{code}x{count}" for code, count in sorted(statuses.items())))
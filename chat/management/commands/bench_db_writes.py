@@ -0,0 +1,98 @@
+import copy
+import os
+import shutil
+import statistics
+import tempfile
+import threading
+import time
+from django.core.management.base import BaseCommand
+from django.db import connections, OperationalError
+from chat.models import User, ChatHistory
+
+BASELINE = 'bench_baseline'
+
+
+class Command(BaseCommand):
+    help = ("Concurrent talk-style writes (read recent turns, insert message and reply) "
+            "against an untuned connection vs the configured database profile.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=16,
+                            help="Concurrent writers, one connection each.")
+        parser.add_argument("--turns", type=int, default=200, help="Turns per worker.")
+
+    def handle(self, *args, **options):
+        connection = connections['default']
+        location = tempfile.mkdtemp(prefix="chat_db_writes_")
+        # A throwaway database, so the benchmark's rows never land in the real one
+        if connection.vendor == 'sqlite':
+            connection.settings_dict['TEST']['NAME'] = os.path.join(location, "bench.sqlite3")
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            self.compare(options)
+        finally:
+            connections.close_all()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            shutil.rmtree(location, ignore_errors=True)
+
+    def compare(self, options):
+        configured = connections['default'].settings_dict
+        # Untuned: Django's defaults, and a fresh connection every request.
+        baseline = copy.deepcopy(configured)
+        baseline.update(CONN_MAX_AGE=0, CONN_HEALTH_CHECKS=False, OPTIONS={})
+        connections.settings[BASELINE] = baseline
+        vendor = connections['default'].vendor
+
+        users = User.objects.bulk_create([User(username=f"bench_db_{i}") for i in range(options["workers"])])
+        self.stdout.write(f"{options['workers']} workers x {options['turns']} turns on {vendor}")
+        self.stdout.write(f"{'profile':<11} {'turns/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'errors':>7}")
+        if vendor == 'sqlite':
+            self.journal_mode(BASELINE, 'DELETE')
+        self.run("baseline", BASELINE, users, options)
+        if vendor == 'sqlite':
+            self.journal_mode('default', 'WAL')
+        self.run("configured", 'default', users, options)
+
+    def journal_mode(self, alias, mode):
+        # The journal mode is stored in the database file, and switching it
+        # needs the only open connection.
+        connections.close_all()
+        with connections[alias].cursor() as cursor:
+            cursor.execute(f"PRAGMA journal_mode={mode}")
+        connections[alias].close()
+
+    def run(self, label, alias, users, options):
+        latencies, errors = [], []
+
+        def worker(user):
+            connection = connections[alias]
+            try:
+                for i in range(options["turns"]):
+                    started = time.perf_counter()
+                    try:
+                        list(ChatHistory.objects.using(alias).filter(user=user)
+                             .order_by('-timestamp')[:5])
+                        ChatHistory.objects.using(alias).create(
+                            user=user, message=f"message {i}", is_user_message=True)
+                        ChatHistory.objects.using(alias).create(
+                            user=user, message=f"reply {i}", is_user_message=False)
+                        latencies.append((time.perf_counter() - started) * 1000)
+                    except OperationalError:
+                        errors.append(i)
+                    # What request_finished does after every request.
+                    connection.close_if_unusable_or_obsolete()
+            finally:
+                connection.close()
+
+        started = time.perf_counter()
+        threads = [threading.Thread(target=worker, args=(u,)) for u in users]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - started
+        ChatHistory.objects.filter(user__in=users).delete()
+
+        q = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else [0.0] * 99
+        self.stdout.write(f"{label:<11} {len(latencies) / elapsed:>8.0f} {q[49]:>8.2f} "
+                          f"{q[98]:>8.2f} {len(errors):>7}")
@@ -0,0 +1,73 @@
+import os
+import shutil
+import statistics
+import tempfile
+import time
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+from chat.models import User, ChatHistory
+from chat.pagination import ChatHistoryCursorPagination
+
+
+class Command(BaseCommand):
+    help = "Page fetch latency at different history depths: keyset cursor vs OFFSET."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", default="10000,100000,1000000",
+                            help="Comma-separated history sizes (rows for one user).")
+        parser.add_argument("--repeat", type=int, default=20)
+
+    def handle(self, *args, **options):
+        self.repeat = options["repeat"]
+        self.stdout.write(f"{'rows':>9} {'first page':>11} {'cursor@90%':>11} {'offset@90%':>11}   (ms, median)")
+        location = tempfile.mkdtemp(prefix="chat_pages_")
+        # A throwaway database, so the filler rows never land in the real one
+        if connection.vendor == 'sqlite':
+            connection.settings_dict['TEST']['NAME'] = os.path.join(location, "bench.sqlite3")
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            for size in [int(n) for n in options["sizes"].split(",")]:
+                user = User.objects.create(username=f"bench_pages_{size}")
+                self.fill(user, size)
+                self.report(user, size)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            shutil.rmtree(location, ignore_errors=True)
+
+    def fill(self, user, size):
+        start = timezone.now() - timedelta(seconds=size)
+        sql = (f"INSERT INTO {ChatHistory._meta.db_table} "
+               "(user_id, message, timestamp, is_user_message) VALUES (%s, %s, %s, %s)")
+        with transaction.atomic(), connection.cursor() as cursor:
+            for offset in range(0, size, 10000):
+                cursor.executemany(sql, [
+                    (user.pk, f"message {i}", start + timedelta(seconds=i), i % 2 == 0)
+                    for i in range(offset, min(offset + 10000, size))
+                ])
+
+    def time_it(self, fn):
+        samples = []
+        for _ in range(self.repeat):
+            started = time.perf_counter()
+            fn()
+            samples.append((time.perf_counter() - started) * 1000)
+        return statistics.median(samples)
+
+    def page(self, user, **params):
+        paginator = ChatHistoryCursorPagination()
+        request = Request(APIRequestFactory().get("/api/v1/chat-history/", params))
+        return paginator.paginate_queryset(ChatHistory.objects.filter(user=user), request)
+
+    def report(self, user, size):
+        depth = int(size * 0.9)
+        anchor = ChatHistory.objects.filter(user=user).order_by('-timestamp', '-id')[depth]
+        cursor = ChatHistoryCursorPagination().encode_cursor(anchor)
+        first = self.time_it(lambda: self.page(user))
+        keyset = self.time_it(lambda: self.page(user, before=cursor))
+        offset = self.time_it(lambda: list(
+            ChatHistory.objects.filter(user=user).order_by('-timestamp', '-id')[depth:depth + 50]))
+        self.stdout.write(f"{size:>9} {first:>11.2f} {keyset:>11.2f} {offset:>11.2f}")
@@ -0,0 +1,52 @@
+import threading
+import time
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings
+from chat.models import User, ChatHistory
+from chat import writebehind
+
+
+class Command(BaseCommand):
+    help = "ChatHistory INSERT throughput: one autocommit INSERT per turn vs write-behind batches."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--exchanges", type=int, default=500,
+                            help="User+AI turn pairs per thread.")
+        parser.add_argument("--threads", type=int, default=4)
+        parser.add_argument("--batch", type=int, default=50)
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"{options['threads']} threads x {options['exchanges']} exchanges "
+                          f"on {connection.vendor}")
+        self.stdout.write(f"{'mode':<13} {'rows':>7} {'seconds':>8} {'rows/s':>9}")
+        users = [User.objects.get_or_create(username=f"bench_writer_{i}")[0]
+                 for i in range(options["threads"])]
+        try:
+            self.run("direct", users, options, {'ENABLED': False})
+            self.run("write-behind", users, options,
+                     {'ENABLED': True, 'MAX_BATCH': options["batch"], 'MAX_DELAY': 0.5})
+        finally:
+            ChatHistory.objects.filter(user__in=users).delete()
+
+    def run(self, mode, users, options, write_behind):
+        def writer(user):
+            try:
+                for i in range(options["exchanges"]):
+                    writebehind.save_turn(user, f"message {i}", True)
+                    writebehind.save_turn(user, f"reply {i}", False)
+            finally:
+                connection.close()
+
+        with override_settings(CHAT_WRITE_BEHIND=write_behind):
+            started = time.perf_counter()
+            threads = [threading.Thread(target=writer, args=(u,)) for u in users]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            writebehind.flush()  # what shutdown would do; count it
+            elapsed = time.perf_counter() - started
+        rows = ChatHistory.objects.filter(user__in=users).count()
+        ChatHistory.objects.filter(user__in=users).delete()
+        self.stdout.write(f"{mode:<13} {rows:>7} {elapsed:>8.2f} {rows / elapsed:>9.0f}")
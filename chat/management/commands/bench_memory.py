@@ -0,0 +1,75 @@
+import itertools
+import random
+import shutil
+import statistics
+import tempfile
+import time
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import override_settings
+from django.utils import timezone
+from chat.models import User, ChatHistory
+from chat import memory
+
+VOCABULARY = [f"word{i}" for i in range(20000)]
+CUM_WEIGHTS = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(VOCABULARY))))
+
+
+class Command(BaseCommand):
+    help = "Long-term memory: index build rate, incremental add and top-k recall latency for one user."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--vectors", type=int, default=100000)
+        parser.add_argument("--queries", type=int, default=200)
+
+    def handle(self, *args, **options):
+        rng = random.Random(42)
+        user, _ = User.objects.get_or_create(username="bench_memory")
+        location = tempfile.mkdtemp(prefix="chat_memory_")
+        try:
+            with override_settings(CHAT_MEMORY={'LOCATION': location}):
+                self.fill(user, options["vectors"], rng)
+                started = time.perf_counter()
+                count = memory.rebuild(user.pk)
+                elapsed = time.perf_counter() - started
+                self.stdout.write(f"built {count} x {memory.get_embedder().dim} "
+                                  f"({memory.get_embedder().name}) in {elapsed:.1f}s, "
+                                  f"{count / elapsed:.0f} messages/s")
+
+                texts = [self.sentence(rng) for _ in range(options["queries"])]
+                vectors, _ = memory._load(user.pk)
+                queries = memory.get_embedder().embed(texts)
+                self.report("scan+top-k", [lambda q=q: memory.np.argpartition(-(vectors @ q), 2)[:3]
+                                           for q in queries])
+                self.report("recall", [lambda t=t: memory.recall(user, t) for t in texts])
+
+                chats = ChatHistory.objects.bulk_create([
+                    ChatHistory(user=user, message=t, is_user_message=True) for t in texts])
+                self.report("add one", [lambda c=c: memory.add([c]) for c in chats])
+        finally:
+            ChatHistory.objects.filter(user=user).delete()
+            shutil.rmtree(location, ignore_errors=True)
+
+    def sentence(self, rng):
+        return " ".join(rng.choices(VOCABULARY, cum_weights=CUM_WEIGHTS, k=rng.randint(4, 20)))
+
+    def fill(self, user, rows, rng):
+        start = timezone.now() - timedelta(seconds=rows)
+        sql = (f"INSERT INTO {ChatHistory._meta.db_table} "
+               "(user_id, message, timestamp, is_user_message) VALUES (%s, %s, %s, %s)")
+        with transaction.atomic(), connection.cursor() as cursor:
+            for offset in range(0, rows, 10000):
+                cursor.executemany(sql, [
+                    (user.pk, self.sentence(rng), start + timedelta(seconds=i), i % 2 == 0)
+                    for i in range(offset, min(offset + 10000, rows))
+                ])
+
+    def report(self, label, calls):
+        samples = []
+        for call in calls:
+            started = time.perf_counter()
+            call()
+            samples.append((time.perf_counter() - started) * 1000)
+        q = statistics.quantiles(samples, n=100)
+        self.stdout.write(f"{label:<11} p50 {q[49]:.2f} ms  p99 {q[98]:.2f} ms")
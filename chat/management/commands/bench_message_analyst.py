@@ -0,0 +1,57 @@
+import random
+import time
+from django.core.management.base import BaseCommand
+from chat import message_analyst as ma
+
+SAMPLES = [
+    "Good morning! Did you sleep well?",
+    "I don't know what to make for lunch today",
+    "How are you doing this afternoon",
+    "My daughter called, she's coming over on Sunday.",
+    "I'm not feeling very good, my back hurts again",
+    "Can you remind me to take my pills at 8?",
+    "It's raining again. I wish it were sunny.",
+    "Thank you, that was lovely to hear.",
+    "I feel a bit lonely since Harold passed.",
+    "Do you remember the name of that song?",
+    "The doctor said my blood pressure is better",
+    "I don't want to go out in the cold",
+    "That's wonderful news! I'm so glad for you.",
+    "What a nice day for a walk in the park.",
+    "Good night, talk to you tomorrow",
+]
+
+
+def legacy(message):
+    # What talk_api did before: prefix check for the style, substring loop for
+    # is_question, and a substring loop per lexicon phrase for the other signals
+    words = ['what', 'when', 'where', 'how', 'why', 'who', 'can', 'do', 'if']
+    lower = message.lower()
+    starts = lower.startswith(tuple(words))
+    question = message.strip().endswith('?') or any(word in lower for word in words)
+    labels = {label for label, phrases in ma.LEXICON.items() for phrase in phrases if phrase in lower}
+    return starts, question, labels
+
+
+class Command(BaseCommand):
+    help = "message_analyst throughput: the old per-word loops vs analyze(), classify_batch() and is_question()."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--messages", type=int, default=100000)
+
+    def handle(self, *args, **options):
+        rng = random.Random(42)
+        messages = [rng.choice(SAMPLES) for _ in range(options["messages"])]
+        self.stdout.write(f"{len(messages)} messages")
+        self.stdout.write(f"{'method':<16} {'msgs/s':>10} {'questions':>10}")
+        self.run("per-word loops", lambda: [legacy(m) for m in messages], lambda r: r[1])
+        self.run("analyze()", lambda: [ma.analyze(m) for m in messages], lambda r: r.is_question)
+        self.run("classify_batch", lambda: ma.classify_batch(messages), lambda r: r.is_question)
+        self.run("is_question()", lambda: [ma.is_question(m) for m in messages], bool)
+
+    def run(self, label, fn, question):
+        started = time.perf_counter()
+        results = fn()
+        elapsed = time.perf_counter() - started
+        share = sum(1 for r in results if question(r)) / len(results)
+        self.stdout.write(f"{label:<16} {len(results) / elapsed:>10.0f} {share:>10.0%}")
@@ -0,0 +1,71 @@
+import time
+import phonenumbers
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+from chat import onboarding
+from chat.models import User
+from chat.serializers import RegisterSerializer
+
+PHONES = ["(617) 555-0100", "617.555.0101", "+1 617 555 0102", "617-555-0103"]
+
+
+class Command(BaseCommand):
+    help = ("Resident onboarding: one RegisterSerializer save per row (what the register endpoint "
+            "does) against chat.onboarding.import_residents, for the same rows.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=500)
+        parser.add_argument("--bad", type=float, default=0.02, help="Fraction of rows with an invalid field.")
+        parser.add_argument("--workers", type=int, default=None,
+                            help="Password-hashing processes for the bulk path (CHAT_ONBOARDING['WORKERS']).")
+        parser.add_argument("--fast-hasher", action="store_true",
+                            help="Hash with MD5 so the timings show validation and inserts only.")
+
+    def handle(self, *args, **options):
+        hashers = {'PASSWORD_HASHERS': ['django.contrib.auth.hashers.MD5PasswordHasher']} \
+            if options["fast_hasher"] else {}
+        with override_settings(**hashers):
+            try:
+                self.per_row(self.rows("bench_onb_a_", options["rows"], options["bad"]))
+                self.bulk(self.rows("bench_onb_b_", options["rows"], options["bad"]), options["workers"])
+            finally:
+                User.objects.filter(username__startswith="bench_onb_").delete()
+
+    def rows(self, prefix, count, bad):
+        every = int(1 / bad) if bad else 0
+        return [(i + 2, {"username": f"{prefix}{i}", "password": f"pw-{i}", "preferred_name": f"Resident {i}",
+                         "security_answer": "blue", "city": "Somerville",
+                         "phone_number": "12" if every and i % every == 0 else PHONES[i % len(PHONES)]})
+                for i in range(count)]
+
+    def per_row(self, rows):
+        # The register endpoint takes no phone number; set it after, the way a
+        # profile edit would, so both paths end with the same data
+        created = 0
+        started = time.perf_counter()
+        for _, row in rows:
+            serializer = RegisterSerializer(data=row)
+            if not serializer.is_valid():
+                continue
+            user = serializer.save()
+            profile = user.profile
+            try:
+                profile.phone_number = phonenumbers.format_number(
+                    phonenumbers.parse(row["phone_number"], "US"), phonenumbers.PhoneNumberFormat.E164)
+                profile.save()  # clean() parses it again
+            except (phonenumbers.NumberParseException, ValidationError):
+                user.delete()
+                continue
+            created += 1
+        self.report("per-row", len(rows), created, time.perf_counter() - started)
+
+    def bulk(self, rows, workers):
+        onboarding._phone.cache_clear()
+        started = time.perf_counter()
+        result = onboarding.import_residents(rows, workers=workers)
+        self.report("bulk", len(rows), result["created"], time.perf_counter() - started)
+
+    def report(self, label, rows, created, elapsed):
+        self.stdout.write(f"{label:<8} {rows} rows, {created} created in {elapsed:.2f}s  "
+                          f"({rows / elapsed:.0f} rows/s)")
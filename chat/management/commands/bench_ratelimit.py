@@ -0,0 +1,73 @@
+import multiprocessing
+import time
+import uuid
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from chat import ratelimit
+
+
+def naive_worker(key, hits, limit, queue):
+    # The old PasswordResetView pattern: read, compare, write back
+    allowed = 0
+    started = time.perf_counter()
+    for _ in range(hits):
+        attempts = cache.get(key, 0)
+        if attempts < limit:
+            allowed += 1
+        cache.set(key, attempts + 1, timeout=3600)
+    queue.put((allowed, time.perf_counter() - started))
+
+
+def ratelimit_worker(scope, hits, limit, queue):
+    ratelimit._backend = None  # fresh backend (and connections) in this process
+    allowed = 0
+    started = time.perf_counter()
+    for _ in range(hits):
+        allowed += ratelimit.hit(scope, "bench", limit, 3600)[0]
+    queue.put((allowed, time.perf_counter() - started))
+
+
+class Command(BaseCommand):
+    help = "Hammer one rate-limit key from several processes and count lost increments."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--processes", type=int, default=8)
+        parser.add_argument("--hits", type=int, default=500,
+                            help="Requests per process.")
+        parser.add_argument("--limit", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        processes, hits, limit = options["processes"], options["hits"], options["limit"]
+        total = processes * hits
+        self.stdout.write(f"backend: {ratelimit.get_backend().__class__.__name__}, "
+                          f"{processes} processes x {hits} hits, limit {limit}")
+        self.stdout.write(f"{'mode':<10} {'counted':>8} {'lost':>6} {'allowed':>8} {'ops/s':>9}")
+
+        key = f"bench_naive_{uuid.uuid4().hex}"
+        allowed, elapsed = self.run(naive_worker, key, hits, limit, processes)
+        counted = cache.get(key, 0)
+        cache.delete(key)
+        # Counts every attempt
+        self.report("get/set", total, counted, allowed, elapsed, total)
+
+        scope = f"bench_{uuid.uuid4().hex}"
+        allowed, elapsed = self.run(ratelimit_worker, scope, hits, limit, processes)
+        counted = ratelimit.get_backend().get(f"rl:{scope}:bench:{int(time.time() // 3600)}")
+        # Counts allowed requests only
+        self.report("ratelimit", allowed, counted, allowed, elapsed, total)
+
+    def run(self, target, key, hits, limit, processes):
+        ctx = multiprocessing.get_context("fork")
+        queue = ctx.Queue()
+        workers = [ctx.Process(target=target, args=(key, hits, limit, queue))
+                   for _ in range(processes)]
+        for w in workers:
+            w.start()
+        results = [queue.get() for _ in workers]
+        for w in workers:
+            w.join()
+        return sum(r[0] for r in results), max(r[1] for r in results)
+
+    def report(self, mode, expected, counted, allowed, elapsed, total):
+        self.stdout.write(f"{mode:<10} {counted:>8} {expected - counted:>6} {allowed:>8} "
+                          f"{total / elapsed:>9.0f}")
@@ -0,0 +1,69 @@
+import itertools
+import os
+import random
+import shutil
+import statistics
+import tempfile
+import time
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+from chat.models import User, ChatHistory
+from chat import search
+
+# Word frequencies in real chat follow Zipf's law; a flat toy vocabulary would
+# make every term hit a quarter of the corpus. Queries use ranks 10-2000.
+VOCABULARY = [f"word{i}" for i in range(20000)]
+CUM_WEIGHTS = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(VOCABULARY))))
+
+
+class Command(BaseCommand):
+    help = "Full-text search latency over a synthetic (Zipf-distributed) ChatHistory corpus."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=1000000)
+        parser.add_argument("--users", type=int, default=100)
+        parser.add_argument("--queries", type=int, default=200)
+
+    def handle(self, *args, **options):
+        rng = random.Random(42)
+        location = tempfile.mkdtemp(prefix="chat_search_")
+        # A throwaway database, so the filler rows never land in the real one
+        if connection.vendor == 'sqlite':
+            connection.settings_dict['TEST']['NAME'] = os.path.join(location, "bench.sqlite3")
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            users = User.objects.bulk_create([User(username=f"bench_search_{i}")
+                                              for i in range(options["users"])])
+            started = time.perf_counter()
+            self.fill(users, options["rows"], rng)
+            self.stdout.write(f"indexed {options['rows']} rows in {time.perf_counter() - started:.1f}s "
+                              f"({connection.vendor})")
+            for label, scoped in (("per-user", True), ("all users", False)):
+                samples = []
+                for _ in range(options["queries"]):
+                    text = " ".join(VOCABULARY[rng.randrange(10, 2000)]
+                                    for _ in range(rng.choice((1, 2))))
+                    user = rng.choice(users) if scoped else None
+                    t0 = time.perf_counter()
+                    search.search(text, user=user, limit=20)
+                    samples.append((time.perf_counter() - t0) * 1000)
+                q = statistics.quantiles(samples, n=100)
+                self.stdout.write(f"{label:<10} p50 {q[49]:.2f} ms  p99 {q[98]:.2f} ms")
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            shutil.rmtree(location, ignore_errors=True)
+
+    def fill(self, users, rows, rng):
+        start = timezone.now() - timedelta(seconds=rows)
+        sql = (f"INSERT INTO {ChatHistory._meta.db_table} "
+               "(user_id, message, timestamp, is_user_message) VALUES (%s, %s, %s, %s)")
+        with transaction.atomic(), connection.cursor() as cursor:
+            for offset in range(0, rows, 10000):
+                cursor.executemany(sql, [
+                    (rng.choice(users).pk,
+                     " ".join(rng.choices(VOCABULARY, cum_weights=CUM_WEIGHTS, k=rng.randint(4, 20))),
+                     start + timedelta(seconds=i), i % 2 == 0)
+                    for i in range(offset, min(offset + 10000, rows))
+                ])
@@ -0,0 +1,100 @@
+import shutil
+import statistics
+import tempfile
+import time
+import numpy as np
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+from chat import blobs, speakers
+from chat.models import User, UserProfile
+
+
+class Command(BaseCommand):
+    help = ("Speaker identification: index build time, single and batched query latency, "
+            "accuracy on noisy probes and incremental update cost, against a per-profile loop.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=10000)
+        parser.add_argument("--queries", type=int, default=500)
+        parser.add_argument("--batch", type=int, default=32, help="Probes per identify_many() call.")
+        parser.add_argument("--noise", type=float, default=0.05,
+                            help="Std. dev. of the Gaussian noise added to each probe coordinate.")
+
+    def handle(self, *args, **options):
+        rng = np.random.default_rng(42)
+        dim = speakers._options()['DIM']
+        location = tempfile.mkdtemp(prefix="chat_blobs_")
+        try:
+            with override_settings(CHAT_BLOBS={'LOCATION': location}):
+                blobs._store = None
+                enrolled = self.enroll(options["users"], dim, rng)
+                user_ids = np.array(list(enrolled))
+                vectors = np.stack(list(enrolled.values()))
+
+                started = time.perf_counter()
+                speakers._index = None
+                index = speakers.get_index()
+                self.stdout.write(f"built index of {len(index)} x {dim} in "
+                                  f"{(time.perf_counter() - started) * 1000:.0f} ms")
+
+                truth = rng.integers(len(user_ids), size=options["queries"])
+                probes = vectors[truth] + rng.normal(0, options["noise"], (len(truth), dim)).astype(np.float32)
+                self.report("identify", [lambda p=p: speakers.identify(p) for p in probes])
+                batch = options["batch"]
+                self.report(f"batch of {batch}", [lambda b=probes[i:i + batch]: speakers.identify_many(b)
+                                                  for i in range(0, len(probes), batch)])
+                self.report("per-profile loop", [lambda p=p: self.naive(p) for p in probes[:5]])
+
+                matches = [speakers.identify(p) for p in probes]
+                right = sum(1 for m, t in zip(matches, truth) if m and m[0] == user_ids[t])
+                unknown = sum(1 for m in matches if m is None)
+                impostors = rng.normal(0, 1, (len(truth), dim)).astype(np.float32)
+                accepted = sum(1 for p in impostors if speakers.identify(p) is not None)
+                self.stdout.write(f"accuracy: {right}/{len(truth)} right, {unknown} unknown; "
+                                  f"{accepted}/{len(impostors)} strangers matched")
+
+                profiles = list(UserProfile.objects.filter(user_id__in=user_ids[:50].tolist()))
+                self.report("update one", [lambda p=p: self.reenroll(p, dim, rng) for p in profiles])
+        finally:
+            User.objects.filter(username__startswith="bench_speaker_").delete()
+            speakers._index = None
+            blobs._store = None
+            shutil.rmtree(location, ignore_errors=True)
+
+    def enroll(self, count, dim, rng):
+        User.objects.filter(username__startswith="bench_speaker_").delete()
+        User.objects.bulk_create([User(username=f"bench_speaker_{i}") for i in range(count)], batch_size=1000)
+        users = User.objects.filter(username__startswith="bench_speaker_").values_list('pk', flat=True)
+        store = blobs.store()
+        enrolled = {}
+        profiles = []
+        for user_id in users:
+            vector = rng.normal(0, 1, dim).astype(np.float32)
+            enrolled[user_id] = vector / np.linalg.norm(vector)
+            profiles.append(UserProfile(user_id=user_id, preferred_name=f"Resident {user_id}",
+                                        voice_key=store.put(speakers.encode(vector))))
+        UserProfile.objects.bulk_create(profiles, batch_size=1000)
+        return enrolled
+
+    def naive(self, probe):
+        # What the obvious version does: score each stored profile in turn
+        probe = speakers.decode(speakers.encode(probe))
+        best = None
+        for profile in UserProfile.objects.filter(account_status='A').exclude(voice_key=None):
+            score = float(speakers.decode(profile.read_voice()) @ probe)
+            if best is None or score > best[1]:
+                best = (profile.user_id, score)
+        return best
+
+    def reenroll(self, profile, dim, rng):
+        profile.set_voice(speakers.encode(rng.normal(0, 1, dim)))
+        profile.save(update_fields=['voice_key', 'voice_profile'])
+
+    def report(self, label, calls):
+        samples = []
+        for call in calls:
+            started = time.perf_counter()
+            call()
+            samples.append((time.perf_counter() - started) * 1000)
+        q = statistics.quantiles(samples, n=100) if len(samples) > 1 else samples * 99
+        self.stdout.write(f"{label:<17} p50 {q[49]:.2f} ms  p99 {q[98]:.2f} ms  ({len(samples)} calls)")
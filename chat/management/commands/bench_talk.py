@@ -0,0 +1,200 @@
+import asyncio
+import json
+import os
+import statistics
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from django.core.management.base import BaseCommand
+from django.test import AsyncClient, Client
+from django.test.utils import setup_test_environment
+from rest_framework_simplejwt.tokens import AccessToken
+from chat.models import User, ChatHistory
+
+
+class FakeCompletionServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+class FakeCompletionHandler(BaseHTTPRequestHandler):
+    '''
+    Answers any POST like /v1/chat/completions: waits `latency` for the first
+    token, then `token_interval` per further word. Honours "stream": true.
+    '''
+    protocol_version = "HTTP/1.1"
+    latency = 0.5
+    token_interval = 0.02
+    reply = "Lovely day for a cup of tea, isn't it? I'll put the kettle on."
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        words = self.reply.split(" ")
+        pieces = [words[0]] + [" " + w for w in words[1:]]
+        if request.get("stream"):
+            return self.stream(pieces)
+        time.sleep(self.latency + self.token_interval * (len(pieces) - 1))
+        body = json.dumps({
+            "id": "chatcmpl-bench",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": "gpt-3.5-turbo",
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": self.reply},
+                "finish_reason": "stop",
+            }],
+            "usage": {"prompt_tokens": 50, "completion_tokens": len(pieces), "total_tokens": 50 + len(pieces)},
+        }).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def stream(self, pieces):
+        self.close_connection = True
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        time.sleep(self.latency)
+        for i, piece in enumerate(pieces + [None]):
+            if i:
+                time.sleep(self.token_interval)
+            chunk = {
+                "id": "chatcmpl-bench",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": "gpt-3.5-turbo",
+                "choices": [{
+                    "index": 0,
+                    "delta": {"content": piece} if piece else {},
+                    "finish_reason": None if piece else "stop",
+                }],
+            }
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            self.wfile.flush()
+        self.wfile.write(b"data: [DONE]\n\n")
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Command(BaseCommand):
+    help = "Load-test talk_api (sync) vs talk_api_async against a local fake completion server."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--mode", choices=["sync", "async", "both"], default="both")
+        parser.add_argument("--concurrency", default="1,10,50,100,200",
+                            help="Comma-separated concurrent client counts.")
+        parser.add_argument("--rounds", type=int, default=3,
+                            help="Sequential requests per client.")
+        parser.add_argument("--workers", type=int, default=8,
+                            help="Worker threads available to the sync view (gunicorn threads).")
+        parser.add_argument("--latency", type=float, default=0.5,
+                            help="Fake completion time to first token in seconds.")
+        parser.add_argument("--stream", action="store_true",
+                            help="Request SSE streaming and also report time to first word.")
+
+    def handle(self, *args, **options):
+        FakeCompletionHandler.latency = options["latency"]
+        self.stream = options["stream"]
+        server = FakeCompletionServer(("127.0.0.1", 0), FakeCompletionHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        # Both OpenAI and AsyncOpenAI pick this up when no base_url is passed.
+        os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{server.server_port}/v1"
+
+        user, _ = User.objects.get_or_create(
+            username="bench_user", defaults={"first_name": "Bench"})
+        self.headers = {"authorization": f"Bearer {AccessToken.for_user(user)}"}
+        setup_test_environment()  # lets the test clients use the 'testserver' host
+
+        modes = ["sync", "async"] if options["mode"] == "both" else [options["mode"]]
+        header = f"{'mode':<6} {'conc':>5} {'reqs':>5} {'p50 ms':>8} {'p99 ms':>8} {'req/s':>8}"
+        if self.stream:
+            header += f" {'ttfw p50':>9} {'ttfw p99':>9}"
+        self.stdout.write(header)
+        try:
+            for level in [int(c) for c in options["concurrency"].split(",")]:
+                for mode in modes:
+                    started = time.perf_counter()
+                    self.first_words = []
+                    if mode == "sync":
+                        latencies = self.run_sync(level, options["rounds"], options["workers"])
+                    else:
+                        latencies = asyncio.run(self.run_async(level, options["rounds"]))
+                    elapsed = time.perf_counter() - started
+                    self.report(mode, level, latencies, elapsed)
+        finally:
+            server.shutdown()
+            ChatHistory.objects.filter(user=user).delete()
+
+    def post_body(self):
+        return {"message": "I think I'll water the plants today", "city": "Boston",
+                "stream": self.stream}
+
+    def run_sync(self, level, rounds, workers):
+        gate = threading.BoundedSemaphore(workers)
+        latencies = []
+        lock = threading.Lock()
+
+        def client_loop():
+            client = Client(headers=self.headers)
+            for _ in range(rounds):
+                t0 = time.perf_counter()
+                with gate:
+                    response = client.post("/api/v1/talk/", self.post_body(),
+                                           content_type="application/json")
+                    first_word = None
+                    if response.streaming:
+                        for chunk in response.streaming_content:
+                            if first_word is None and chunk.startswith(b"event: token"):
+                                first_word = time.perf_counter() - t0
+                with lock:
+                    latencies.append(time.perf_counter() - t0)
+                    if first_word is not None:
+                        self.first_words.append(first_word)
+
+        threads = [threading.Thread(target=client_loop) for _ in range(level)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return latencies
+
+    async def run_async(self, level, rounds):
+        latencies = []
+
+        async def client_loop():
+            client = AsyncClient()
+            for _ in range(rounds):
+                t0 = time.perf_counter()
+                response = await client.post("/api/v1/talk/async/", self.post_body(),
+                                             content_type="application/json", headers=self.headers)
+                if response.streaming:
+                    async for chunk in response.streaming_content:
+                        if chunk.startswith(b"event: token"):
+                            self.first_words.append(time.perf_counter() - t0)
+                            break
+                    async for chunk in response.streaming_content:
+                        pass
+                latencies.append(time.perf_counter() - t0)
+
+        await asyncio.gather(*(client_loop() for _ in range(level)))
+        return latencies
+
+    def percentiles(self, samples):
+        if len(samples) > 1:
+            q = statistics.quantiles(samples, n=100)
+            return q[49], q[98]
+        return samples[0], samples[0]
+
+    def report(self, mode, level, latencies, elapsed):
+        p50, p99 = self.percentiles(latencies)
+        line = (f"{mode:<6} {level:>5} {len(latencies):>5} {p50 * 1000:>8.1f} {p99 * 1000:>8.1f} "
+                f"{len(latencies) / elapsed:>8.1f}")
+        if self.first_words:
+            p50, p99 = self.percentiles(self.first_words)
+            line += f" {p50 * 1000:>9.1f} {p99 * 1000:>9.1f}"
+        self.stdout.write(line)
@@ -0,0 +1,128 @@
+import json
+import os
+import statistics
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from django.core.management.base import BaseCommand
+from django.shortcuts import render
+from django.test import Client, RequestFactory
+from django.test.utils import setup_test_environment
+from chat import llm, weather, writebehind
+from chat.models import User, ChatHistory
+from chat.serializers import UserSerializer
+from .bench_talk import FakeCompletionServer, FakeCompletionHandler
+
+
+class FakeWeatherHandler(BaseHTTPRequestHandler):
+    '''
+    Answers any GET like OpenWeatherMap's /data/2.5/weather after `latency`.
+    '''
+    protocol_version = "HTTP/1.1"
+    latency = 0.3
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        body = json.dumps({"cod": 200, "main": {"temp": 68.4}, "name": "Springfield"}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serial_talk(request):
+    # The talk view before chat/jobs.py: every step in turn on the request thread
+    message = request.POST.get("message", "").strip()
+    lat = request.POST.get("my_lat").strip()
+    lon = request.POST.get("my_lon").strip()
+    user = request.user
+    writebehind.save_turn(user, message, True)
+    try:
+        current = weather.get_weather(lat, lon)
+        temp, city = current["temperature"], current["city"]
+    except (weather.WeatherError, ValueError):
+        temp = city = "unknown"
+    prompt = f"Act as a friendly companion for an elderly person. They said: '{message}'. It’s {temp}°F outside. Respond warmly and naturally."
+    ai_response = llm.get_client().chat.completions.create(
+        model="gpt-3.5-turbo",
+        messages=[{"role": "user", "content": prompt}]
+    ).choices[0].message.content
+    writebehind.save_turn(user, ai_response, False)
+    user.last_chat = message
+    user.save()
+    context = {"reply": ai_response, "user": UserSerializer(user).data, "message": message,
+               "temp": temp, "city": city}
+    return render(request, "chat/talk.html", context)
+
+
+class Command(BaseCommand):
+    help = "Time the talk page end to end: the old serial flow vs the current view (concurrent lookups, deferred writes)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=30)
+        parser.add_argument("--llm-latency", type=float, default=0.5,
+                            help="Fake completion time in seconds.")
+        parser.add_argument("--weather-latency", type=float, default=0.3,
+                            help="Fake weather API time in seconds.")
+
+    def handle(self, *args, **options):
+        FakeCompletionHandler.latency = options["llm_latency"]
+        FakeCompletionHandler.token_interval = 0
+        FakeWeatherHandler.latency = options["weather_latency"]
+        servers = [FakeCompletionServer(("127.0.0.1", 0), FakeCompletionHandler),
+                   FakeCompletionServer(("127.0.0.1", 0), FakeWeatherHandler)]
+        for server in servers:
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+        os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{servers[0].server_port}/v1"
+        weather.WEATHER_URL = f"http://127.0.0.1:{servers[1].server_port}/data/2.5/weather"
+
+        user, _ = User.objects.get_or_create(username="bench_user", defaults={"first_name": "Bench"})
+        setup_test_environment()  # lets the test client use the 'testserver' host
+        client = Client()
+        client.force_login(user)
+        factory = RequestFactory()
+
+        def via_view(body):
+            return client.post("/chat/", body)
+
+        def via_serial(body):
+            request = factory.post("/chat/", body)
+            request.user = user
+            return serial_talk(request)
+
+        self.stdout.write(f"{'flow':<8} {'weather':<7} {'reqs':>5} {'p50 ms':>8} {'p99 ms':>8}")
+        cell = iter(range(10 ** 6))
+        try:
+            for warm in (False, True):
+                for name, call in (("serial", via_serial), ("current", via_view)):
+                    latencies = []
+                    for _ in range(options["requests"]):
+                        # A new grid cell every time misses the weather cache
+                        lat = 10 if warm else 10 + next(cell) * 0.1
+                        body = {"message": "I think I'll water the plants today",
+                                "my_lat": str(lat), "my_lon": "20"}
+                        t0 = time.perf_counter()
+                        response = call(body)
+                        latencies.append(time.perf_counter() - t0)
+                        assert response.status_code == 200, response.status_code
+                    q = statistics.quantiles(latencies, n=100)
+                    self.stdout.write(f"{name:<8} {'cached' if warm else 'cold':<7} {len(latencies):>5} "
+                                      f"{q[49] * 1000:>8.1f} {q[98] * 1000:>8.1f}")
+            # Deferred saves land shortly after the last response
+            expected = options["requests"] * 8
+            deadline = time.monotonic() + 10
+            while True:
+                writebehind.flush()
+                saved = ChatHistory.objects.filter(user=user).count()
+                if saved >= expected or time.monotonic() > deadline:
+                    break
+                time.sleep(0.1)
+            self.stdout.write(f"turns saved: {saved} (expected {expected})")
+        finally:
+            for server in servers:
+                server.shutdown()
+            ChatHistory.objects.filter(user=user).delete()
@@ -0,0 +1,103 @@
+import os
+import shutil
+import statistics
+import tempfile
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client
+from django.test.utils import override_settings, setup_test_environment
+from rest_framework_simplejwt.tokens import RefreshToken
+from chat import tokens
+from chat.models import RevokedToken, User
+
+BACKENDS = {
+    "database": {'BACKEND': 'chat.tokens.DatabaseStore'},
+    "cache": {'BACKEND': 'chat.tokens.CacheStore', 'OPTIONS': {'alias': 'bench_tokens'}},
+}
+
+
+class Command(BaseCommand):
+    help = ("Refresh-token rotation through /api/v1/auth/token/refresh/ with an empty revocation "
+            "store and with --tokens revoked tokens in it; revocation lookups; purging expired ones.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--backend", choices=sorted(BACKENDS), default="database")
+        parser.add_argument("--tokens", type=int, default=1000000, help="Revoked tokens to preload.")
+        parser.add_argument("--expired", type=float, default=0.25,
+                            help="Fraction of the preloaded tokens already expired (purge fodder).")
+        parser.add_argument("--refreshes", type=int, default=2000)
+
+    def handle(self, *args, **options):
+        setup_test_environment()  # lets the test client use the 'testserver' host
+        location = tempfile.mkdtemp(prefix="chat_tokens_")
+        # A throwaway database, so the preloaded revocations never land in the real one
+        if connection.vendor == 'sqlite':
+            connection.settings_dict['TEST']['NAME'] = os.path.join(location, "bench.sqlite3")
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        caches = {'bench_tokens': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                                   'OPTIONS': {'MAX_ENTRIES': options["tokens"] * 2}}}
+        try:
+            with override_settings(CHAT_TOKENS={**BACKENDS[options["backend"]], 'PURGE_EVERY': 10 ** 9},
+                                   CACHES={**settings.CACHES, **caches}):
+                tokens._store = None
+                user = User.objects.create(username="bench_token_refresh")
+                self.refresh(user, "empty store", options["refreshes"])
+                started = time.perf_counter()
+                revoked = self.preload(options["tokens"], options["expired"])
+                self.stdout.write(f"preloaded {options['tokens']} revoked tokens in "
+                                  f"{time.perf_counter() - started:.1f}s")
+                self.refresh(user, f"{options['tokens']} revoked", options["refreshes"])
+                self.lookups(revoked)
+                started = time.perf_counter()
+                purged = tokens.purge()
+                self.stdout.write(f"purged {purged} expired in {time.perf_counter() - started:.2f}s")
+        finally:
+            tokens._store = None
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            shutil.rmtree(location, ignore_errors=True)
+
+    def preload(self, count, expired):
+        now = time.time()
+        store = tokens.store()
+        chunk = 50000
+        live = []
+        for start in range(0, count, chunk):
+            rows = [(os.urandom(16).hex(), now - 60 if (start + i) < count * expired else now + 30 * 86400)
+                    for i in range(min(chunk, count - start))]
+            if isinstance(store, tokens.DatabaseStore):
+                RevokedToken.objects.bulk_create(
+                    [RevokedToken(jti=tokens._digest(jti), expires=exp) for jti, exp in rows], batch_size=5000)
+            else:
+                store.cache.set_many({store._key(jti): 1 for jti, exp in rows if exp > now}, timeout=30 * 86400)
+            live += [jti for jti, exp in rows[-100:] if exp > now]
+        return live
+
+    def refresh(self, user, label, count):
+        client = Client()
+        token = str(RefreshToken.for_user(user))
+        first = token
+        samples = []
+        started = time.perf_counter()
+        for _ in range(count):
+            t0 = time.perf_counter()
+            response = client.post("/api/v1/auth/token/refresh/", {"refresh": token}, content_type="application/json")
+            samples.append((time.perf_counter() - t0) * 1000)
+            if response.status_code != 200:
+                raise RuntimeError(f"refresh failed: {response.status_code} {response.content!r}")
+            token = response.json()["refresh"]
+        elapsed = time.perf_counter() - started
+        replay = client.post("/api/v1/auth/token/refresh/", {"refresh": first}, content_type="application/json")
+        q = statistics.quantiles(samples, n=100)
+        self.stdout.write(f"refresh, {label:<18} {count / elapsed:>7.0f}/s  p50 {q[49]:.2f} ms  p99 {q[98]:.2f} ms  "
+                          f"(replayed old token: {replay.status_code})")
+
+    def lookups(self, revoked):
+        store = tokens.store()
+        for label, jtis in (("hit", revoked * (10000 // max(1, len(revoked)))),
+                            ("miss", [os.urandom(16).hex() for _ in range(10000)])):
+            started = time.perf_counter()
+            found = sum(store.is_revoked(jti) for jti in jtis)
+            self.stdout.write(f"is_revoked {label:<4} {(time.perf_counter() - started) / len(jtis) * 1e6:.1f} us "
+                              f"({found}/{len(jtis)} revoked)")
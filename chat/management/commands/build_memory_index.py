@@ -0,0 +1,23 @@
+import time
+from django.core.management.base import BaseCommand
+from chat.models import User
+from chat import memory
+
+
+class Command(BaseCommand):
+    help = ("(Re)build users' long-term memory indexes from their chat history. "
+            "Needed once for existing history, and after changing CHAT_MEMORY['EMBEDDER'].")
+
+    def add_arguments(self, parser):
+        parser.add_argument("usernames", nargs="*", help="Only these users (default: everyone).")
+
+    def handle(self, *args, **options):
+        users = User.objects.all()
+        if options["usernames"]:
+            users = users.filter(username__in=options["usernames"])
+        started = time.perf_counter()
+        total = 0
+        for user in users.iterator():
+            total += memory.rebuild(user.pk)
+        self.stdout.write(f"indexed {total} messages with {memory.get_embedder().name} "
+                          f"in {time.perf_counter() - started:.1f}s")
@@ -0,0 +1,52 @@
+import io
+import os
+import sys
+import time
+from django.core.management.base import BaseCommand, CommandError
+from chat import onboarding
+
+
+class Command(BaseCommand):
+    help = ("Create residents (a user and profile each) from a CSV file with a header row or a JSON "
+            "lines file. Rows that fail validation are listed and skipped; the rest are imported.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="File to import, or - for standard input.")
+        parser.add_argument("--format", choices=["csv", "jsonl"],
+                            help="Defaults to the file's extension (.csv, .jsonl or .json).")
+        parser.add_argument("--chunk", type=int, help="Rows validated and inserted together (CHAT_ONBOARDING['CHUNK']).")
+        parser.add_argument("--workers", type=int,
+                            help="Password-hashing processes (CHAT_ONBOARDING['WORKERS']); 1 hashes in-process.")
+        parser.add_argument("--region", help="Region for phone numbers without a country code, e.g. US.")
+        parser.add_argument("--dry-run", action="store_true", help="Validate only; create nothing.")
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        format = options["format"] or {".csv": "csv", ".jsonl": "jsonl", ".json": "jsonl"}.get(
+            os.path.splitext(path)[1].lower())
+        if format is None:
+            raise CommandError("Can't tell the format from the file name; pass --format.")
+        if path == "-":
+            stream = io.TextIOWrapper(sys.stdin.buffer, encoding="utf-8-sig", newline="")
+        else:
+            try:
+                stream = open(path, encoding="utf-8-sig", newline="")
+            except OSError as e:
+                raise CommandError(e)
+
+        started = time.perf_counter()
+        with stream:
+            result = onboarding.import_residents(
+                onboarding.read_rows(stream, format), region=options["region"], chunk=options["chunk"],
+                workers=options["workers"], dry_run=options["dry_run"],
+                on_chunk=self.progress if options["verbosity"] > 1 else None)
+
+        for error in result["errors"]:
+            messages = "; ".join(f"{field}: {' '.join(texts)}" for field, texts in error["errors"].items())
+            self.stdout.write(f"row {error['row']} ({error['username'] or '?'}): {messages}")
+        verb = "would create" if options["dry_run"] else "created"
+        self.stdout.write(f"{result['rows']} rows: {verb} {result['created']}, skipped {len(result['errors'])} "
+                          f"in {time.perf_counter() - started:.1f}s")
+
+    def progress(self, result):
+        self.stderr.write(f"{result['rows']} rows read, {result['created']} created")
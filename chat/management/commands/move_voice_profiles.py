@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from chat import blobs
+from chat.models import UserProfile
+
+
+class Command(BaseCommand):
+    help = ("Move inline UserProfile.voice_profile data into the blob store (CHAT_BLOBS), "
+            "and optionally delete blobs no profile points at.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch", type=int, default=100, help="Profiles moved per transaction.")
+        parser.add_argument("--prune", action="store_true",
+                            help="Afterwards delete blobs that no profile's voice_key refers to.")
+
+    def handle(self, *args, **options):
+        store = blobs.store()
+        inline = UserProfile.objects.filter(voice_profile__isnull=False).order_by('pk')
+        moved = 0
+        while True:
+            batch = list(inline.values_list('pk', 'voice_profile')[:options["batch"]])
+            if not batch:
+                break
+            with transaction.atomic():
+                for pk, data in batch:
+                    UserProfile.objects.filter(pk=pk).update(
+                        voice_key=store.put(bytes(data)) if data else None, voice_profile=None)
+            moved += len(batch)
+        self.stdout.write(f"moved {moved} voice profiles")
+
+        if options["prune"]:
+            # Listed first: a blob stored after this belongs to an upload still in progress
+            stored = list(store.keys())
+            used = set(UserProfile.objects.exclude(voice_key=None).values_list('voice_key', flat=True))
+            unused = [key for key in stored if key not in used]
+            for key in unused:
+                store.delete(key)
+            self.stdout.write(f"deleted {len(unused)} unreferenced blobs")
@@ -0,0 +1,294 @@
+import fcntl
+import os
+import re
+import zlib
+from contextlib import contextmanager
+from datetime import datetime, timezone as dt_timezone
+import numpy as np
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+from .models import ChatHistory
+from . import archive
+from . import jobs
+from . import metrics
+
+# Long-term memory: every ChatHistory turn is embedded and appended to a
+# per-user index of three flat files: <user_id>.vec (float32 rows),
+# <user_id>.meta (one META record per row) and <user_id>.txt (the messages,
+# UTF-8, which META points into). Recall is one matrix-vector product over a
+# memory-mapped .vec file, and the turns it finds are read back from .meta and
+# .txt, so it never touches the database or the archive. Each embedder gets
+# its own directory, so switching embedders never mixes vectors (run
+# build_memory_index after).
+DEFAULTS = {
+    'ENABLED': True,
+    'EMBEDDER': 'chat.memory.HashingEmbedder',
+    'OPTIONS': {'dim': 256},
+    'LOCATION': os.path.join(settings.BASE_DIR, '.chat_memory'),
+    'TOP_K': 3,
+    'MIN_SCORE': 0.2,    # cosine similarity
+}
+
+# id is -1 once the message has been deleted or edited (an edit appends a new row)
+META = np.dtype([('id', '<i8'), ('timestamp', '<f8'), ('is_user_message', 'u1'),
+                 ('offset', '<i8'), ('length', '<i4')])
+
+STOP_WORDS = frozenset(
+    "a about all am an and any are as at be been but by can could did do does for from get got "
+    "had has have he her him his how i if in is it its just me my no not of on or our she so "
+    "some that the their them then there they this to too us very was we were what when where "
+    "which who why will with would you your".split())
+
+_embedder = None
+
+
+def _options():
+    return {**DEFAULTS, **getattr(settings, 'CHAT_MEMORY', {})}
+
+
+def _stem(word):
+    for suffix in ("ing", "ed", "s"):
+        if word.endswith(suffix) and len(word) > len(suffix) + 2:
+            return word[:-len(suffix)]
+    return word
+
+
+class HashingEmbedder:
+    '''
+    Local and deterministic: signed feature hashing of words (crudely
+    stemmed, stop words dropped) and, at half weight, word pairs;
+    L2-normalized. Matches wording, not meaning.
+    '''
+
+    def __init__(self, dim=256):
+        self.dim = dim
+        self.name = f"hashing-{dim}"
+
+    def embed(self, texts):
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            words = [_stem(w) for w in re.findall(r"\w+", text.lower()) if w not in STOP_WORDS]
+            features = [(w, 1.0) for w in words] + [(f"{a} {b}", 0.5) for a, b in zip(words, words[1:])]
+            for feature, weight in features:
+                h = zlib.crc32(feature.encode())
+                vectors[row, h % self.dim] += weight if h & 0x80000000 else -weight
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.where(norms == 0, 1, norms)
+
+
+class OpenAIEmbedder:
+    '''
+    OpenAI embeddings, shortened to dim (text-embedding-3 models support it).
+    '''
+
+    def __init__(self, dim=256, model='text-embedding-3-small'):
+        self.dim = dim
+        self.model = model
+        self.name = f"{model}-{dim}"
+
+    def embed(self, texts):
+        from . import llm
+        data = llm.get_client().embeddings.create(
+            model=self.model, input=list(texts), dimensions=self.dim).data
+        return np.array([item.embedding for item in data], dtype=np.float32)
+
+
+def get_embedder():
+    global _embedder
+    if _embedder is None:
+        options = _options()
+        _embedder = import_string(options['EMBEDDER'])(**options['OPTIONS'])
+    return _embedder
+
+
+def _paths(user_id):
+    directory = os.path.join(str(_options()['LOCATION']), get_embedder().name)
+    os.makedirs(directory, exist_ok=True)
+    base = os.path.join(directory, str(user_id))
+    return base + ".vec", base + ".meta", base + ".txt"
+
+
+@contextmanager
+def _locked(user_id):
+    paths = _paths(user_id)
+    fd = os.open(paths[1], os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield paths
+    finally:
+        os.close(fd)  # releases the lock
+
+
+def _records(chats, offset):
+    texts = [chat.message.encode() for chat in chats]
+    meta = np.zeros(len(chats), dtype=META)
+    meta['id'] = [chat.pk for chat in chats]
+    meta['timestamp'] = [chat.timestamp.timestamp() for chat in chats]
+    meta['is_user_message'] = [chat.is_user_message for chat in chats]
+    meta['length'] = [len(text) for text in texts]
+    meta['offset'] = offset + np.concatenate(([0], np.cumsum(meta['length'][:-1])))
+    return meta, b"".join(texts)
+
+
+def add(chats):
+    '''
+    Embed ChatHistory rows (saved, so with ids) and append them to their
+    users' indexes.
+    '''
+    if not chats or not _options()['ENABLED']:
+        return
+    embedder = get_embedder()
+    vectors = embedder.embed([chat.message for chat in chats])
+    by_user = {}
+    for i, chat in enumerate(chats):
+        by_user.setdefault(chat.user_id, []).append(i)
+    for user_id, rows in by_user.items():
+        with _locked(user_id) as (vec_path, meta_path, txt_path):
+            # Drop a half-written tail left by a crash, so the files stay
+            # aligned; .meta is written last, so it decides what counts
+            count = os.path.getsize(meta_path) // META.itemsize
+            end = 0
+            if count:
+                last = np.fromfile(meta_path, dtype=META, offset=(count - 1) * META.itemsize)[0]
+                end = int(last['offset']) + int(last['length'])
+            meta, text = _records([chats[i] for i in rows], end)
+            with open(txt_path, 'ab') as f:
+                f.truncate(end)
+                f.write(text)
+            with open(vec_path, 'ab') as f:
+                f.truncate(count * embedder.dim * 4)
+                f.write(vectors[rows].tobytes())
+            with open(meta_path, 'ab') as f:
+                f.truncate(count * META.itemsize)
+                f.write(meta.tobytes())
+
+
+def forget(user_id, ids):
+    '''
+    Stop recalling these messages (deleted, or edited and re-added).
+    '''
+    if not _options()['ENABLED'] or not os.path.exists(_paths(user_id)[1]):
+        return
+    with _locked(user_id) as (vec_path, meta_path, txt_path):
+        if not os.path.getsize(meta_path):
+            return
+        meta = np.memmap(meta_path, dtype=META, mode='r+')
+        meta['id'][np.isin(meta['id'], ids)] = -1
+        meta.flush()
+
+
+def _load(user_id):
+    vec_path, meta_path, txt_path = _paths(user_id)
+    try:
+        meta = np.memmap(meta_path, dtype=META, mode='r')
+        vectors = np.memmap(vec_path, dtype=np.float32, mode='r').reshape(-1, get_embedder().dim)
+    except (FileNotFoundError, ValueError):  # ValueError: empty file
+        return None, None
+    count = min(len(meta), len(vectors))
+    return vectors[:count], meta[:count]
+
+
+@metrics.timed("memory_recall")
+def recall(user, text, exclude=(), k=None):
+    '''
+    Up to k past turns most similar to text, best first, skipping messages in
+    exclude (e.g. the turns already in the prompt). Unsaved ChatHistory
+    objects with a .score (cosine similarity).
+    '''
+    options = _options()
+    if not options['ENABLED']:
+        return []
+    vectors, meta = _load(user.pk)
+    if meta is None or not len(meta):
+        return []
+    k = k or options['TOP_K']
+    query = get_embedder().embed([text])[0]
+    scores = vectors @ query
+    # Extra candidates, since some may be excluded or forgotten
+    wanted = min(len(scores), k + len(exclude) + 2)
+    top = np.argpartition(-scores, wanted - 1)[:wanted]
+    top = top[np.argsort(-scores[top])]
+    top = top[(scores[top] >= options['MIN_SCORE']) & (meta['id'][top] >= 0)]
+
+    exclude = set(exclude)
+    results = []
+    with open(_paths(user.pk)[2], 'rb') as f:
+        for i in top:
+            record = meta[i]
+            f.seek(int(record['offset']))
+            message = f.read(int(record['length'])).decode()
+            if message in exclude:
+                continue
+            chat = ChatHistory(id=int(record['id']), user_id=user.pk, message=message,
+                               is_user_message=bool(record['is_user_message']),
+                               timestamp=datetime.fromtimestamp(float(record['timestamp']), tz=dt_timezone.utc))
+            chat.score = float(scores[i])
+            results.append(chat)
+            if len(results) == k:
+                break
+    return results
+
+
+def rebuild(user_id, batch=512):
+    '''
+    Re-embed all of a user's turns, archived ones included. Returns the count.
+    '''
+    embedder = get_embedder()
+    chats = list(reversed(archive.older(user_id, limit=None))) + list(
+        ChatHistory.objects.filter(user_id=user_id).order_by('timestamp', 'id'))
+    with _locked(user_id) as (vec_path, meta_path, txt_path):
+        meta, text = _records(chats, 0) if chats else (np.zeros(0, dtype=META), b"")
+        with open(txt_path, 'wb') as f:
+            f.write(text)
+        with open(vec_path, 'wb') as f:
+            for start in range(0, len(chats), batch):
+                f.write(embedder.embed([c.message for c in chats[start:start + batch]]).tobytes())
+        with open(meta_path, 'r+b') as f:
+            f.truncate(0)
+            f.write(meta.tobytes())
+    try:  # ids-only index from before .meta
+        os.remove(meta_path[:-len(".meta")] + ".ids")
+    except FileNotFoundError:
+        pass
+    return len(chats)
+
+
+def _task_records(chats):
+    return [[chat.pk, chat.user_id, chat.timestamp.isoformat(), chat.is_user_message, chat.message]
+            for chat in chats]
+
+
+@receiver(post_save, sender=ChatHistory)
+def _chat_saved(sender, instance, created, **kwargs):
+    # Embedding is slow (an API call with OpenAIEmbedder), so it runs as a
+    # deferred job. bulk_create sends no post_save; writebehind.flush calls
+    # add() itself, from its own thread.
+    if not _options()['ENABLED']:
+        return
+    records = _task_records([instance])
+    transaction.on_commit(lambda: jobs.defer('chat.tasks.index_memory', records, not created))
+
+
+@receiver(post_delete, sender=ChatHistory)
+def _chat_deleted(sender, instance, **kwargs):
+    if not _options()['ENABLED']:
+        return
+    user_id, pk = instance.user_id, instance.pk
+    transaction.on_commit(lambda: jobs.defer('chat.tasks.forget_memory', user_id, [pk]))
+
+
+@receiver(post_delete, sender=User)
+def _drop_user_memory(sender, instance, **kwargs):
+    user_id = instance.pk
+
+    def drop():
+        for path in _paths(user_id):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+    transaction.on_commit(drop)
@@ -0,0 +1,149 @@
+import re
+from collections import namedtuple
+
+# One compiled tokenizer pass per message, then one hash lookup per word (and
+# word pair) against the lexicon: a word-level Aho-Corasick, so "do" never
+# matches inside "don't". (One big alternation regex over the phrases was
+# tried; CPython's re scans it ~3x slower than this.)
+QUESTION_WORDS = frozenset(("what", "when", "where", "how", "why", "who", "which", "can", "could",
+                            "do", "does", "did", "is", "are", "will", "would", "should"))
+
+LEXICON = {
+    "intent:greeting": ["hello", "hi", "hey", "good morning", "good afternoon", "good evening",
+                        "morning"],
+    "intent:checkin": ["checking in", "just checking", "i'm back", "i'm home", "it's me", "back home"],
+    "intent:farewell": ["bye", "goodbye", "good night", "see you", "talk later"],
+    "intent:gratitude": ["thanks", "thank you", "appreciate it"],
+    "intent:distress": ["help", "emergency", "ambulance", "911", "fell", "fallen", "hurt",
+                        "pain", "dizzy", "can't breathe", "chest pain"],
+    "intent:health": ["medicine", "medication", "pills", "doctor", "appointment",
+                      "blood pressure", "sugar", "nurse"],
+    "intent:weather": ["weather", "rain", "raining", "snow", "snowing", "sunny", "cold", "hot",
+                       "temperature"],
+    "intent:loneliness": ["lonely", "alone", "miss you", "nobody", "no one", "bored"],
+    "sentiment:+": ["happy", "glad", "good", "great", "wonderful", "lovely", "love", "nice",
+                    "enjoy", "enjoyed", "fun", "better", "excited", "fine", "well"],
+    "sentiment:-": ["sad", "lonely", "bored", "tired", "worried", "scared", "afraid", "angry",
+                    "upset", "bad", "awful", "terrible", "hurt", "pain", "sick", "miss", "miss you",
+                    "worse", "alone"],
+    "negation": ["not", "no", "never", "don't", "doesn't", "didn't", "isn't", "wasn't",
+                 "can't", "won't", "hardly"],
+}
+
+# A negation flips sentiment words up to this many words after it, within
+# the same clause
+NEGATION_REACH = 3
+
+Analysis = namedtuple("Analysis", ["is_question", "starts_with_question", "intents", "sentiment"])
+
+# phrase -> (is negation, positive, negative, intents); phrases are one or two words
+_ENTRIES = {}
+for _label, _phrases in LEXICON.items():
+    for _phrase in _phrases:
+        _negation, _positive, _negative, _intents = _ENTRIES.get(_phrase, (False, 0, 0, frozenset()))
+        if _label == "negation":
+            _negation = True
+        elif _label == "sentiment:+":
+            _positive += 1
+        elif _label == "sentiment:-":
+            _negative += 1
+        else:
+            _intents = _intents | {_label.split(":", 1)[1]}
+        _ENTRIES[_phrase] = (_negation, _positive, _negative, _intents)
+assert all(len(phrase.split()) <= 2 for phrase in _ENTRIES)
+
+# Words (with contractions), question marks, clause punctuation, and the
+# \x00 that separates messages in classify_batch
+_TOKEN = re.compile(r"[a-z0-9]+(?:'[a-z]+)*|[?,.;:!\x00]")
+_CLAUSE_END = frozenset(",.;:!?")
+
+
+def _analyze_tokens(tokens, start, end):
+    opener = start < end and tokens[start] in QUESTION_WORDS
+    question = opener
+    intents = set()
+    positive = negative = 0
+    negation = None
+    i = start
+    while i < end:
+        token = tokens[i]
+        if token in _CLAUSE_END:
+            question = question or token == "?"
+            negation = None
+            i += 1
+            continue
+        entry = None
+        if i + 1 < end:  # two-word phrases win over their first word
+            entry = _ENTRIES.get(token + " " + tokens[i + 1])
+            if entry:
+                i += 1
+        if entry is None:
+            entry = _ENTRIES.get(token)
+        if entry:
+            is_negation, pos, neg, found = entry
+            if is_negation:
+                negation = i
+            elif pos or neg:
+                if negation is not None and i - negation <= NEGATION_REACH:
+                    pos, neg = neg, pos
+                positive += pos
+                negative += neg
+            if found:
+                intents.update(found)
+        i += 1
+    total = positive + negative
+    return Analysis(
+        is_question=question,
+        starts_with_question=opener,
+        intents=tuple(sorted(intents)),
+        sentiment=(positive - negative) / total if total else 0.0,
+    )
+
+
+def _tokens(text):
+    return _TOKEN.findall(text.lower().replace("’", "'"))
+
+
+def analyze(message):
+    '''
+    Question, intent and sentiment signals for one message. sentiment is in
+    [-1, 1]; intents are names like "greeting" or "distress".
+    '''
+    tokens = _tokens(message)
+    return _analyze_tokens(tokens, 0, len(tokens))
+
+
+def classify_batch(messages):
+    '''
+    analyze() for many messages (e.g. a ChatHistory values_list), tokenized
+    in one regex pass over the joined text. Returns a list in the same order.
+    '''
+    messages = [m.replace("\x00", " ") for m in messages]
+    if not messages:
+        return []
+    tokens = _tokens("\x00".join(messages))
+    tokens.append("\x00")
+    results = []
+    start = 0
+    for i, token in enumerate(tokens):
+        if token == "\x00":
+            results.append(_analyze_tokens(tokens, start, i))
+            start = i + 1
+    return results
+
+
+def starts_with_question_word(message):
+    '''
+    True if the message opens with a question word ("how are you"), after
+    any leading quotes, brackets or ellipsis, as analyze() reads it.
+    '''
+    match = _TOKEN.search(message.lower().replace("’", "'"))
+    return bool(match) and match.group() in QUESTION_WORDS
+
+
+def is_question(message):
+    '''
+    True for a message that asks something: a question mark, or a question
+    word up front. Same answer as analyze(message).is_question, cheaper.
+    '''
+    return "?" in message or starts_with_question_word(message)
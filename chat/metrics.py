@@ -0,0 +1,284 @@
+import atexit
+import bisect
+import contextlib
+import functools
+import glob
+import hmac
+import json
+import logging
+import os
+import threading
+import time
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connections
+from django.http import HttpResponse, HttpResponseForbidden
+
+logger = logging.getLogger(__name__)
+
+# Request-level instrumentation, exported in the Prometheus text format at
+# /metrics. Recording only touches this process's memory; a background
+# thread writes the process's totals to LOCATION/<pid>.json every
+# FLUSH_INTERVAL seconds, and /metrics adds up every worker's file (so clear
+# LOCATION when deploying). Counters the app already keeps in the shared
+# cache (weather, replies, breakers) are read at scrape time.
+DEFAULTS = {
+    'ENABLED': True,
+    'LOCATION': os.path.join(settings.BASE_DIR, '.metrics'),
+    'FLUSH_INTERVAL': 5,  # seconds
+    'BUCKETS': (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+    # Staff users may always look. Scrapers send "Authorization: Bearer <TOKEN>"
+    # or, opt-in, come from ALLOWED_IPS: REMOTE_ADDR is the proxy's address
+    # behind a reverse proxy, so only list addresses nothing else shares.
+    'TOKEN': None,
+    'ALLOWED_IPS': [],
+}
+
+METRICS = {
+    'companion_http_request_duration_seconds': ('histogram', 'Time to a response, by view.'),
+    'companion_db_queries_total': ('counter', 'Database queries made while serving requests, by view.'),
+    'companion_db_query_seconds_total': ('counter', 'Time spent in database queries, by view.'),
+    'companion_stage_duration_seconds': ('histogram', 'Time spent in instrumented steps (@timed).'),
+    'companion_llm_request_duration_seconds': ('histogram', 'OpenAI HTTP time to first byte, by status.'),
+    'companion_llm_tokens_total': ('counter', 'OpenAI tokens used, by kind.'),
+    'companion_cache_requests_total': ('counter', 'Cache lookups, by cache and result.'),
+    'companion_breaker_state': ('gauge', 'Circuit breaker state: 0 closed, 1 half-open, 2 open.'),
+    'companion_breaker_events_total': ('counter', 'Circuit breaker calls, failures, rejections and openings.'),
+}
+BREAKER_STATES = {"closed": 0, "half-open": 1, "open": 2}
+
+_lock = threading.Lock()
+_counters = {}    # (name, labels) -> value
+_histograms = {}  # (name, labels) -> [count per bucket..., +Inf count, sum]
+_flusher_pid = None
+
+
+def _options():
+    return {**DEFAULTS, **getattr(settings, 'CHAT_METRICS', {})}
+
+
+def _start_flusher(options):
+    # Called with _lock held. Re-checks the pid so forked workers get their own thread.
+    global _flusher_pid
+    if _flusher_pid != os.getpid():
+        _flusher_pid = os.getpid()
+        threading.Thread(target=_run_flusher, args=(options,), daemon=True).start()
+
+
+def inc(name, amount=1, **labels):
+    options = _options()
+    if not options['ENABLED']:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _start_flusher(options)
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+def observe(name, value, **labels):
+    options = _options()
+    if not options['ENABLED']:
+        return
+    buckets = options['BUCKETS']
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _start_flusher(options)
+        series = _histograms.get(key)
+        if series is None:
+            series = _histograms[key] = [0] * (len(buckets) + 1) + [0.0]
+        series[bisect.bisect_left(buckets, value)] += 1
+        series[-1] += value
+
+
+def timed(stage):
+    '''
+    Decorator: time each call into companion_stage_duration_seconds{stage}.
+    '''
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapped(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                observe('companion_stage_duration_seconds', time.perf_counter() - start, stage=stage)
+        return wrapped
+    return decorator
+
+
+def _snapshot():
+    with _lock:
+        return {
+            "counters": [[name, labels, value] for (name, labels), value in _counters.items()],
+            "histograms": [[name, labels, series[:]] for (name, labels), series in _histograms.items()],
+        }
+
+
+def flush():
+    options = _options()
+    os.makedirs(options['LOCATION'], exist_ok=True)
+    path = os.path.join(str(options['LOCATION']), f"{os.getpid()}.json")
+    with open(path + ".tmp", "w") as f:
+        json.dump(_snapshot(), f)
+    os.replace(path + ".tmp", path)
+
+
+def _run_flusher(options):
+    atexit.register(flush)
+    while True:
+        time.sleep(options['FLUSH_INTERVAL'])
+        try:
+            flush()
+        except OSError:
+            logger.exception("Writing metrics failed")
+
+
+def collect():
+    '''
+    ({(name, labels): value}, {(name, labels): histogram}) summed over every
+    worker's latest totals, this process's being live.
+    '''
+    counters, histograms = {}, {}
+    snapshots = []
+    for path in glob.glob(os.path.join(str(_options()['LOCATION']), "*.json")):
+        if os.path.basename(path) == f"{os.getpid()}.json":
+            continue
+        try:
+            with open(path) as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError):  # a worker is replacing it right now
+            continue
+    snapshots.append(_snapshot())
+    for snapshot in snapshots:
+        for name, labels, value in snapshot["counters"]:
+            key = (name, tuple(map(tuple, labels)))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, series in snapshot["histograms"]:
+            key = (name, tuple(map(tuple, labels)))
+            total = histograms.get(key)
+            histograms[key] = series[:] if total is None or len(total) != len(series) else [
+                a + b for a, b in zip(total, series)]
+    return counters, histograms
+
+
+def _shared_counters():
+    # Counters other modules keep in the shared cache
+    from . import breaker, replies, weather
+    counters = {}
+    for result, value in weather.stats().items():
+        counters[('companion_cache_requests_total', (('cache', 'weather'), ('result', result)))] = value
+    for result, value in replies.stats().items():
+        if result != "hit_rate":
+            counters[('companion_cache_requests_total', (('cache', 'replies'), ('result', result)))] = value
+    for upstream, state in breaker.stats().items():
+        counters[('companion_breaker_state', (('upstream', upstream),))] = BREAKER_STATES[state["state"]]
+        for event in breaker.STATS:
+            counters[('companion_breaker_events_total', (('event', event), ('upstream', upstream)))] = state[event]
+    return counters
+
+
+def _labels(labels, extra=()):
+    pairs = [*labels, *extra]
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+def render():
+    '''
+    Every metric in the Prometheus text exposition format.
+    '''
+    counters, histograms = collect()
+    counters.update(_shared_counters())
+    buckets = [str(b) for b in _options()['BUCKETS']] + ["+Inf"]
+    lines = []
+    for name, (kind, help_text) in METRICS.items():
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+        if kind == "histogram":
+            for (metric, labels), series in sorted(histograms.items()):
+                if metric != name or len(series) != len(buckets) + 1:
+                    continue
+                cumulative = 0
+                for le, count in zip(buckets, series):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_labels(labels, [('le', le)])} {cumulative}")
+                lines.append(f"{name}_sum{_labels(labels)} {series[-1]}")
+                lines.append(f"{name}_count{_labels(labels)} {cumulative}")
+        else:
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append(f"{name}{_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def _allowed(request, options):
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_staff:
+        return True
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    if options['TOKEN'] and scheme.lower() == 'bearer' and hmac.compare_digest(
+            token.strip().encode(), str(options['TOKEN']).encode()):
+        return True
+    return request.META.get('REMOTE_ADDR') in options['ALLOWED_IPS']
+
+
+def metrics_view(request):
+    options = _options()
+    if not _allowed(request, options):
+        return HttpResponseForbidden()
+    return HttpResponse(render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+class MetricsMiddleware:
+    '''
+    Records each request's latency and database queries under its view name.
+    Streaming responses are timed to their first byte. Queries made in
+    other threads (sync_to_async, the job pool) aren't attributed.
+    '''
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not _options()['ENABLED']:
+            return self.get_response(request)
+        queries = [0, 0.0]
+
+        def count_query(execute, sql, params, many, context):
+            start = time.perf_counter()
+            try:
+                return execute(sql, params, many, context)
+            finally:
+                queries[0] += 1
+                queries[1] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        with contextlib.ExitStack() as stack:
+            for alias in connections:
+                stack.enter_context(connections[alias].execute_wrapper(count_query))
+            response = self.get_response(request)
+        self._record(request, response, time.perf_counter() - start, *queries)
+        return response
+
+    async def __acall__(self, request):
+        start = time.perf_counter()
+        response = await self.get_response(request)
+        if _options()['ENABLED']:
+            self._record(request, response, time.perf_counter() - start, 0, 0.0)
+        return response
+
+    def _record(self, request, response, elapsed, queries, query_time):
+        match = request.resolver_match
+        view = match.view_name if match else "unmatched"
+        observe('companion_http_request_duration_seconds', elapsed,
+                view=view, method=request.method, status=str(response.status_code))
+        if queries:
+            inc('companion_db_queries_total', queries, view=view)
+            inc('companion_db_query_seconds_total', query_time, view=view)
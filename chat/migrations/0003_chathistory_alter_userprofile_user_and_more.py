@@ -0,0 +1,121 @@
+# Generated by Django 5.2 on 2026-10-18 03:16
+#
+# Catches the migrations up with the models as they stood at the baseline:
+# ChatHistory, the profile fields added since 0002, and UserProfile.user
+# pointing at auth.User instead of the old chat.User, which is dropped.
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+def check_no_legacy_users(apps, schema_editor):
+    # Profiles are repointed from chat_user to auth_user ids as they are. That
+    # is only safe while chat_user is empty; refuse rather than orphan them.
+    legacy = apps.get_model('chat', 'User').objects.using(schema_editor.connection.alias)
+    count = legacy.count()
+    if count:
+        raise RuntimeError(
+            f"chat_user has {count} rows. This migration moves UserProfile.user to auth.User and "
+            "drops chat_user: create an auth_user for each of them, point chat_userprofile.user_id "
+            "at it, empty chat_user, then migrate again.")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0002_alter_userprofile_city_alter_userprofile_state_and_more'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunPython(check_no_legacy_users, migrations.RunPython.noop),
+        migrations.CreateModel(
+            name='ChatHistory',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('message', models.TextField(max_length=5001)),
+                ('timestamp', models.DateTimeField(auto_now_add=True)),
+                ('is_user_message', models.BooleanField()),
+            ],
+            options={
+                'ordering': ['timestamp'],
+            },
+        ),
+        migrations.AlterField(
+            model_name='userprofile',
+            name='user',
+            field=models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='profile', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterModelOptions(
+            name='userprofile',
+            options={'verbose_name': 'User Profile', 'verbose_name_plural': 'User Profiles'},
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='account_create_date',
+            field=models.DateTimeField(auto_now_add=True, default=django.utils.timezone.now, help_text='Date and time when the account was created.'),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='account_status',
+            field=models.CharField(choices=[('A', 'Active'), ('S', 'Suspended')], default='A', help_text='Status of the user account.', max_length=1),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='details',
+            field=models.TextField(blank=True, max_length=1000),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='preferred_name',
+            field=models.CharField(blank=True, max_length=100),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='security_answer_hash',
+            field=models.CharField(blank=True, max_length=128, null=True),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='subscription_expiry',
+            field=models.DateTimeField(blank=True, help_text='Date when the subscription expires.', null=True),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='voice_profile',
+            field=models.BinaryField(blank=True, help_text='Voice recognition data for user identification.', null=True),
+        ),
+        migrations.AlterField(
+            model_name='userprofile',
+            name='city',
+            field=models.CharField(blank=True, default='Boston', max_length=100, null=True),
+        ),
+        migrations.AlterField(
+            model_name='userprofile',
+            name='gender',
+            field=models.CharField(blank=True, choices=[('', 'Select Gender'), ('Male', 'Male'), ('Female', 'Female'), ('Other', 'Other')], max_length=6, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='userprofile',
+            index=models.Index(fields=['account_status'], name='chat_userpr_account_6f20b1_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userprofile',
+            index=models.Index(fields=['account_create_date'], name='chat_userpr_account_c65e00_idx'),
+        ),
+        migrations.AddField(
+            model_name='chathistory',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chat_history', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.DeleteModel(
+            name='User',
+        ),
+        migrations.AddIndex(
+            model_name='chathistory',
+            index=models.Index(fields=['user', 'timestamp'], name='chat_chathi_user_id_606a80_idx'),
+        ),
+    ]
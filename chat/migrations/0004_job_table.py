@@ -0,0 +1,36 @@
+from django.db import migrations
+
+# chat.jobs.DatabaseQueue's table. Raw SQL rather than a model: the queue
+# claims jobs with UPDATE ... RETURNING, which the ORM can't express.
+SCHEMA = {
+    'sqlite': """CREATE TABLE IF NOT EXISTS chat_job (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, task TEXT NOT NULL, args TEXT NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0, run_after REAL NOT NULL)""",
+    'postgresql': """CREATE TABLE IF NOT EXISTS chat_job (
+        id BIGSERIAL PRIMARY KEY, task TEXT NOT NULL, args TEXT NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0, run_after DOUBLE PRECISION NOT NULL)""",
+}
+
+
+def create_table(apps, schema_editor):
+    # IF NOT EXISTS: databases set up before this migration got the table
+    # from a post_migrate hook
+    sql = SCHEMA.get(schema_editor.connection.vendor)
+    if sql:
+        schema_editor.execute(sql)
+
+
+def drop_table(apps, schema_editor):
+    if schema_editor.connection.vendor in SCHEMA:
+        schema_editor.execute("DROP TABLE IF EXISTS chat_job")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_chathistory_alter_userprofile_user_and_more'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_table, drop_table),
+    ]
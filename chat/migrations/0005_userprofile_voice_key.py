@@ -0,0 +1,27 @@
+# Generated by Django 5.2 on 2026-10-18 03:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_job_table'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='userprofile',
+            options={'base_manager_name': 'objects', 'verbose_name': 'User Profile', 'verbose_name_plural': 'User Profiles'},
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='voice_key',
+            field=models.CharField(blank=True, editable=False, help_text='Blob store key (SHA-256) of the voice recognition data for user identification.', max_length=64, null=True),
+        ),
+        migrations.AlterField(
+            model_name='userprofile',
+            name='voice_profile',
+            field=models.BinaryField(blank=True, help_text='Legacy inline voice data; new data goes to the blob store (see voice_key, `manage.py move_voice_profiles`).', null=True),
+        ),
+    ]
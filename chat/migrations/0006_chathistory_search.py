@@ -0,0 +1,84 @@
+from django.db import migrations
+
+# chat.search's indexes over ChatHistory.message.
+#
+# SQLite: an FTS5 index. It is external-content (reads text back through a
+# view instead of storing a second copy) and also indexes a "u<user_id>" token
+# so per-user queries intersect posting lists instead of filtering every
+# match. Triggers keep it in sync for every write path, including bulk_create
+# and raw SQL.
+#
+# PostgreSQL: an expression GIN index matching the SearchVector in
+# chat/search.py, maintained by Postgres itself.
+#
+# IF NOT EXISTS throughout: databases set up before this migration got the
+# same objects from a post_migrate hook.
+SCHEMA = {
+    'sqlite': [
+        """CREATE VIEW IF NOT EXISTS chat_chathistory_fts_src AS
+            SELECT id, message, 'u' || user_id AS user_key FROM chat_chathistory""",
+        """CREATE VIRTUAL TABLE IF NOT EXISTS chat_chathistory_fts USING fts5(
+            message, user_key, content='chat_chathistory_fts_src', content_rowid='id',
+            tokenize='porter unicode61')""",
+        """CREATE TRIGGER IF NOT EXISTS chat_chathistory_fts_ai AFTER INSERT ON chat_chathistory BEGIN
+            INSERT INTO chat_chathistory_fts(rowid, message, user_key)
+                VALUES (new.id, new.message, 'u' || new.user_id);
+            END""",
+        """CREATE TRIGGER IF NOT EXISTS chat_chathistory_fts_ad AFTER DELETE ON chat_chathistory BEGIN
+            INSERT INTO chat_chathistory_fts(chat_chathistory_fts, rowid, message, user_key)
+                VALUES ('delete', old.id, old.message, 'u' || old.user_id);
+            END""",
+        """CREATE TRIGGER IF NOT EXISTS chat_chathistory_fts_au
+            AFTER UPDATE OF message, user_id ON chat_chathistory BEGIN
+            INSERT INTO chat_chathistory_fts(chat_chathistory_fts, rowid, message, user_key)
+                VALUES ('delete', old.id, old.message, 'u' || old.user_id);
+            INSERT INTO chat_chathistory_fts(rowid, message, user_key)
+                VALUES (new.id, new.message, 'u' || new.user_id);
+            END""",
+    ],
+    'postgresql': [
+        """CREATE INDEX IF NOT EXISTS chat_chathistory_message_tsv ON chat_chathistory
+            USING GIN (to_tsvector('english'::regconfig, COALESCE(message, '')))""",
+    ],
+}
+
+REVERSE = {
+    'sqlite': [
+        "DROP TRIGGER IF EXISTS chat_chathistory_fts_au",
+        "DROP TRIGGER IF EXISTS chat_chathistory_fts_ad",
+        "DROP TRIGGER IF EXISTS chat_chathistory_fts_ai",
+        "DROP TABLE IF EXISTS chat_chathistory_fts",
+        "DROP VIEW IF EXISTS chat_chathistory_fts_src",
+    ],
+    'postgresql': [
+        "DROP INDEX IF EXISTS chat_chathistory_message_tsv",
+    ],
+}
+
+
+def create_index(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            existed = 'chat_chathistory_fts' in connection.introspection.table_names(cursor)
+    for statement in SCHEMA.get(connection.vendor, []):
+        schema_editor.execute(statement)
+    if connection.vendor == 'sqlite' and not existed:
+        # Backfill from the rows already in the table
+        schema_editor.execute("INSERT INTO chat_chathistory_fts(chat_chathistory_fts) VALUES ('rebuild')")
+
+
+def drop_index(apps, schema_editor):
+    for statement in REVERSE.get(schema_editor.connection.vendor, []):
+        schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_userprofile_voice_key'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
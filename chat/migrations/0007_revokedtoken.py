@@ -0,0 +1,43 @@
+from django.db import migrations, models
+
+# chat.tokens.DatabaseStore's table. Databases set up before this migration
+# already have it, created by a post_migrate hook with the same columns and an
+# expires index, so the model is only created where the table is missing.
+
+
+def create_table(apps, schema_editor):
+    connection = schema_editor.connection
+    with connection.cursor() as cursor:
+        if 'chat_revoked_token' in connection.introspection.table_names(cursor):
+            return
+    schema_editor.create_model(apps.get_model('chat', 'RevokedToken'))
+
+
+def drop_table(apps, schema_editor):
+    schema_editor.delete_model(apps.get_model('chat', 'RevokedToken'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0006_chathistory_search'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.CreateModel(
+                    name='RevokedToken',
+                    fields=[
+                        ('jti', models.BinaryField(max_length=16, primary_key=True, serialize=False)),
+                        ('expires', models.FloatField(db_index=True)),
+                    ],
+                    options={
+                        'db_table': 'chat_revoked_token',
+                    },
+                ),
+            ],
+        ),
+        # After the state change, so the model is in the apps it's given
+        migrations.RunPython(create_table, drop_table),
+    ]
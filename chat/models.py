@@ -3,6 +3,13 @@ from django.contrib.auth.models import User
 from django.utils import timezone
 from django.core.exceptions import ValidationError
 import phonenumbers
+from . import blobs
+
+
+class UserProfileManager(models.Manager):
+    def get_queryset(self):
+        # Legacy inline voice data stays on disk unless asked for by name
+        return super().get_queryset().defer('voice_profile')
 
 
 class UserProfile(models.Model):
@@ -63,10 +70,21 @@ class UserProfile(models.Model):
     voice_profile = models.BinaryField(
         null=True,
         blank=True,
-        help_text="Voice recognition data for user identification."
+        help_text="Legacy inline voice data; new data goes to the blob store "
+                  "(see voice_key, `manage.py move_voice_profiles`)."
+    )
+    voice_key = models.CharField(
+        max_length=64,
+        blank=True,
+        null=True,
+        editable=False,
+        help_text="Blob store key (SHA-256) of the voice recognition data for user identification."
     )
 
+    objects = UserProfileManager()
+
     class Meta:
+        base_manager_name = 'objects'  # user.profile defers voice_profile too
         indexes = [
             models.Index(fields=['account_status']),
             models.Index(fields=['account_create_date']),
@@ -97,6 +115,35 @@ class UserProfile(models.Model):
         self.clean()  # Run validation
         super().save(*args, **kwargs)
 
+    def set_voice(self, data):
+        '''
+        Store data (bytes, or None to clear) in the blob store and point
+        voice_key at it. Call save() afterwards.
+        '''
+        self.voice_key = blobs.store().put(bytes(data)) if data else None
+        self.voice_profile = None
+
+    def voice_size(self):
+        '''
+        Bytes of voice data, or None if there is none (or its blob is missing).
+        '''
+        if self.voice_key:
+            return blobs.store().size(self.voice_key)
+        if self.voice_profile is not None:
+            return len(self.voice_profile)
+        return None
+
+    def read_voice(self, start=0, end=None):
+        '''
+        Voice data bytes start..end (end exclusive), or None if there is none.
+        Falls back to a legacy inline voice_profile (one extra query).
+        '''
+        if self.voice_key:
+            return blobs.store().read(self.voice_key, start, end)
+        if self.voice_profile is not None:
+            return bytes(self.voice_profile)[start:end]
+        return None
+
 
 class ChatHistory(models.Model):
     user = models.ForeignKey(
@@ -120,3 +167,18 @@ class ChatHistory(models.Model):
     def clean(self):
         if not self.message.strip():
             raise ValidationError("Message cannot be empty.")
+
+
+class RevokedToken(models.Model):
+    '''
+    A refresh token revoked by rotation or the revoke endpoint, kept until it
+    would have expired anyway (chat.tokens.DatabaseStore).
+    '''
+    jti = models.BinaryField(primary_key=True, max_length=16)  # blake2b digest of the token's jti
+    expires = models.FloatField(db_index=True)  # Unix time
+
+    class Meta:
+        db_table = "chat_revoked_token"
+
+    def __str__(self):
+        return self.jti.hex()
@@ -0,0 +1,231 @@
+import csv
+import functools
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+import django
+import phonenumbers
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, transaction
+from .models import User, UserProfile
+
+# Bulk resident onboarding from a facility's spreadsheet (CSV with a header
+# row, or JSON lines). Rows are read and handled CHUNK at a time: validated
+# together (one username query per chunk, phone numbers parsed once per
+# distinct number), passwords hashed in a process pool, users and profiles
+# inserted with bulk_create. A bad row is reported and skipped; the rest go
+# in. Unknown columns are ignored.
+DEFAULTS = {
+    'CHUNK': 500,
+    'WORKERS': os.cpu_count(),  # password-hashing processes; 1 hashes in-process
+    'START_METHOD': 'spawn',    # fresh interpreters: nothing inherited from the caller's threads
+    'DEFAULT_REGION': 'US',     # for phone numbers written without +<country code>
+}
+
+USER_FIELDS = ('username', 'password', 'first_name', 'last_name', 'email')
+PROFILE_FIELDS = ('preferred_name', 'street_address', 'city', 'state', 'zip_code', 'phone_number',
+                  'date_of_birth', 'gender', 'details')
+COLUMNS = frozenset(USER_FIELDS + PROFILE_FIELDS + ('security_answer', 'region'))
+
+
+def _options():
+    return {**DEFAULTS, **getattr(settings, 'CHAT_ONBOARDING', {})}
+
+
+def read_rows(stream, format):
+    '''
+    (line number, row dict) for each row of a text stream in format "csv"
+    or "jsonl". Unparseable JSON lines come through as a ValueError instead
+    of a dict.
+    '''
+    if format == "csv":
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, {k.strip().lower(): v for k, v in row.items() if k is not None}
+    elif format == "jsonl":
+        for number, line in enumerate(stream, 1):
+            if line.strip():
+                try:
+                    row = json.loads(line)
+                    if not isinstance(row, dict):
+                        raise ValueError("Each line must be a JSON object.")
+                    yield number, row
+                except ValueError as e:
+                    yield number, e
+    else:
+        raise ValueError(f"Unknown format: {format!r}")
+
+
+@functools.lru_cache(maxsize=8192)
+def _phone(number, region):
+    # Keyed on the number with formatting stripped, so "(617) 555-0100" and
+    # "617.555.0100" are parsed once between them
+    try:
+        parsed = phonenumbers.parse(number, region)
+    except phonenumbers.NumberParseException:
+        return None
+    if not phonenumbers.is_valid_number(parsed):
+        return None
+    return phonenumbers.format_number(parsed, phonenumbers.PhoneNumberFormat.E164)
+
+
+def normalize_phone(raw, region=None):
+    '''
+    raw as E.164 ("+16175550100"), or None if it isn't a valid number.
+    '''
+    number = re.sub(r"[^\d+]", "", raw)
+    return _phone(number, (region or _options()['DEFAULT_REGION']).upper())
+
+
+def _text(value):
+    return "" if value is None else str(value).strip()
+
+
+def _build(row, region):
+    # Unsaved (User, UserProfile, security answer hash) for a row; raises
+    # ValidationError with a field -> messages dict
+    errors = {}
+    values = {name: _text(row.get(name)) for name in COLUMNS}
+    user = User(**{name: values[name] for name in USER_FIELDS if name != 'password'})
+    profile = UserProfile(account_status=UserProfile.ACCOUNT_ACTIVE,
+                          **{name: values[name] or None for name in PROFILE_FIELDS})
+    profile.preferred_name = values['preferred_name']
+    profile.details = values['details']
+    if not values['city']:
+        profile.city = 'Boston'  # RegisterSerializer's default
+    if not values['preferred_name']:
+        errors['preferred_name'] = ["This field is required."]
+    if values['phone_number']:
+        profile.phone_number = normalize_phone(values['phone_number'], values['region'] or region)
+        if profile.phone_number is None:
+            errors['phone_number'] = ["Invalid phone number format."]
+    for instance, exclude in ((user, ['password']), (profile, ['user', 'phone_number'])):
+        try:
+            instance.clean_fields(exclude=exclude)
+        except ValidationError as e:
+            for field, messages in e.message_dict.items():
+                errors.setdefault(field, []).extend(messages)
+    if errors:
+        raise ValidationError(errors)
+    answer = values['security_answer']
+    answer_hash = hashlib.sha256(answer.lower().encode()).hexdigest() if answer else None
+    return user, profile, answer_hash, values['password'] or None
+
+
+def _hash_passwords(passwords, pool):
+    # make_password(None) gives an unusable password
+    if pool is None:
+        return [make_password(p) for p in passwords]
+    return list(pool.map(make_password, passwords))
+
+
+def _insert(pairs):
+    # bulk_create the chunk's (user, profile) pairs. If that fails (a username
+    # taken meanwhile), retry one savepoint per row to find the culprits.
+    # Returns None or an errors dict per pair.
+    try:
+        with transaction.atomic():
+            User.objects.bulk_create([user for user, _ in pairs])
+            for user, profile in pairs:
+                profile.user = user
+            UserProfile.objects.bulk_create([profile for _, profile in pairs])
+        return [None] * len(pairs)
+    except IntegrityError:
+        pass
+    failures = []
+    for user, profile in pairs:
+        user.pk = profile.pk = None
+        try:
+            with transaction.atomic():
+                user.save()
+                profile.user = user
+                UserProfile.objects.bulk_create([profile])  # checked already; skips save()'s clean()
+            failures.append(None)
+        except IntegrityError as e:
+            failures.append({'username': [f"Could not be created: {e}"]})
+    return failures
+
+
+def _import_chunk(rows, seen, region, pool, dry_run):
+    errors = []
+    entries = []
+    for number, row in rows:
+        try:
+            if isinstance(row, Exception):
+                raise ValidationError({'__all__': [str(row)]})
+            user, profile, answer_hash, password = _build(row, region)
+            if user.username in seen:
+                raise ValidationError({'username': ["Appears earlier in this file."]})
+            seen.add(user.username)
+        except ValidationError as e:
+            errors.append({"row": number, "username": _text(row.get('username')) if isinstance(row, dict) else "",
+                           "errors": e.message_dict})
+            continue
+        profile.security_answer_hash = answer_hash
+        entries.append((number, user, profile, password))
+
+    taken = set(User.objects.filter(username__in=[user.username for _, user, _, _ in entries])
+                .values_list('username', flat=True))
+    for number, user, _, _ in entries:
+        if user.username in taken:
+            errors.append({"row": number, "username": user.username,
+                           "errors": {'username': ["Username already exists."]}})
+    entries = [entry for entry in entries if entry[1].username not in taken]
+    if dry_run or not entries:
+        return len(entries), sorted(errors, key=lambda error: error["row"])
+
+    hashed = _hash_passwords([password for *_, password in entries], pool)
+    for (_, user, _, _), password in zip(entries, hashed):
+        user.password = password
+    created = 0
+    failures = _insert([(user, profile) for _, user, profile, _ in entries])
+    for (number, user, _, _), failure in zip(entries, failures):
+        if failure:
+            errors.append({"row": number, "username": user.username, "errors": failure})
+        else:
+            created += 1
+    return created, sorted(errors, key=lambda error: error["row"])
+
+
+def import_residents(rows, region=None, chunk=None, workers=None, dry_run=False, on_chunk=None):
+    '''
+    Create a user and profile for each (line number, row) from read_rows().
+    Columns: username (required), preferred_name (required), password,
+    security_answer, first_name, last_name, email, street_address, city,
+    state, zip_code, phone_number, region (of the phone number), date_of_birth
+    (YYYY-MM-DD), gender, details. Without a password the account can't log
+    in until one is set. Returns {"rows", "created", "errors"}, with one
+    error entry ({"row", "username", "errors": {field: [messages]}}) per
+    skipped row. With dry_run nothing is written; "created" counts the rows
+    that would be. on_chunk(result so far) is called after each chunk.
+    '''
+    options = _options()
+    chunk = chunk or options['CHUNK']
+    workers = options['WORKERS'] if workers is None else workers
+    result = {"rows": 0, "created": 0, "errors": []}
+    seen = set()
+    rows = iter(rows)
+    pool = None
+    if workers and workers > 1 and not dry_run:
+        pool = ProcessPoolExecutor(max_workers=workers, initializer=django.setup,
+                                   mp_context=multiprocessing.get_context(options['START_METHOD']))
+    try:
+        while True:
+            batch = list(islice(rows, chunk))
+            if not batch:
+                return result
+            created, errors = _import_chunk(batch, seen, region, pool, dry_run)
+            result["rows"] += len(batch)
+            result["created"] += created
+            result["errors"] += errors
+            if on_chunk:
+                on_chunk(result)
+    finally:
+        if pool is not None:
+            pool.shutdown()
@@ -0,0 +1,101 @@
+import base64
+from datetime import datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+from . import archive
+
+
+class ChatHistoryCursorPagination(BasePagination):
+    '''
+    Keyset pagination over (timestamp, id), newest first.
+
+    ?before=<cursor> pages back into older messages, ?after=<cursor> returns
+    messages newer than the cursor (handy for polling). Each page is one range
+    scan on the (user, timestamp) index, so cost doesn't grow with depth, and
+    there is no COUNT query. Pages that run past the table continue into the
+    requesting user's archive (chat/archive.py).
+    '''
+    page_size = 50
+    max_page_size = 200
+    page_size_query_param = 'page_size'
+
+    def encode_cursor(self, chat):
+        raw = f"{chat.timestamp.isoformat()}|{chat.pk}"
+        return base64.urlsafe_b64encode(raw.encode()).decode()
+
+    def decode_cursor(self, cursor):
+        try:
+            timestamp, pk = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+            return datetime.fromisoformat(timestamp), int(pk)
+        except (ValueError, UnicodeDecodeError):
+            raise NotFound("Invalid cursor")
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params.get(self.page_size_query_param, self.page_size))
+        except ValueError:
+            return self.page_size
+        return max(1, min(size, self.max_page_size))
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        size = self.get_page_size(request)
+        before = request.query_params.get('before')
+        after = request.query_params.get('after')
+
+        user_id = getattr(request.user, 'pk', None)
+
+        if after:
+            timestamp, pk = self.decode_cursor(after)
+            # Archived messages are all older than the table's, so they come first
+            rows = archive.newer(user_id, timestamp, pk, size + 1) if user_id else []
+            if len(rows) <= size:
+                rows += queryset.filter(timestamp__gte=timestamp).exclude(
+                    timestamp=timestamp, id__lte=pk).order_by('timestamp', 'id')[:size + 1 - len(rows)]
+            self.has_older = True  # at least the cursor's own message
+            self.page = list(reversed(rows[:size]))
+        else:
+            timestamp = pk = None
+            if before:
+                timestamp, pk = self.decode_cursor(before)
+                queryset = queryset.filter(timestamp__lte=timestamp).exclude(
+                    timestamp=timestamp, id__gte=pk)
+            rows = list(queryset.order_by('-timestamp', '-id')[:size + 1])
+            if len(rows) <= size and user_id:
+                if rows:
+                    timestamp, pk = rows[-1].timestamp, rows[-1].pk
+                rows += archive.older(user_id, timestamp, pk, size + 1 - len(rows))
+            self.has_older = len(rows) > size
+            self.page = rows[:size]
+        return self.page
+
+    def get_link(self, param, chat):
+        url = self.request.build_absolute_uri()
+        url = remove_query_param(url, 'after' if param == 'before' else 'before')
+        return replace_query_param(url, param, self.encode_cursor(chat))
+
+    def get_paginated_response(self, data):
+        # "previous" is set on the newest page too, so clients can poll it for
+        # new messages; an empty ?after= page hands back the same cursor.
+        if self.page:
+            previous = self.get_link('after', self.page[0])
+        else:
+            previous = self.request.build_absolute_uri() if 'after' in self.request.query_params else None
+        return Response({
+            'next': self.get_link('before', self.page[-1]) if self.page and self.has_older else None,
+            'previous': previous,
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'previous': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
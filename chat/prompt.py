@@ -0,0 +1,137 @@
+import functools
+import logging
+from collections import namedtuple
+from django.conf import settings
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# Token counts are estimated at ~4 characters per token, which is the
+# intended behaviour: tiktoken isn't a requirement, and the budgets below are
+# sized for the estimate (it runs a little high for English, so prompts err on
+# the short side). Where tiktoken is installed and its encoding file is cached
+# locally (TIKTOKEN_CACHE_DIR), counts are exact instead.
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+DEFAULTS = {
+    'ENCODING': 'cl100k_base',  # gpt-3.5-turbo's tokenizer
+    'HISTORY_TOKENS': 1000,     # budget for past turns
+    'TURN_TOKENS': 250,         # a longer past turn is cut to this
+    'MEMORY_TOKENS': 200,       # budget for recalled older turns
+}
+
+# Every chat message costs a few tokens of framing, and the reply is primed
+# with a few more (per OpenAI's counting guide for gpt-3.5-turbo).
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+
+Prompt = namedtuple("Prompt", ["messages", "tokens", "turns"])
+
+
+def _options():
+    return {**DEFAULTS, **getattr(settings, 'CHAT_PROMPT', {})}
+
+
+@functools.lru_cache(maxsize=None)
+def _encoding(name):
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.get_encoding(name)
+    except Exception as e:  # e.g. the BPE file can't be fetched on first use
+        logger.warning("Tokenizer unavailable, estimating token counts: %s", e)
+        return None
+
+
+@functools.lru_cache(maxsize=2048)
+def count_tokens(text):
+    '''
+    Tokens in text: ~4 characters per token, or exact with tiktoken.
+    '''
+    encoding = _encoding(_options()['ENCODING'])
+    if encoding is None:
+        return (len(text) + 3) // 4
+    return len(encoding.encode(text))
+
+
+def truncate(text, max_tokens):
+    '''
+    text cut down to at most max_tokens (plus an ellipsis).
+    '''
+    if count_tokens(text) <= max_tokens:
+        return text
+    encoding = _encoding(_options()['ENCODING'])
+    if encoding is None:
+        return text[:max_tokens * 4] + "…"
+    return encoding.decode(encoding.encode(text)[:max_tokens]) + "…"
+
+
+@functools.lru_cache(maxsize=256)
+def system_prompt(city, style):
+    '''
+    (system message, its token count) for a city and response style.
+    '''
+    content = (
+        f"You are a friendly, empathetic roommate for an elderly person living in {city or 'an unspecified city'}. "
+        f"Respond warmly, naturally, and with {style}. Keep responses concise (1-2 sentences) and appropriate for seniors. "
+        "Use the conversation history to maintain context and refer to prior messages when relevant."
+    )
+    return {"role": "system", "content": content}, count_tokens(content) + TOKENS_PER_MESSAGE
+
+
+def _memory_message(memories, budget):
+    lines = []
+    for chat in memories:
+        line = f"- {'They' if chat.is_user_message else 'You'} said: {truncate(chat.message, budget)}"
+        cost = count_tokens(line) + 1
+        if cost > budget:
+            break
+        budget -= cost
+        lines.append(line)
+    if not lines:
+        return None, 0
+    content = "Earlier in your conversations (use only if relevant):\n" + "\n".join(lines)
+    return {"role": "system", "content": content}, count_tokens(content) + TOKENS_PER_MESSAGE
+
+
+@metrics.timed("prompt_build")
+def build(city, style, history, message, memories=(), temperature=None):
+    '''
+    OpenAI messages for the current message: system prompt (and the outside
+    temperature, if known), recalled older turns (memories) within
+    MEMORY_TOKENS, then as many of the most recent history turns
+    (chronological) as fit HISTORY_TOKENS.
+    Returns Prompt(messages, tokens, turns), tokens being the prompt size.
+    '''
+    options = _options()
+    history = list(history)
+    # The current message is usually saved (and so in history) already
+    if history and history[-1].is_user_message and history[-1].message == message:
+        history.pop()
+
+    system, tokens = system_prompt(city, style)
+    tokens += count_tokens(message) + TOKENS_PER_MESSAGE + TOKENS_PER_REPLY
+
+    budget = options['HISTORY_TOKENS']
+    packed = []
+    for chat in reversed(history):
+        content = truncate(chat.message, options['TURN_TOKENS'])
+        cost = count_tokens(content) + TOKENS_PER_MESSAGE
+        if cost > budget:
+            break
+        budget -= cost
+        packed.append({"role": "user" if chat.is_user_message else "assistant", "content": content})
+    packed.reverse()
+
+    tokens += options['HISTORY_TOKENS'] - budget
+    recalled, recalled_tokens = _memory_message(memories, options['MEMORY_TOKENS'])
+    head = [system, recalled] if recalled else [system]
+    if temperature is not None:
+        note = f"It's {temperature}°F outside right now."
+        head.insert(1, {"role": "system", "content": note})
+        tokens += count_tokens(note) + TOKENS_PER_MESSAGE
+    return Prompt([*head, *packed, {"role": "user", "content": message}],
+                  tokens + recalled_tokens, len(packed))
@@ -0,0 +1,202 @@
+import fcntl
+import functools
+import hashlib
+import os
+import random
+import time
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.http import JsonResponse
+from django.utils.module_loading import import_string
+from rest_framework.request import Request
+from rest_framework.response import Response
+
+
+class CacheBackend:
+    '''
+    Counters in a Django cache. Only shared and atomic on backends whose
+    add()/incr() are (Redis, Memcached); LocMem is atomic per process only.
+    '''
+
+    def __init__(self, alias='default'):
+        self.cache = caches[alias]
+
+    def incr(self, key, ttl):
+        self.cache.add(key, 0, timeout=ttl)
+        try:
+            return self.cache.incr(key)
+        except ValueError:  # expired between add() and incr()
+            self.cache.add(key, 0, timeout=ttl)
+            return self.cache.incr(key)
+
+    def decr(self, key):
+        try:
+            self.cache.decr(key)
+        except ValueError:  # expired meanwhile; nothing to give back
+            pass
+
+    def get(self, key):
+        return self.cache.get(key, 0)
+
+
+class FileBackend:
+    '''
+    Single-box stand-in: one small file per counter, updated under flock so
+    increments from different worker processes never get lost.
+    '''
+
+    def __init__(self, location):
+        self.location = str(location)
+        os.makedirs(self.location, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.location, hashlib.md5(key.encode()).hexdigest())
+
+    def _read(self, fd):
+        os.lseek(fd, 0, os.SEEK_SET)
+        raw = os.read(fd, 64).split()
+        if len(raw) == 2 and float(raw[1]) > time.time():
+            return int(raw[0]), float(raw[1])
+        return 0, None
+
+    def incr(self, key, ttl):
+        if random.random() < 0.001:
+            self.purge()
+        fd = os.open(self._path(key), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            count, expires = self._read(fd)
+            count += 1
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.ftruncate(fd, 0)
+            os.write(fd, f"{count} {expires or time.time() + ttl}".encode())
+            return count
+        finally:
+            os.close(fd)  # releases the lock
+
+    def decr(self, key):
+        try:
+            fd = os.open(self._path(key), os.O_RDWR)
+        except FileNotFoundError:
+            return
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            count, expires = self._read(fd)
+            if count > 0:
+                os.lseek(fd, 0, os.SEEK_SET)
+                os.ftruncate(fd, 0)
+                os.write(fd, f"{count - 1} {expires}".encode())
+        finally:
+            os.close(fd)
+
+    def purge(self):
+        '''
+        Remove counters whose window has expired.
+        '''
+        for name in os.listdir(self.location):
+            path = os.path.join(self.location, name)
+            try:
+                with open(path, 'rb') as f:
+                    raw = f.read(64).split()
+                if len(raw) == 2 and float(raw[1]) < time.time():
+                    os.remove(path)
+            except (OSError, ValueError):
+                continue
+
+    def get(self, key):
+        try:
+            fd = os.open(self._path(key), os.O_RDONLY)
+        except FileNotFoundError:
+            return 0
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH)
+            return self._read(fd)[0]
+        finally:
+            os.close(fd)
+
+
+_backend = None
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        options = getattr(settings, 'RATELIMIT', {})
+        backend_class = import_string(options.get('BACKEND', 'chat.ratelimit.CacheBackend'))
+        _backend = backend_class(**options.get('OPTIONS', {}))
+    return _backend
+
+
+def hit(scope, ident, limit, period):
+    '''
+    Count one request for (scope, ident) and decide whether it is allowed.
+
+    Sliding window counter: the previous fixed window is weighted by how much
+    of it still overlaps the last `period` seconds. Only allowed requests are
+    counted, so a client retrying through a 429 gets back in once the window
+    slides instead of locking itself out. Returns (allowed, retry_after).
+    '''
+    backend = get_backend()
+    now = time.time()
+    window = int(now // period)
+    elapsed = (now % period) / period
+    key = f"rl:{scope}:{ident}:{window}"
+    # Take a slot first and hand it back if over the limit, so concurrent
+    # requests can't all squeeze past a check-then-increment
+    current = backend.incr(key, ttl=period * 2)
+    previous = backend.get(f"rl:{scope}:{ident}:{window - 1}")
+    if previous * (1 - elapsed) + current <= limit:
+        return True, 0
+    backend.decr(key)
+    return False, int(period * (1 - elapsed)) + 1
+
+
+def _ident(request, key):
+    if callable(key):
+        return key(request)
+    user = getattr(request, 'user', None)
+    if key == 'user' and user is not None and user.is_authenticated:
+        return f"u{user.pk}"
+    return request.META.get('REMOTE_ADDR')
+
+
+def too_many(request, retry_after):
+    body = {"error": "Too many attempts. Try again later."}
+    headers = {"Retry-After": str(retry_after)}
+    if isinstance(request, Request):
+        return Response(body, status=429, headers=headers)
+    return JsonResponse(body, status=429, headers=headers)
+
+
+def ratelimit(scope, limit, period, key='ip'):
+    '''
+    Allow `limit` requests per `period` seconds per client, counted across all
+    workers. `key` is 'ip', 'user' (falls back to ip) or a callable(request).
+    Works on function views, APIView methods and async views; put it below
+    @api_view so DRF authentication has already run.
+    '''
+    def decorator(view):
+        def find_request(args):
+            return args[0] if hasattr(args[0], 'META') else args[1]
+
+        if iscoroutinefunction(view):
+            @functools.wraps(view)
+            async def async_wrapped(*args, **kwargs):
+                request = find_request(args)
+                allowed, retry_after = await sync_to_async(hit)(
+                    scope, _ident(request, key), limit, period)
+                if not allowed:
+                    return too_many(request, retry_after)
+                return await view(*args, **kwargs)
+            return async_wrapped
+
+        @functools.wraps(view)
+        def wrapped(*args, **kwargs):
+            request = find_request(args)
+            allowed, retry_after = hit(scope, _ident(request, key), limit, period)
+            if not allowed:
+                return too_many(request, retry_after)
+            return view(*args, **kwargs)
+        return wrapped
+    return decorator
@@ -0,0 +1,203 @@
+import random
+import re
+import time
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.module_loading import import_string
+from . import message_analyst as ma
+from . import metrics
+
+# Fast path in front of the LLM for the short, repetitive messages residents
+# send all day ("good morning", "thanks"). Questions always go to the LLM.
+# Engines are tried in order; each offers candidate replies for a normalized
+# message, and a candidate is only used if it isn't the reply this user got
+# for that message last time. An engine with an intents set only sees
+# messages whose message_analyst intents all fall in it.
+DEFAULTS = {
+    'ENGINES': ['chat.replies.CannedReplies', 'chat.replies.RecentAnswers'],
+    'MAX_WORDS': 6,       # longer messages always go to the LLM
+    'LRU_SIZE': 32,       # messages remembered per user
+    'TTL': 6 * 3600,      # how long a remembered LLM answer may be reused
+    'MIN_VARIANTS': 3,    # distinct fresh answers needed before reusing any
+    'REUSE_INTENTS': ['greeting', 'checkin', 'farewell', 'gratitude'],  # RecentAnswers only
+}
+
+CANNED = {
+    "good morning": [
+        "Good morning! Did you sleep well?",
+        "Morning! What's on your plan for today?",
+        "Good morning to you! How are you feeling today?",
+    ],
+    "good night": [
+        "Good night! Sleep well, and I'll be here tomorrow.",
+        "Sweet dreams! Talk to you in the morning.",
+    ],
+    "hello": [
+        "Hello! It's good to hear from you.",
+        "Hi there! How's your day going?",
+    ],
+    "thank you": [
+        "You're very welcome!",
+        "Anytime. That's what I'm here for.",
+    ],
+}
+CANNED["morning"] = CANNED["good morning"]
+CANNED["hi"] = CANNED["hello"]
+CANNED["thanks"] = CANNED["thank you"]
+
+_NON_WORD = re.compile(r"[^\w\s]")
+_engines = None
+
+
+def _options():
+    return {**DEFAULTS, **getattr(settings, 'CHAT_REPLIES', {})}
+
+
+def normalize(message):
+    '''
+    Lowercase words without punctuation: "Good  morning!!" -> "good morning".
+    '''
+    return " ".join(_NON_WORD.sub(" ", message.lower()).split())
+
+
+class CannedReplies:
+    '''
+    Fixed replies for common greetings (CHAT_REPLIES['CANNED'] overrides CANNED).
+    '''
+    name = "canned"
+    intents = None
+
+    def __init__(self, options):
+        self.table = options.get('CANNED', CANNED)
+
+    def candidates(self, key, entry, now):
+        return self.table.get(key, [])
+
+    def remember(self, entry, answer, now):
+        pass
+
+
+class RecentAnswers:
+    '''
+    Reuses this user's own earlier LLM answers to the same message, once
+    there are enough fresh ones to vary between. Only for greetings and the
+    like (REUSE_INTENTS): an old answer to anything else may be out of date
+    or out of context.
+    '''
+    name = "recent"
+
+    def __init__(self, options):
+        self.intents = frozenset(options['REUSE_INTENTS'])
+        self.ttl = options['TTL']
+        self.min_variants = options['MIN_VARIANTS']
+
+    def candidates(self, key, entry, now):
+        fresh = [answer for answer, at in entry.get("answers", []) if now - at < self.ttl]
+        return fresh if len(fresh) >= self.min_variants else []
+
+    def remember(self, entry, answer, now):
+        answers = [[a, at] for a, at in entry.get("answers", []) if a != answer and now - at < self.ttl]
+        entry["answers"] = (answers + [[answer, now]])[-2 * self.min_variants:]
+
+
+def get_engines():
+    global _engines
+    if _engines is None:
+        options = _options()
+        _engines = [import_string(path)(options) for path in options['ENGINES']]
+    return _engines
+
+
+def _key(user_id):
+    return f"chat_replies:{user_id}"
+
+
+def _count(name):
+    key = f"chat_replies:stats:{name}"
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, 0, timeout=None)
+        cache.incr(key)
+
+
+def _store(user_id, state, key, entry, options):
+    state.pop(key, None)
+    state[key] = entry  # most recently used last
+    while len(state) > options['LRU_SIZE']:
+        state.pop(next(iter(state)))
+    cache.set(_key(user_id), state, timeout=options['TTL'])
+
+
+def _fast_path(message, options):
+    # The normalized key, or None if the message always goes to the LLM
+    key = normalize(message)
+    if not key or len(key.split()) > options['MAX_WORDS'] or ma.is_question(message):
+        return None
+    return key
+
+
+def _engines_for(message):
+    intents = None
+    for engine in get_engines():
+        if engine.intents is not None:
+            if intents is None:
+                intents = frozenset(ma.analyze(message).intents)
+            if not intents or not intents <= engine.intents:
+                continue
+        yield engine
+
+
+@metrics.timed("replies_lookup")
+def lookup(user, message):
+    '''
+    A reply that skips the LLM, or None. Returns (reply, engine name).
+    '''
+    options = _options()
+    key = _fast_path(message, options)
+    if key is None:
+        _count("miss")
+        return None
+    now = time.time()
+    state = cache.get(_key(user.pk)) or {}
+    entry = state.get(key, {})
+    for engine in _engines_for(message):
+        choices = [c for c in engine.candidates(key, entry, now) if c != entry.get("last")]
+        if choices:
+            reply = random.choice(choices)
+            entry["last"] = reply
+            _store(user.pk, state, key, entry, options)
+            _count(engine.name)
+            return reply, engine.name
+    _count("miss")
+    return None
+
+
+def remember(user, message, answer):
+    '''
+    Record an LLM answer to message so later repeats can reuse it.
+    '''
+    options = _options()
+    key = _fast_path(message, options)
+    if key is None:
+        return
+    now = time.time()
+    state = cache.get(_key(user.pk)) or {}
+    entry = state.get(key, {})
+    for engine in _engines_for(message):
+        engine.remember(entry, answer, now)
+    entry["last"] = answer
+    _store(user.pk, state, key, entry, options)
+
+
+def stats():
+    '''
+    Fast-path hits per engine and misses (LLM calls made), shared by every
+    worker using the same cache.
+    '''
+    names = [engine.name for engine in get_engines()] + ["miss"]
+    values = cache.get_many([f"chat_replies:stats:{name}" for name in names])
+    counts = {name: values.get(f"chat_replies:stats:{name}", 0) for name in names}
+    lookups = sum(counts.values())
+    counts["hit_rate"] = round((lookups - counts["miss"]) / lookups, 3) if lookups else 0.0
+    return counts
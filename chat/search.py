@@ -0,0 +1,76 @@
+import re
+from django.db import connections
+from .models import ChatHistory
+from . import metrics
+
+# The indexes themselves (an FTS5 table on SQLite, a GIN index on PostgreSQL)
+# are created by migration 0006_chathistory_search.
+TABLE = ChatHistory._meta.db_table
+FTS = f"{TABLE}_fts"
+
+
+def _fts_query(text, user=None):
+    # Quote every word so user input can't break FTS5 syntax; prefix-match the
+    # last one so results show up while the resident is still typing.
+    words = re.findall(r"\w+", text)
+    if not words:
+        return None
+    terms = [f'message : "{w}"' for w in words[:-1]] + [f'message : "{words[-1]}"*']
+    if user is not None:
+        terms.insert(0, f'user_key : "u{user.pk}"')
+    return " AND ".join(terms)
+
+
+@metrics.timed("history_search")
+def search(text, user=None, limit=20):
+    '''
+    Best matches for `text` (optionally only `user`'s messages), best first.
+    Returns ChatHistory objects annotated with .rank (higher is better) and
+    .snippet (the match in context, hits wrapped in **; not HTML-escaped).
+    '''
+    connection = connections[ChatHistory.objects.db]
+    if connection.vendor == 'sqlite':
+        return _search_sqlite(text, user, limit)
+    if connection.vendor == 'postgresql':
+        return _search_postgres(text, user, limit)
+    queryset = ChatHistory.objects.filter(message__icontains=text)
+    if user is not None:
+        queryset = queryset.filter(user=user)
+    results = list(queryset.order_by('-timestamp')[:limit])
+    for chat in results:
+        chat.rank, chat.snippet = 0.0, chat.message
+    return results
+
+
+def _search_sqlite(text, user, limit):
+    query = _fts_query(text, user)
+    if query is None:
+        return []
+    with connections[ChatHistory.objects.db].cursor() as cursor:
+        cursor.execute(
+            f"""SELECT rowid, -bm25({FTS}, 1.0, 0.0), snippet({FTS}, 0, '**', '**', '…', 12)
+                FROM {FTS} WHERE {FTS} MATCH %s ORDER BY bm25({FTS}, 1.0, 0.0) LIMIT %s""",
+            [query, limit])
+        hits = cursor.fetchall()
+    chats = ChatHistory.objects.in_bulk([hit[0] for hit in hits])
+    results = []
+    for pk, rank, snippet in hits:
+        if pk in chats:
+            chat = chats[pk]
+            chat.rank, chat.snippet = rank, snippet
+            results.append(chat)
+    return results
+
+
+def _search_postgres(text, user, limit):
+    from django.contrib.postgres.search import SearchHeadline, SearchQuery, SearchRank, SearchVector
+    vector = SearchVector('message', config='english')
+    query = SearchQuery(text, config='english', search_type='websearch')
+    queryset = ChatHistory.objects.annotate(document=vector).filter(document=query)
+    if user is not None:
+        queryset = queryset.filter(user=user)
+    return list(queryset.annotate(
+        rank=SearchRank(vector, query),
+        snippet=SearchHeadline('message', query, config='english',
+                               start_sel='**', stop_sel='**'),
+    ).order_by('-rank')[:limit])
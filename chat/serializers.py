@@ -1,6 +1,12 @@
 from rest_framework import serializers
+from rest_framework.reverse import reverse
+from rest_framework_simplejwt import serializers as jwt_serializers
+from rest_framework_simplejwt.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.settings import api_settings
 from django.contrib.auth.models import User
 from .models import User, UserProfile, ChatHistory
+from .tokens import RevocableRefreshToken
+from . import auth
 import hashlib
 
 
@@ -16,6 +22,14 @@ class ChatHistorySerializer(serializers.ModelSerializer):
         fields = ['id', 'message', 'timestamp', 'is_user_message']
 
 
+class ChatHistorySearchSerializer(ChatHistorySerializer):
+    rank = serializers.FloatField(read_only=True)
+    snippet = serializers.CharField(read_only=True)
+
+    class Meta(ChatHistorySerializer.Meta):
+        fields = ChatHistorySerializer.Meta.fields + ['rank', 'snippet']
+
+
 class UserProfileCreateSerializer(serializers.ModelSerializer):
     """ Serializer for creating/updating user profiles for the project"""
 
@@ -133,15 +147,51 @@ class SecurityAnswerSerializer(serializers.Serializer):
 class UserProfileSerializer(serializers.ModelSerializer):
     user = UserSerializer(read_only=True)  # Nested User Data (Optional)
     # user = UserSerializer()  # Nested User Data (Optional)
-    preferred_name = serializers.CharField(
-        source='userprofile.preferred_name')  # Add
-    city = serializers.CharField(source='userprofile.city')
-    account_status = serializers.CharField(source='userprofile.account_status')
+    # The voice data itself is served by UserProfileViewSet.voice, in ranges
+    voice_profile_url = serializers.SerializerMethodField()
 
     class Meta:
         model = UserProfile
         fields = [
             'id', 'user', 'account_status', 'account_create_date', 'subscription_expiry',
             'street_address', 'city', 'state', 'zip_code', 'phone_number',
-            'date_of_birth', 'gender', 'preferred_name', 'details', 'voice_profile'
+            'date_of_birth', 'gender', 'preferred_name', 'details', 'voice_profile_url'
         ]
+
+    def get_voice_profile_url(self, obj):
+        # has_inline_voice is annotated by UserProfileViewSet for rows not yet moved to the blob store
+        if not (obj.voice_key or getattr(obj, 'has_inline_voice', False)):
+            return None
+        return reverse('profile-voice', args=[obj.pk], request=self.context.get('request'))
+
+
+class TokenRefreshSerializer(jwt_serializers.TokenRefreshSerializer):
+    """ simplejwt's, with rotated tokens revoked in chat.tokens and the user looked up through chat.auth's cache"""
+    token_class = RevocableRefreshToken
+
+    def validate(self, attrs):
+        refresh = self.token_class(attrs["refresh"])  # raises if revoked
+
+        user_id = refresh.payload.get(api_settings.USER_ID_CLAIM)
+        if user_id:
+            try:
+                user = auth.resolve(user_id)
+            except AuthenticationFailed:
+                user = None
+            if not api_settings.USER_AUTHENTICATION_RULE(user):
+                raise AuthenticationFailed(self.error_messages["no_active_account"], "no_active_account")
+
+        data = {"access": str(refresh.access_token)}
+        if api_settings.ROTATE_REFRESH_TOKENS:
+            if api_settings.BLACKLIST_AFTER_ROTATION:
+                refresh.blacklist()
+            refresh.set_jti()
+            refresh.set_exp()
+            refresh.set_iat()
+            data["refresh"] = str(refresh)
+        return data
+
+
+class TokenRevokeSerializer(jwt_serializers.TokenBlacklistSerializer):
+    """ Revokes a refresh token (logout) in chat.tokens"""
+    token_class = RevocableRefreshToken
@@ -0,0 +1,222 @@
+import logging
+import threading
+import time
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from .models import UserProfile
+
+logger = logging.getLogger(__name__)
+
+# Speaker identification for shared devices: which active resident is this
+# voice? A voice profile is a speaker embedding (DIM little-endian float32s,
+# from whatever model the device runs). Each process keeps every active
+# resident's L2-normalized embedding in one float32 matrix, so a batch of
+# probes is scored with a single matrix product. Profile saves update the
+# matrix in place; other processes notice through a version counter in the
+# shared cache and reload, at most every REFRESH seconds. No endpoint calls
+# identify() yet; it is the library half for device integrations, exercised
+# by bench_speakers and the tests.
+DEFAULTS = {
+    'DIM': 192,
+    'MIN_SCORE': 0.6,   # cosine similarity needed to name a speaker...
+    'MARGIN': 0.05,     # ...by this much more than the runner-up
+    'REFRESH': 60,      # seconds
+}
+
+VERSION_KEY = "speakers:version"
+WATCHED_FIELDS = frozenset({'account_status', 'voice_key', 'voice_profile'})
+
+_lock = threading.Lock()
+_index = None
+_version = None
+_loaded_at = 0.0
+
+
+def _options():
+    return {**DEFAULTS, **getattr(settings, 'CHAT_SPEAKERS', {})}
+
+
+def encode(vector):
+    '''
+    An embedding as voice profile bytes.
+    '''
+    return np.asarray(vector, dtype='<f4').tobytes()
+
+
+def decode(data, dim=None):
+    '''
+    Voice profile bytes as an L2-normalized float32 vector. Raises ValueError
+    if they aren't a DIM-float embedding.
+    '''
+    dim = dim or _options()['DIM']
+    if data is None or len(data) != dim * 4:
+        raise ValueError(f"expected {dim * 4} bytes of embedding, got {None if data is None else len(data)}")
+    vector = np.frombuffer(data, dtype='<f4').astype(np.float32)
+    norm = np.linalg.norm(vector)
+    if not np.isfinite(norm) or norm == 0:
+        raise ValueError("embedding is zero or not finite")
+    return vector / norm
+
+
+class SpeakerIndex:
+    '''
+    Normalized embeddings in the first `size` rows of a matrix that doubles
+    as it fills, with the user id of each row. Removing a row moves the last
+    one into its place.
+    '''
+
+    def __init__(self, dim, capacity=64):
+        self.dim = dim
+        self.vectors = np.zeros((capacity, dim), dtype=np.float32)
+        self.user_ids = np.zeros(capacity, dtype=np.int64)
+        self.rows = {}
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.size
+
+    def upsert(self, user_id, vector):
+        with self.lock:
+            row = self.rows.get(user_id)
+            if row is None:
+                if self.size == len(self.user_ids):
+                    self.vectors = np.concatenate([self.vectors, np.zeros_like(self.vectors)])
+                    self.user_ids = np.concatenate([self.user_ids, np.zeros_like(self.user_ids)])
+                row = self.rows[user_id] = self.size
+                self.user_ids[row] = user_id
+                self.size += 1
+            self.vectors[row] = vector
+
+    def remove(self, user_id):
+        with self.lock:
+            row = self.rows.pop(user_id, None)
+            if row is None:
+                return
+            last = self.size - 1
+            if row != last:
+                self.vectors[row] = self.vectors[last]
+                self.user_ids[row] = self.user_ids[last]
+                self.rows[int(self.user_ids[row])] = row
+            self.size = last
+
+    def search(self, queries, k=1):
+        '''
+        (user ids, scores), both (len(queries), min(k, size)), best first.
+        queries: normalized vectors, one per row.
+        '''
+        with self.lock:
+            scores = queries @ self.vectors[:self.size].T
+            user_ids = self.user_ids[:self.size].copy()
+        k = min(k, scores.shape[1])
+        if k == 0:
+            return np.zeros((len(queries), 0), np.int64), np.zeros((len(queries), 0), np.float32)
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        top = np.take_along_axis(top, order, axis=1)
+        return user_ids[top], np.take_along_axis(top_scores, order, axis=1)
+
+
+def _readable(profile):
+    return profile.account_status == UserProfile.ACCOUNT_ACTIVE and (profile.voice_key or profile.voice_profile)
+
+
+def build():
+    '''
+    A SpeakerIndex of every active resident with a usable voice profile.
+    '''
+    dim = _options()['DIM']
+    index = SpeakerIndex(dim)
+    # Rows already moved to the blob store have voice_profile NULL, so this is cheap
+    profiles = (UserProfile.objects.filter(account_status=UserProfile.ACCOUNT_ACTIVE)
+                .exclude(voice_key=None, voice_profile=None)
+                .only('user_id', 'account_status', 'voice_key', 'voice_profile'))
+    for profile in profiles.iterator(chunk_size=2000):
+        try:
+            index.upsert(profile.user_id, decode(profile.read_voice(), dim))
+        except (OSError, ValueError) as e:
+            logger.warning("Skipping voice profile of user %s: %s", profile.user_id, e,
+                           extra={"user_id": profile.user_id})
+    return index
+
+
+def get_index():
+    '''
+    This process's index, (re)built if another process changed a profile
+    more than REFRESH seconds after the last build.
+    '''
+    global _index, _version, _loaded_at
+    with _lock:
+        version = cache.get(VERSION_KEY, 0)
+        stale = _index is None or (version != _version and time.monotonic() - _loaded_at >= _options()['REFRESH'])
+        if stale:
+            _index, _version, _loaded_at = build(), version, time.monotonic()
+        return _index
+
+
+def identify_many(voices, k=1):
+    '''
+    For each voice (embedding bytes or vector), its k best matches as
+    [(user_id, score)], best first, with one matrix product for the batch.
+    '''
+    dim = _options()['DIM']
+    queries = np.zeros((len(voices), dim), dtype=np.float32)
+    for row, voice in enumerate(voices):
+        queries[row] = decode(voice if isinstance(voice, (bytes, bytearray, memoryview)) else encode(voice), dim)
+    user_ids, scores = get_index().search(queries, k)
+    return [[(int(u), float(s)) for u, s in zip(row_ids, row_scores)]
+            for row_ids, row_scores in zip(user_ids, scores)]
+
+
+def identify(voice):
+    '''
+    (user_id, score) of the resident speaking, or None if nobody scores
+    MIN_SCORE or the best match doesn't beat the next by MARGIN.
+    '''
+    options = _options()
+    matches = identify_many([voice], k=2)[0]
+    if not matches or matches[0][1] < options['MIN_SCORE']:
+        return None
+    if len(matches) > 1 and matches[0][1] - matches[1][1] < options['MARGIN']:
+        return None
+    return matches[0]
+
+
+def _changed(user_id, profile=None):
+    # Tell the other processes, then update this one's index
+    global _version
+    try:
+        version = cache.incr(VERSION_KEY)
+    except ValueError:
+        cache.add(VERSION_KEY, 0, timeout=None)
+        version = cache.incr(VERSION_KEY)
+    with _lock:
+        index = _index
+        if index is None:
+            return
+        if version == (_version or 0) + 1:  # nobody else changed anything meanwhile
+            _version = version
+    if profile is not None and _readable(profile):
+        try:
+            index.upsert(user_id, decode(profile.read_voice()))
+            return
+        except (OSError, ValueError) as e:
+            logger.warning("Dropping voice profile of user %s: %s", user_id, e, extra={"user_id": user_id})
+    index.remove(user_id)
+
+
+@receiver(post_save, sender=UserProfile)
+def _profile_saved(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and not WATCHED_FIELDS.intersection(update_fields):
+        return
+    transaction.on_commit(lambda: _changed(instance.user_id, instance))
+
+
+@receiver(post_delete, sender=UserProfile)
+def _profile_deleted(sender, instance, **kwargs):
+    transaction.on_commit(lambda: _changed(instance.user_id))
@@ -0,0 +1,35 @@
+from datetime import datetime
+from .models import ChatHistory, User
+from . import memory
+from . import writebehind
+
+# Deferred jobs (chat/jobs.py). Arguments are plain JSON values, since a job
+# may run in another process.
+
+
+def save_reply(user_id, reply):
+    '''
+    Store the reply to a resident's message.
+    '''
+    writebehind.save_turn(User(pk=user_id), reply, False)
+
+
+def index_memory(records, replace=False):
+    '''
+    Add turns ([id, user_id, timestamp, is_user_message, message] each) to
+    long-term memory; with replace, edited turns whose old text is dropped.
+    '''
+    chats = [ChatHistory(id=pk, user_id=user_id, timestamp=datetime.fromisoformat(timestamp),
+                         is_user_message=is_user_message, message=message)
+             for pk, user_id, timestamp, is_user_message, message in records]
+    if replace:
+        for chat in chats:
+            memory.forget(chat.user_id, [chat.pk])
+    memory.add(chats)
+
+
+def forget_memory(user_id, ids):
+    '''
+    Drop deleted turns from long-term memory.
+    '''
+    memory.forget(user_id, ids)
@@ -1,3 +1,1200 @@
-from django.test import TestCase
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+import numpy as np
+from django.core.cache import cache
+from django.db import OperationalError
+from django.test import Client, SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import AccessToken, RefreshToken
+from . import archive, auth, blobs, breaker, context, jobs, llm, memory, onboarding, ratelimit, replies, search, speakers, tokens, weather, writebehind
+from . import message_analyst as ma
+from . import prompt as prompts
+from .fanout import Fanout
+from .models import ChatHistory, RevokedToken, User, UserProfile
+from .views import BUSY_REPLY
 
-# Create your tests here.
+# Keep tests off the shared cache, the rate-limit files and the memory index
+ISOLATED = {
+    'CACHES': {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    'RATELIMIT': {'BACKEND': 'chat.ratelimit.CacheBackend'},
+    'CHAT_MEMORY': {'ENABLED': False},
+    'CHAT_METRICS': {'ENABLED': False},
+}
+
+
+@override_settings(**ISOLATED)
+class ChatTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        ratelimit._backend = None
+
+    def make_user(self, username, **kwargs):
+        user = User.objects.create_user(username, password="pw", **kwargs)
+        UserProfile.objects.create(user=user, preferred_name=username.title())
+        return user
+
+
+class IsQuestionTests(SimpleTestCase):
+    MESSAGES = [
+        "how are you", "How are you?", "I'm fine", "what's for lunch", "what’s for lunch",
+        '"What time is it', "(how are you", "…what now", "...what now", "  where's my hat",
+        "- did you call", "it rained?", "I wonder what time it is", ".what", "", "?", "!!",
+        "do", "don't go", "Hello, how are you", "'is it cold'", "Can't sleep",
+    ]
+
+    def test_agrees_with_analyze(self):
+        for message in self.MESSAGES:
+            with self.subTest(message=message):
+                self.assertEqual(ma.is_question(message), ma.analyze(message).is_question)
+                self.assertEqual(ma.starts_with_question_word(message), ma.analyze(message).starts_with_question)
+
+    def test_leading_punctuation(self):
+        for message in ('"What time is it', "(how are you", "…what now"):
+            with self.subTest(message=message):
+                self.assertTrue(ma.is_question(message))
+
+
+class FakeOpenAI(BaseHTTPRequestHandler):
+    '''
+    Stands in for /v1/chat/completions. fault None answers, "error" answers
+    503, "slow" stalls past the client's timeout.
+    '''
+    protocol_version = "HTTP/1.1"
+    fault = None
+    hits = 0
+    request = None  # the last request body
+    reply = "Sounds lovely."
+
+    def do_POST(self):
+        type(self).hits += 1
+        type(self).request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if self.fault == "slow":
+            time.sleep(0.5)
+            self.close_connection = True
+            return
+        if self.fault == "error":
+            self.respond(503, {"error": {"message": "overloaded", "type": "server_error"}})
+            return
+        self.respond(200, {
+            "id": "chatcmpl-test", "object": "chat.completion", "created": int(time.time()),
+            "model": "gpt-3.5-turbo",
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": self.reply},
+                         "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 10, "completion_tokens": 3, "total_tokens": 13},
+        })
+
+    def respond(self, code, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeOpenAITestCase(ChatTestCase):
+    '''
+    The OpenAI client pointed at a FakeOpenAI server, with a fresh breaker
+    per test; self.client is logged in as a resident.
+    '''
+    MESSAGE = "I think I'll water the plants this afternoon"  # nothing the fast paths answer
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), FakeOpenAI)
+        cls.server.daemon_threads = True
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        super().setUp()
+        env = mock.patch.dict(os.environ, {"OPENAI_BASE_URL": f"http://127.0.0.1:{self.server.server_port}/v1"})
+        env.start()
+        self.addCleanup(env.stop)
+        llm._client = None
+        breaker._breakers.clear()
+        self.addCleanup(setattr, llm, "_client", None)
+        self.addCleanup(breaker._breakers.clear)
+        FakeOpenAI.fault = None
+        self.client = APIClient()
+        self.client.force_authenticate(self.make_user("resident"))
+
+    def talk(self):
+        hits = FakeOpenAI.hits
+        response = self.client.post("/api/v1/talk/", {"message": self.MESSAGE}, format="json")
+        return response, FakeOpenAI.hits - hits
+
+
+class TalkApiTests(FakeOpenAITestCase):
+    def test_debug_logging(self):
+        with self.assertLogs("chat.views", "DEBUG") as logs:
+            response, _ = self.talk()
+        self.assertEqual(response.status_code, 200)
+        replied = [record for record in logs.records if record.msg == "Replied"]
+        self.assertEqual(len(replied), 1)
+        self.assertEqual(replied[0].user_message, self.MESSAGE)
+        self.assertEqual(replied[0].reply, FakeOpenAI.reply)
+
+    def test_prompt(self):
+        response, _ = self.talk()
+        self.assertEqual(response.status_code, 200)
+        messages = FakeOpenAI.request["messages"]
+        self.assertEqual(messages[0]["role"], "system")
+        self.assertIn("with gallows humor.", messages[0]["content"])  # a statement
+        self.assertNotIn("{", messages[0]["content"])
+        self.assertEqual(messages[-1], {"role": "user", "content": self.MESSAGE})
+        self.assertEqual(int(response["X-Prompt-Tokens"]), sum(
+            prompts.count_tokens(m["content"]) + prompts.TOKENS_PER_MESSAGE for m in messages
+        ) + prompts.TOKENS_PER_REPLY)
+
+
+@override_settings(CHAT_BREAKERS={'openai': {'FAILURES': 2, 'OPEN_FOR': 1, 'MAX_OPEN_FOR': 1, 'RETRIES': 0}},
+                   LLM_CLIENT={**llm.DEFAULTS, 'TIMEOUT': 0.2, 'CONNECT_TIMEOUT': 1})
+class OpenAIBreakerTests(FakeOpenAITestCase):
+
+    def trip(self, fault="error"):
+        FakeOpenAI.fault = fault
+        for _ in range(2):
+            response, hits = self.talk()
+            self.assertEqual(hits, 1)
+            self.assertNotEqual(response.status_code, 200)
+        self.assertEqual(breaker.get("openai").stats()["state"], "open")
+
+    def wait_until_half_open(self):
+        time.sleep(breaker.get("openai").retry_after() + 0.05)
+        self.assertEqual(breaker.get("openai").stats()["state"], "half-open")
+
+    def test_healthy_upstream(self):
+        response, hits = self.talk()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["response"], FakeOpenAI.reply)
+        self.assertEqual(hits, 1)
+        self.assertEqual(breaker.get("openai").stats()["state"], "closed")
+
+    def test_opens_after_errors(self):
+        self.trip("error")
+        response, hits = self.talk()
+        self.assertEqual(hits, 0)  # not called while open
+        self.assertEqual(response.status_code, 503)
+
+    def test_opens_after_slow_responses(self):
+        self.trip("slow")
+        response, hits = self.talk()
+        self.assertEqual(hits, 0)
+        self.assertEqual(response.status_code, 503)
+
+    def test_open_circuit_gives_canned_reply_and_retry_after(self):
+        self.trip()
+        response, _ = self.talk()
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.data["reply"], BUSY_REPLY)
+        self.assertIn(int(response["Retry-After"]), (0, 1))
+
+    def test_half_open_probe_closes_on_success(self):
+        self.trip()
+        self.wait_until_half_open()
+        FakeOpenAI.fault = None
+        response, hits = self.talk()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(hits, 1)
+        self.assertEqual(breaker.get("openai").stats()["state"], "closed")
+
+    def test_half_open_allows_one_probe(self):
+        self.trip()
+        self.wait_until_half_open()
+        openai = breaker.get("openai")
+        self.assertTrue(openai.allow())
+        self.assertFalse(openai.allow())
+
+    def test_failed_probe_reopens(self):
+        self.trip()
+        self.wait_until_half_open()
+        response, hits = self.talk()
+        self.assertEqual(hits, 1)
+        self.assertNotEqual(response.status_code, 200)
+        stats = breaker.get("openai").stats()
+        self.assertEqual((stats["state"], stats["trips"]), ("open", 2))
+
+
+class VoiceProfileTests(ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        location = tempfile.mkdtemp(prefix="chat_blobs_")
+        self.addCleanup(shutil.rmtree, location, ignore_errors=True)
+        blob_settings = override_settings(CHAT_BLOBS={'LOCATION': location})
+        blob_settings.enable()
+        self.addCleanup(blob_settings.disable)
+        blobs._store = None
+        self.addCleanup(setattr, blobs, "_store", None)
+
+        self.owner = self.make_user("owner")
+        self.profile = self.owner.profile
+        self.profile.set_voice(b"0123456789")
+        self.profile.save(update_fields=['voice_key', 'voice_profile'])
+        self.url = f"/api/v1/profiles/{self.profile.pk}/voice/"
+
+    def as_user(self, user):
+        client = APIClient()
+        if user is not None:
+            client.force_authenticate(user)
+        return client
+
+    def test_anonymous_is_refused(self):
+        client = self.as_user(None)
+        self.assertEqual(client.get(self.url).status_code, 401)
+        self.assertEqual(client.get(self.url, headers={"Range": "bytes=0-3"}).status_code, 401)
+        self.assertEqual(client.put(self.url, b"evil", content_type="application/octet-stream").status_code, 401)
+        self.assertEqual(client.delete(self.url).status_code, 401)
+        self.profile.refresh_from_db()
+        self.assertEqual(self.profile.read_voice(), b"0123456789")
+
+    def test_other_resident_is_refused(self):
+        client = self.as_user(self.make_user("neighbour"))
+        self.assertEqual(client.get(self.url).status_code, 403)
+        self.assertEqual(client.put(self.url, b"evil", content_type="application/octet-stream").status_code, 403)
+        self.assertEqual(client.delete(self.url).status_code, 403)
+        self.profile.refresh_from_db()
+        self.assertEqual(self.profile.read_voice(), b"0123456789")
+
+    def test_owner(self):
+        client = self.as_user(self.owner)
+        response = client.get(self.url, headers={"Range": "bytes=2-5"})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.content, b"2345")
+        self.assertEqual(client.put(self.url, b"new voice", content_type="application/octet-stream").status_code, 200)
+        self.assertEqual(client.get(self.url).content, b"new voice")
+        self.assertEqual(client.delete(self.url).status_code, 200)
+        self.assertEqual(client.get(self.url).status_code, 404)
+
+    def test_staff(self):
+        client = self.as_user(self.make_user("nurse", is_staff=True))
+        self.assertEqual(client.get(self.url).content, b"0123456789")
+        self.assertEqual(client.put(self.url, b"fixed", content_type="application/octet-stream").status_code, 200)
+        self.profile.refresh_from_db()
+        self.assertEqual(self.profile.read_voice(), b"fixed")
+
+
+class HistoryPaginationTests(ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = self.make_user("resident")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def add(self, *timestamps):
+        ids = []
+        for i, timestamp in enumerate(timestamps):
+            chat = ChatHistory.objects.create(user=self.user, message=f"message {i}", is_user_message=True)
+            ChatHistory.objects.filter(pk=chat.pk).update(timestamp=timestamp)  # auto_now_add
+            ids.append(chat.pk)
+        return ids
+
+    def walk(self, url):
+        # Follows "next" to the end; returns the ids seen, page by page
+        pages = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            pages.append([chat["id"] for chat in response.data["results"]])
+            url = response.data["next"]
+        return pages
+
+    def test_before_pages_back(self):
+        now = timezone.now()
+        ids = self.add(*(now - timedelta(minutes=10 - i) for i in range(7)))
+        pages = self.walk("/api/v1/chat-history/?page_size=3")
+        self.assertEqual(pages, [ids[:3:-1], ids[3:0:-1], ids[:1]])
+
+    def test_after_returns_newer(self):
+        now = timezone.now()
+        ids = self.add(*(now - timedelta(minutes=10 - i) for i in range(5)))
+        first = self.client.get("/api/v1/chat-history/?page_size=2").data
+        older = self.client.get(first["next"]).data
+        newer = self.client.get(older["previous"]).data
+        self.assertEqual([chat["id"] for chat in newer["results"]], ids[:2:-1])
+        # Polling the newest page's "previous" finds nothing new, and keeps the cursor
+        empty = self.client.get(first["previous"]).data
+        self.assertEqual(empty["results"], [])
+        self.assertEqual(empty["previous"], first["previous"])
+        later = self.add(now)
+        self.assertEqual([chat["id"] for chat in self.client.get(first["previous"]).data["results"]], later)
+
+    def test_equal_timestamps(self):
+        ids = self.add(*[timezone.now() - timedelta(minutes=1)] * 5)
+        pages = self.walk("/api/v1/chat-history/?page_size=2")
+        self.assertEqual(pages, [ids[:2:-1], ids[2:0:-1], ids[:1]])
+        cursor = self.client.get("/api/v1/chat-history/?page_size=2").data["next"]
+        newer = self.client.get(cursor.replace("before=", "after=")).data
+        self.assertEqual([chat["id"] for chat in newer["results"]], ids[:3:-1])
+
+    def test_falls_through_to_archive(self):
+        location = tempfile.mkdtemp(prefix="chat_archive_")
+        self.addCleanup(shutil.rmtree, location, ignore_errors=True)
+        now = timezone.now()
+        ids = self.add(*(now - timedelta(days=60, minutes=10 - i) for i in range(4)),
+                       now - timedelta(minutes=2), now - timedelta(minutes=1))
+        with override_settings(CHAT_ARCHIVE={'LOCATION': location, 'KEEP': 2}):
+            self.assertEqual(archive.archive(age_days=30, user_ids=[self.user.pk]), 4)
+            self.assertEqual(ChatHistory.objects.filter(user=self.user).count(), 2)
+            pages = self.walk("/api/v1/chat-history/?page_size=3")
+            self.assertEqual(pages, [ids[:2:-1], ids[2::-1]])
+            # And forwards, from the oldest archived message back into the table
+            last = self.client.get(self.client.get("/api/v1/chat-history/?page_size=5").data["next"]).data
+            self.assertEqual([chat["id"] for chat in last["results"]], ids[:1])
+            newer = self.client.get(last["previous"]).data
+            self.assertEqual([chat["id"] for chat in newer["results"]], ids[:0:-1])
+
+
+class SearchTests(ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = self.make_user("resident")
+        self.chat = ChatHistory.objects.create(user=self.user, message="The tulips are blooming", is_user_message=True)
+
+    def found(self, text, user=None):
+        return [chat.pk for chat in search.search(text, user=user)]
+
+    def test_saved_message_is_found(self):
+        self.assertEqual(self.found("tulips"), [self.chat.pk])
+        self.assertEqual(self.found("tul"), [self.chat.pk])  # prefix of the last word
+        self.assertEqual(self.found("tulips", user=self.user), [self.chat.pk])
+        self.assertEqual(self.found("tulips", user=self.make_user("neighbour")), [])
+
+    def test_edited_message_is_found(self):
+        self.chat.message = "The roses are blooming"
+        self.chat.save()
+        self.assertEqual(self.found("roses"), [self.chat.pk])
+        self.assertEqual(self.found("tulips"), [])
+        ChatHistory.objects.filter(pk=self.chat.pk).update(message="Daffodils today")
+        self.assertEqual(self.found("daffodils", user=self.user), [self.chat.pk])
+        self.assertEqual(self.found("roses"), [])
+
+    def test_deleted_message_is_not_found(self):
+        self.chat.delete()
+        self.assertEqual(self.found("tulips"), [])
+        self.assertEqual(self.found("tulips", user=self.user), [])
+
+
+class WeatherApiTests(ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.client.force_authenticate(self.make_user("resident"))
+
+    def test_units_whitelist(self):
+        data = {"temperature": 12, "city": "Leeds", "units": "metric"}
+        with mock.patch.object(weather, "get_weather", return_value=data) as get_weather:
+            response = self.client.get("/api/v1/weather/", {"lat": "53.8", "lon": "-1.55", "units": "metric"})
+            self.assertEqual(response.status_code, 200)
+            for units in ("kelvin", "", "metric:1"):
+                with self.subTest(units=units):
+                    response = self.client.get("/api/v1/weather/", {"lat": "53.8", "lon": "-1.55", "units": units})
+                    self.assertEqual(response.status_code, 400)
+        get_weather.assert_called_once_with(53.8, -1.55, "metric")
+
+
+class RateLimitTests(ChatTestCase):
+    PERIOD = 3600
+
+    def at(self, seconds):
+        # A clock that starts at the beginning of a window
+        return mock.patch("chat.ratelimit.time.time", return_value=self.PERIOD * 1000 + seconds)
+
+    def check_backend(self):
+        with self.at(0):
+            self.assertEqual([ratelimit.hit("test", "a", 3, self.PERIOD)[0] for _ in range(5)],
+                             [True, True, True, False, False])
+            self.assertEqual(ratelimit.get_backend().get("rl:test:a:1000"), 3)  # denials aren't counted
+            self.assertTrue(ratelimit.hit("test", "b", 3, self.PERIOD)[0])  # per ident
+        with self.at(self.PERIOD * 3 // 4):
+            self.assertEqual(ratelimit.hit("test", "a", 3, self.PERIOD), (False, self.PERIOD // 4 + 1))
+        # Three quarters into the next window the last one weighs 3 * 0.25,
+        # so two more fit; had the denials counted, none would
+        with self.at(self.PERIOD * 7 // 4):
+            self.assertEqual([ratelimit.hit("test", "a", 3, self.PERIOD)[0] for _ in range(3)],
+                             [True, True, False])
+
+    def test_cache_backend(self):
+        self.check_backend()
+
+    def test_file_backend(self):
+        location = tempfile.mkdtemp(prefix="chat_ratelimit_")
+        self.addCleanup(shutil.rmtree, location, ignore_errors=True)
+        with override_settings(RATELIMIT={'BACKEND': 'chat.ratelimit.FileBackend',
+                                          'OPTIONS': {'location': location}}):
+            ratelimit._backend = None
+            self.addCleanup(setattr, ratelimit, "_backend", None)
+            self.check_backend()
+
+    def test_too_many_requests(self):
+        with self.at(self.PERIOD // 2):
+            for _ in range(5):
+                self.assertEqual(self.client.post("/api/v1/auth/password_reset/", {}).status_code, 400)
+            response = self.client.post("/api/v1/auth/password_reset/", {})
+            self.assertEqual(response.status_code, 429)
+            self.assertEqual(response["Retry-After"], str(self.PERIOD // 2 + 1))
+            # Another client address has its own budget
+            response = self.client.post("/api/v1/auth/password_reset/", {}, REMOTE_ADDR="10.0.0.2")
+            self.assertEqual(response.status_code, 400)
+
+
+class ContextTests(ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = self.make_user("resident")
+
+    def say(self, message, is_user_message=True):
+        with self.captureOnCommitCallbacks(execute=True):
+            return ChatHistory.objects.create(user=self.user, message=message, is_user_message=is_user_message)
+
+    def test_append_writes_through(self):
+        self.say("hello")
+        self.assertEqual(context.recent_turns(self.user), [("hello", True)])
+        self.say("hi there", False)
+        with self.assertNumQueries(0):
+            self.assertEqual(context.recent_turns(self.user), [("hello", True), ("hi there", False)])
+
+    def test_racing_append_rebuilds_from_db(self):
+        self.say("hello")
+        context.recent_turns(self.user)
+        # Another worker's append has taken the next version but not written it yet
+        cache.incr(f"chat_context:{self.user.pk}:version")
+        self.say("still there?")
+        with self.assertNumQueries(1):
+            self.assertEqual(context.recent_turns(self.user), [("hello", True), ("still there?", True)])
+        with self.assertNumQueries(0):
+            context.recent_turns(self.user)
+
+    @override_settings(CHAT_CONTEXT={'WINDOW': 3})
+    def test_window(self):
+        for i in range(5):
+            self.say(f"message {i}")
+        self.assertEqual([turn.message for turn in context.recent_turns(self.user, 10)],
+                         ["message 2", "message 3", "message 4"])
+        self.assertEqual([turn.message for turn in context.recent_turns(self.user, 2)], ["message 3", "message 4"])
+        self.assertEqual(context.recent_turns(self.user, 0), [])
+        self.assertEqual(context.recent_turns(self.user, -1), [])
+
+    def test_edit_and_delete_invalidate(self):
+        chat = self.say("helo")
+        context.recent_turns(self.user)
+        chat.message = "hello"
+        with self.captureOnCommitCallbacks(execute=True):
+            chat.save()
+        self.assertEqual(context.recent_turns(self.user), [("hello", True)])
+        with self.captureOnCommitCallbacks(execute=True):
+            chat.delete()
+        self.assertEqual(context.recent_turns(self.user), [])
+
+
+@override_settings(CHAT_WRITE_BEHIND={'ENABLED': True, 'MAX_ATTEMPTS': 3})
+class WriteBehindTests(ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = self.make_user("resident")
+        # Flushed by hand, not by the background thread
+        patcher = mock.patch.object(writebehind, "_start_flusher")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(writebehind._pending.clear)
+
+    def test_flush_keeps_order(self):
+        for i in range(3):
+            writebehind.save_turn(self.user, f"message {i}", i % 2 == 0)
+        self.assertFalse(ChatHistory.objects.filter(user=self.user).exists())
+        self.assertEqual([chat.message for chat in writebehind.pending(self.user.pk)],
+                         ["message 0", "message 1", "message 2"])
+        self.assertEqual([turn.message for turn in context.recent_turns(self.user)],
+                         ["message 0", "message 1", "message 2"])
+        self.assertEqual(writebehind.flush(), 3)
+        self.assertEqual(writebehind.pending(self.user.pk), [])
+        self.assertEqual(list(ChatHistory.objects.filter(user=self.user).order_by('id')
+                              .values_list('message', 'is_user_message')),
+                         [("message 0", True), ("message 1", False), ("message 2", True)])
+
+    def test_retry_then_drop(self):
+        writebehind.save_turn(self.user, "first", True)
+        with mock.patch.object(ChatHistory.objects, "bulk_create", side_effect=OperationalError("locked")):
+            with self.assertLogs("chat.writebehind", "WARNING"):
+                self.assertEqual(writebehind.flush(), 0)
+            writebehind.save_turn(self.user, "second", True)
+            # A failed batch goes back in front of rows queued since
+            self.assertEqual([chat.message for chat in writebehind.pending(self.user.pk)], ["first", "second"])
+            with self.assertLogs("chat.writebehind", "WARNING"):
+                writebehind.flush()
+            with self.assertLogs("chat.writebehind", "ERROR") as logs:
+                writebehind.flush()
+        self.assertIn("Dropped 1 ChatHistory rows after 3 failed flushes", logs.output[0])
+        self.assertEqual([chat.message for chat in writebehind.pending(self.user.pk)], ["second"])
+        self.assertEqual(writebehind.flush(), 1)
+        self.assertEqual(list(ChatHistory.objects.values_list('message', flat=True)), ["second"])
+
+    def test_shutdown_stops_the_flusher(self):
+        stop = mock.patch.object(writebehind, "_stop", threading.Event())
+        stop.start()
+        self.addCleanup(stop.stop)
+        flusher = threading.Thread(target=writebehind._run_flusher, daemon=True)
+        flusher.start()
+        with mock.patch.object(writebehind, "_flusher", flusher), \
+                mock.patch.object(writebehind, "_flusher_pid", os.getpid()):
+            writebehind.save_turn(self.user, "bye", True)
+            writebehind._shutdown()
+        self.assertFalse(flusher.is_alive())
+        self.assertEqual(writebehind.pending(self.user.pk), [])
+        self.assertEqual(list(ChatHistory.objects.values_list('message', flat=True)), ["bye"])
+
+
+class RepliesTests(ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = self.make_user("resident")
+        replies._engines = None
+        self.addCleanup(setattr, replies, "_engines", None)
+
+    def test_canned_hit(self):
+        reply, engine = replies.lookup(self.user, "Good  morning!!")
+        self.assertEqual(engine, "canned")
+        self.assertIn(reply, replies.CANNED["good morning"])
+        # Never the same reply twice in a row
+        self.assertNotEqual(replies.lookup(self.user, "good morning")[0], reply)
+
+    def test_questions_and_long_messages_go_to_the_llm(self):
+        self.assertIsNone(replies.lookup(self.user, "hello?"))
+        self.assertIsNone(replies.lookup(self.user, "hello there my dear friend how are things"))
+
+    def test_recent_answer_hit(self):
+        answers = ["Bye! Talk soon.", "See you later!", "Take care, bye!"]
+        for answer in answers[:2]:
+            replies.remember(self.user, "Bye for now", answer)
+            self.assertIsNone(replies.lookup(self.user, "bye for now"))  # too few to vary between
+        replies.remember(self.user, "Bye for now", answers[2])
+        reply, engine = replies.lookup(self.user, "bye for now!")
+        self.assertEqual(engine, "recent")
+        self.assertIn(reply, answers[:2])  # not the one just given
+        self.assertNotEqual(replies.lookup(self.user, "bye for now")[0], reply)
+        self.assertIsNone(replies.lookup(self.make_user("neighbour"), "bye for now"))  # per user
+
+    def test_intent_gated_miss(self):
+        for message in ("I took my pills", "my hip hurts"):
+            with self.subTest(message=message):
+                for i in range(3):
+                    replies.remember(self.user, message, f"answer {i}")
+                self.assertIsNone(replies.lookup(self.user, message))
+
+    def test_stats(self):
+        replies.lookup(self.user, "hello")
+        replies.lookup(self.user, "my hip hurts")
+        self.assertEqual(replies.stats(), {"canned": 1, "recent": 0, "miss": 1, "hit_rate": 0.5})
+
+
+class UserProfileTests(ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = self.make_user("resident")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_etag(self):
+        ChatHistory.objects.create(user=self.user, message="hello", is_user_message=True)
+        response = self.client.get("/api/v1/user_profile/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([chat["message"] for chat in response.data["chat_history"]], ["hello"])
+        etag = response["ETag"]
+
+        response = self.client.get("/api/v1/user_profile/", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b"")
+        self.assertEqual(response["ETag"], etag)
+        response = self.client.get("/api/v1/user_profile/", headers={"If-None-Match": f'"other", {etag}'})
+        self.assertEqual(response.status_code, 304)
+
+        ChatHistory.objects.create(user=self.user, message="anyone there?", is_user_message=True)
+        response = self.client.get("/api/v1/user_profile/", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_etag_follows_the_profile(self):
+        etag = self.client.get("/api/v1/user_profile/")["ETag"]
+        UserProfile.objects.filter(user=self.user).update(preferred_name="Mrs R")
+        self.client.force_authenticate(User.objects.get(pk=self.user.pk))  # not the instance with the old profile cached
+        response = self.client.get("/api/v1/user_profile/", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["preferred_name"], "Mrs R")
+
+
+class ArchiveTests(ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        location = tempfile.mkdtemp(prefix="chat_archive_")
+        self.addCleanup(shutil.rmtree, location, ignore_errors=True)
+        archive_settings = override_settings(CHAT_ARCHIVE={'LOCATION': location, 'KEEP': 1})
+        archive_settings.enable()
+        self.addCleanup(archive_settings.disable)
+        self.user = self.make_user("resident")
+        now = timezone.now()
+        self.chats = []
+        for days in (200, 160, 120, 80, 0):  # a segment each
+            chat = ChatHistory.objects.create(user=self.user, message=f"{days} days ago", is_user_message=True)
+            ChatHistory.objects.filter(pk=chat.pk).update(timestamp=now - timedelta(days=days))
+            self.chats.append(chat)
+        self.assertEqual(archive.archive(age_days=30), 4)
+
+    def test_get_opens_one_segment(self):
+        months = archive._index(self.user.pk)
+        self.assertEqual(len(months), 4)
+        self.assertEqual(sorted(low for low, high in months.values()), [chat.pk for chat in self.chats[:4]])
+        with mock.patch.object(archive, "_load", wraps=archive._load) as load:
+            self.assertEqual(archive.get(self.user.pk, self.chats[1].pk).message, "160 days ago")
+            self.assertEqual(load.call_count, 1)
+            self.assertIsNone(archive.get(self.user.pk, self.chats[4].pk))  # still in the table
+            self.assertEqual(load.call_count, 1)
+
+    def test_segments_without_an_index(self):
+        os.remove(archive._index_path(self.user.pk))
+        self.assertEqual(archive.get(self.user.pk, self.chats[0].pk).message, "200 days ago")
+        archive.archive(age_days=30)  # indexes what's there
+        self.assertEqual(len(archive._index(self.user.pk)), 4)
+
+
+class PromptTests(SimpleTestCase):
+    def history(self, *messages):
+        return [context.Turn(message, i % 2 == 0) for i, message in enumerate(messages)]
+
+    def cost(self, message):
+        return prompts.count_tokens(message["content"]) + prompts.TOKENS_PER_MESSAGE
+
+    def test_system_prompt(self):
+        system, tokens = prompts.system_prompt("Leeds", "brevity")
+        self.assertIn("living in Leeds.", system["content"])
+        self.assertIn("with brevity.", system["content"])
+        self.assertNotIn("{", system["content"])
+        self.assertEqual(tokens, self.cost(system))
+        self.assertIn("an unspecified city", prompts.system_prompt(None, "brevity")[0]["content"])
+
+    @override_settings(CHAT_PROMPT={'HISTORY_TOKENS': 40, 'TURN_TOKENS': 10})
+    def test_history_budget(self):
+        history = self.history(*(f"this is message number {i} of the day" for i in range(20)))
+        prompt = prompts.build("Leeds", "brevity", history, "and another")
+        packed = prompt.messages[1:-1]
+        # The newest turns that fit, oldest first
+        self.assertEqual(prompt.turns, len(packed))
+        self.assertGreater(len(packed), 0)
+        self.assertEqual([m["content"] for m in packed], [turn.message for turn in history[-len(packed):]])
+        self.assertLessEqual(sum(map(self.cost, packed)), 40)
+        self.assertGreater(sum(map(self.cost, packed)) + self.cost({"content": history[-len(packed) - 1].message}), 40)
+        self.assertEqual(prompt.tokens, sum(map(self.cost, prompt.messages)) + prompts.TOKENS_PER_REPLY)
+
+    @override_settings(CHAT_PROMPT={'TURN_TOKENS': 10})
+    def test_long_turn_is_cut(self):
+        prompt = prompts.build("Leeds", "brevity", self.history("word " * 200), "hello")
+        content = prompt.messages[1]["content"]
+        self.assertTrue(content.endswith("…"))
+        self.assertLessEqual(prompts.count_tokens(content[:-1]), 10)
+
+    def test_current_message_sent_once(self):
+        prompt = prompts.build("Leeds", "brevity", self.history("hi", "hello!", "how are you"), "how are you")
+        self.assertEqual([m["content"] for m in prompt.messages[1:]], ["hi", "hello!", "how are you"])
+
+    @override_settings(CHAT_PROMPT={'MEMORY_TOKENS': 30})
+    def test_memories_and_temperature(self):
+        memories = [ChatHistory(message=f"I planted {flower} in the garden", is_user_message=True)
+                    for flower in ("tulips", "roses", "daffodils", "crocuses", "lilies")]
+        prompt = prompts.build("Leeds", "brevity", [], "hello", memories, temperature=54)
+        self.assertEqual(prompt.messages[1], {"role": "system", "content": "It's 54°F outside right now."})
+        recalled = prompt.messages[2]["content"].splitlines()[1:]
+        self.assertGreater(len(recalled), 0)
+        self.assertLess(len(recalled), len(memories))
+        self.assertEqual(recalled[0], "- They said: I planted tulips in the garden")
+        self.assertEqual(prompt.tokens, sum(map(self.cost, prompt.messages)) + prompts.TOKENS_PER_REPLY)
+
+
+class MemoryTests(ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        location = tempfile.mkdtemp(prefix="chat_memory_")
+        self.addCleanup(shutil.rmtree, location, ignore_errors=True)
+        memory_settings = override_settings(CHAT_MEMORY={'ENABLED': True, 'LOCATION': location})
+        memory_settings.enable()
+        self.addCleanup(memory_settings.disable)
+        # Deferred jobs run at once, through their JSON round trip
+        defer = mock.patch.object(jobs, "defer", side_effect=lambda task, *args: jobs._execute(task, json.dumps(args)))
+        self.defer = defer.start()
+        self.addCleanup(defer.stop)
+        self.user = self.make_user("resident")
+
+    def say(self, message):
+        with self.captureOnCommitCallbacks(execute=True):
+            return ChatHistory.objects.create(user=self.user, message=message, is_user_message=True)
+
+    def recalled(self, text):
+        return [chat.message for chat in memory.recall(self.user, text)]
+
+    def test_saved_turn_is_recalled_from_the_index(self):
+        chat = self.say("My granddaughter Lucy visits on Sunday")
+        self.say("The soup was too salty")
+        self.assertEqual(self.defer.call_args.args[0], "chat.tasks.index_memory")
+        with self.assertNumQueries(0):
+            found = memory.recall(self.user, "when does Lucy visit")
+        self.assertEqual([(c.pk, c.message, c.is_user_message) for c in found],
+                         [(chat.pk, chat.message, True)])
+        self.assertEqual(found[0].timestamp, ChatHistory.objects.get(pk=chat.pk).timestamp)
+        self.assertEqual(memory.recall(self.user, "when does Lucy visit", exclude=[chat.message]), [])
+
+    def test_edited_and_deleted_turns(self):
+        chat = self.say("My granddaughter Lucy visits on Sunday")
+        chat.message = "My granddaughter Lucy visits on Monday"
+        with self.captureOnCommitCallbacks(execute=True):
+            chat.save()
+        self.assertEqual(self.recalled("Lucy visits on"), ["My granddaughter Lucy visits on Monday"])
+        with self.captureOnCommitCallbacks(execute=True):
+            chat.delete()
+        self.assertEqual(self.recalled("Lucy visits on"), [])
+
+    def test_archived_turn_is_still_recalled(self):
+        chat = self.say("My granddaughter Lucy visits on Sunday")
+        ChatHistory.objects.filter(pk=chat.pk).update(timestamp=timezone.now() - timedelta(days=400))
+        self.say("The soup was too salty")
+        location = tempfile.mkdtemp(prefix="chat_archive_")
+        self.addCleanup(shutil.rmtree, location, ignore_errors=True)
+        with override_settings(CHAT_ARCHIVE={'LOCATION': location, 'KEEP': 1}):
+            self.assertEqual(archive.archive(), 1)
+            with mock.patch.object(archive, "get") as get:
+                self.assertEqual(self.recalled("Lucy visits"), [chat.message])
+            get.assert_not_called()
+            self.assertEqual(memory.rebuild(self.user.pk), 2)
+            self.assertEqual(self.recalled("Lucy visits"), [chat.message])
+
+
+class FanoutTests(SimpleTestCase):
+    def test_stage_past_its_deadline(self):
+        release = threading.Event()
+        lookups = Fanout().start("slow", lambda: release.wait(5) and "answer", deadline=0.05, fallback="fallback")
+        self.assertEqual(lookups.result("slow"), "fallback")
+        self.assertEqual(lookups.timings["slow"][1], "timeout")
+        release.set()
+        lookups.stages["slow"][0].result(timeout=5)
+        # Asked again, the answer that arrived since is used
+        self.assertEqual(lookups.result("slow"), "answer")
+        self.assertEqual(lookups.timings["slow"][1], "late")
+
+    def test_results_are_memoized(self):
+        def fail():
+            raise ValueError("no")
+        lookups = Fanout().start("ok", lambda: "value", deadline=1).start("bad", fail, deadline=1, fallback=0)
+        self.assertEqual(lookups.result("ok"), "value")
+        with self.assertLogs("chat.fanout", "WARNING"):
+            self.assertEqual(lookups.result("bad"), 0)
+        timings = dict(lookups.timings)
+        with self.assertNoLogs("chat.fanout", "WARNING"):
+            self.assertEqual((lookups.result("ok"), lookups.result("bad")), ("value", 0))
+        self.assertEqual(lookups.timings, timings)
+
+    def test_unexpected_errors_propagate(self):
+        def fail():
+            raise KeyError("bug")
+        lookups = Fanout().start("bad", fail, deadline=1, errors=(ValueError,))
+        with self.assertRaises(KeyError):
+            lookups.result("bad")
+
+    def test_server_timing(self):
+        lookups = Fanout().start("a", lambda: 1, deadline=1).start("b", time.sleep, 1, deadline=0.01)
+        lookups.result("a")
+        lookups.result("b")
+        self.assertRegex(lookups.server_timing(),
+                         r'^a;dur=[0-9.]+;desc="ok", b;dur=[0-9.]+;desc="timeout"$')
+
+
+class TalkPageTests(FakeOpenAITestCase):
+    def setUp(self):
+        super().setUp()
+        defer = mock.patch.object(jobs, "defer")  # the reply is saved by a job; not here
+        defer.start()
+        self.addCleanup(defer.stop)
+
+    def test_csrf_exempt_and_server_timing(self):
+        def slow_weather(*args):
+            time.sleep(1)
+            return {"temperature": 60, "city": "Leeds", "units": "imperial"}
+        client = Client(enforce_csrf_checks=True)
+        with mock.patch.object(weather, "get_weather", side_effect=slow_weather):
+            response = client.post("/chat/", {"message": self.MESSAGE, "my_lat": "53.8", "my_lon": "-1.55"})
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, FakeOpenAI.reply)
+        timing = response["Server-Timing"]
+        self.assertRegex(timing, r'weather;dur=[0-9.]+;desc="timeout"')  # past its deadline; the page went on
+        self.assertRegex(timing, r'context;dur=[0-9.]+;desc="\w+"')
+
+
+class MetricsAccessTests(ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        location = tempfile.mkdtemp(prefix="chat_metrics_")
+        self.addCleanup(shutil.rmtree, location, ignore_errors=True)
+        self.options = {'ENABLED': False, 'LOCATION': location, 'TOKEN': "s3cret"}
+        metrics_settings = override_settings(CHAT_METRICS=self.options)
+        metrics_settings.enable()
+        self.addCleanup(metrics_settings.disable)
+
+    def test_localhost_is_not_enough(self):
+        # The test client's REMOTE_ADDR, and a reverse proxy's
+        self.assertEqual(self.client.get("/metrics", REMOTE_ADDR="127.0.0.1").status_code, 403)
+        self.client.force_login(self.make_user("resident"))
+        self.assertEqual(self.client.get("/metrics").status_code, 403)
+
+    def test_staff(self):
+        self.client.force_login(self.make_user("nurse", is_staff=True))
+        response = self.client.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["Content-Type"].startswith("text/plain"))
+
+    def test_bearer_token(self):
+        self.assertEqual(self.client.get("/metrics", headers={"Authorization": "Bearer s3cret"}).status_code, 200)
+        self.assertEqual(self.client.get("/metrics", headers={"Authorization": "Bearer guess"}).status_code, 403)
+        self.assertEqual(self.client.get("/metrics", headers={"Authorization": "s3cret"}).status_code, 403)
+        with override_settings(CHAT_METRICS={**self.options, 'TOKEN': None}):
+            self.assertEqual(self.client.get("/metrics", headers={"Authorization": "Bearer "}).status_code, 403)
+
+    def test_allowed_ips_opt_in(self):
+        with override_settings(CHAT_METRICS={**self.options, 'ALLOWED_IPS': ["10.0.0.5"]}):
+            self.assertEqual(self.client.get("/metrics", REMOTE_ADDR="10.0.0.5").status_code, 200)
+            self.assertEqual(self.client.get("/metrics", REMOTE_ADDR="10.0.0.6").status_code, 403)
+
+
+class SpeakerIndexTests(SimpleTestCase):
+    def test_decode(self):
+        np.testing.assert_allclose(speakers.decode(speakers.encode([3, 0, 4, 0]), dim=4), [0.6, 0, 0.8, 0])
+        for data in (None, b"", speakers.encode([1, 0, 0]), speakers.encode([1, 0, 0, 0, 0]),
+                     speakers.encode([0, 0, 0, 0]), speakers.encode([float("nan"), 0, 0, 1]),
+                     speakers.encode([float("inf"), 0, 0, 1])):
+            with self.subTest(data=data):
+                with self.assertRaises(ValueError):
+                    speakers.decode(data, dim=4)
+
+    def test_upsert_and_remove(self):
+        index = speakers.SpeakerIndex(dim=2, capacity=2)
+        for user_id, vector in ((10, [1, 0]), (20, [0, 1]), (30, [-1, 0])):
+            index.upsert(user_id, vector)
+        self.assertEqual((len(index), len(index.user_ids)), (3, 4))  # grew
+        index.upsert(20, [0, -1])  # in place
+        self.assertEqual(index.rows, {10: 0, 20: 1, 30: 2})
+
+        index.remove(10)  # the last row moves into its place
+        self.assertEqual(index.rows, {30: 0, 20: 1})
+        self.assertEqual(index.user_ids[:len(index)].tolist(), [30, 20])
+        index.remove(99)
+        self.assertEqual(len(index), 2)
+        user_ids, scores = index.search(np.array([[-1, 0], [0, -1]], dtype=np.float32), k=2)
+        self.assertEqual(user_ids.tolist(), [[30, 20], [20, 30]])
+        self.assertEqual(scores[:, 0].tolist(), [1.0, 1.0])
+
+        index.remove(30)
+        index.remove(20)
+        self.assertEqual(index.search(np.array([[1, 0]], dtype=np.float32), k=2)[0].shape, (1, 0))
+
+
+@override_settings(CHAT_SPEAKERS={'DIM': 4, 'REFRESH': 60})
+class SpeakersTests(ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        location = tempfile.mkdtemp(prefix="chat_blobs_")
+        self.addCleanup(shutil.rmtree, location, ignore_errors=True)
+        blob_settings = override_settings(CHAT_BLOBS={'LOCATION': location})
+        blob_settings.enable()
+        self.addCleanup(blob_settings.disable)
+        blobs._store = None
+        self.addCleanup(setattr, blobs, "_store", None)
+        for name in ("_index", "_version"):
+            setattr(speakers, name, None)
+            self.addCleanup(setattr, speakers, name, None)
+
+        self.alice = self.make_user("alice")
+        self.bob = self.make_user("bob")
+        self.set_voice(self.alice, [1, 0, 0, 0])
+        self.set_voice(self.bob, [0, 1, 0, 0])
+
+    def set_voice(self, user, vector):
+        profile = UserProfile.objects.get(user=user)
+        profile.set_voice(speakers.encode(vector))
+        with self.captureOnCommitCallbacks(execute=True):
+            profile.save(update_fields=['voice_key', 'voice_profile'])
+
+    def test_identify(self):
+        user_id, score = speakers.identify([0.9, 0.1, 0, 0])
+        self.assertEqual(user_id, self.alice.pk)
+        self.assertGreater(score, 0.9)
+        self.assertIsNone(speakers.identify([0, 0, 1, 0]))  # below MIN_SCORE
+        self.assertIsNone(speakers.identify([1, 0.95, 0, 0]))  # within MARGIN of the runner-up
+        self.assertEqual(speakers.identify_many([[0, 1, 0, 0], speakers.encode([1, 0, 0, 0])], k=1),
+                         [[(self.bob.pk, 1.0)], [(self.alice.pk, 1.0)]])
+
+    def test_suspended_and_deleted_profiles_drop_out(self):
+        speakers.get_index()
+        profile = self.alice.profile
+        profile.account_status = UserProfile.ACCOUNT_SUSPENDED
+        with self.captureOnCommitCallbacks(execute=True):
+            profile.save()
+        self.assertIsNone(speakers.identify([1, 0, 0, 0]))
+        with self.captureOnCommitCallbacks(execute=True):
+            UserProfile.objects.get(user=self.bob).delete()
+        self.assertEqual(len(speakers.get_index()), 0)
+
+    def test_version_counter(self):
+        index = speakers.get_index()
+        # A save in this process updates the index in place
+        self.set_voice(self.alice, [0, 0, 1, 0])
+        self.assertIs(speakers.get_index(), index)
+        self.assertEqual(speakers.identify([0, 0, 1, 0])[0], self.alice.pk)
+
+        # Another process's save only bumps the version...
+        profile = UserProfile.objects.get(user=self.bob)
+        profile.set_voice(speakers.encode([0, 0, 0, 1]))
+        UserProfile.objects.filter(pk=profile.pk).update(voice_key=profile.voice_key)
+        cache.incr(speakers.VERSION_KEY)
+        # ...which this one picks up once REFRESH has passed since its last build
+        self.assertIs(speakers.get_index(), index)
+        with mock.patch.object(speakers, "_loaded_at", speakers._loaded_at - 60):
+            self.assertIsNot(speakers.get_index(), index)
+        self.assertEqual(speakers.identify([0, 0, 0, 1])[0], self.bob.pk)
+
+
+class CachedJWTAuthenticationTests(ChatTestCase):
+    URL = "/api/v1/chat-history/"
+
+    def setUp(self):
+        super().setUp()
+        self.user = self.make_user("resident")
+        self.token = str(AccessToken.for_user(self.user))
+
+    def get(self, token=None):
+        return APIClient().get(self.URL, headers={"Authorization": f"Bearer {token or self.token}"})
+
+    def save(self, instance, **kwargs):
+        with self.captureOnCommitCallbacks(execute=True):
+            instance.save(**kwargs)
+
+    def test_password_change_ends_old_tokens(self):
+        self.assertEqual(self.get().status_code, 200)  # cached now
+        self.user.set_password("new password")
+        self.save(self.user)
+        self.assertEqual(self.get().status_code, 401)
+        self.assertEqual(self.get(str(AccessToken.for_user(self.user))).status_code, 200)
+
+    def test_new_token_refetches_a_stale_entry(self):
+        self.assertEqual(self.get().status_code, 200)
+        user = User.objects.get(pk=self.user.pk)
+        user.set_password("new password")
+        User.objects.filter(pk=user.pk).update(password=user.password)  # no signal: the entry stays
+        # A token issued since doesn't match the cached version, so the entry is refetched
+        self.assertEqual(self.get(str(AccessToken.for_user(user))).status_code, 200)
+        self.assertEqual(self.get().status_code, 401)
+
+    def test_deactivation_and_deletion_take_effect_at_once(self):
+        self.assertEqual(self.get().status_code, 200)
+        self.user.is_active = False
+        self.save(self.user)
+        self.assertEqual(self.get().status_code, 401)
+        self.user.is_active = True
+        self.save(self.user)
+        self.assertEqual(self.get().status_code, 200)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.delete()
+        self.assertEqual(self.get().status_code, 401)
+
+    def test_cached_user_matches_the_database(self):
+        self.user.is_staff = True
+        self.save(self.user)
+        UserProfile.objects.filter(user=self.user).update(city="Leeds")
+        auth.invalidate(self.user.pk)
+        auth.resolve(self.user.pk)
+        with self.assertNumQueries(0):
+            cached = auth.resolve(self.user.pk)
+            self.assertEqual(cached._token_version, auth.resolve(self.user.pk)._token_version)
+        loaded = User.objects.select_related('profile').get(pk=self.user.pk)
+        self.assertEqual((cached.pk, cached.username, cached.is_staff, cached.is_active),
+                         (loaded.pk, loaded.username, loaded.is_staff, loaded.is_active))
+        with self.assertNumQueries(0):
+            profile = cached.profile
+            self.assertEqual((profile.pk, profile.user_id, profile.account_status, profile.preferred_name, profile.city),
+                             (loaded.profile.pk, loaded.pk, loaded.profile.account_status,
+                              loaded.profile.preferred_name, "Leeds"))
+            self.assertIs(profile.user, cached)
+        self.assertEqual(profile.phone_number, loaded.profile.phone_number)  # deferred; loads on access
+
+    def test_cache_miss_falls_back_to_the_database(self):
+        auth.resolve(self.user.pk)
+        cache.clear()
+        with self.assertNumQueries(1):
+            self.assertEqual(auth.resolve(self.user.pk).username, "resident")
+        with self.assertRaises(AuthenticationFailed):
+            auth.resolve(self.user.pk + 1000)
+        # No profile behaves as for a user from the database, without the query
+        user = auth.resolve(User.objects.create_user("no_profile").pk)
+        with self.assertNumQueries(0), self.assertRaises(UserProfile.DoesNotExist):
+            user.profile
+
+
+@override_settings(CHAT_TOKENS={'BACKEND': 'chat.tokens.DatabaseStore', 'PURGE_EVERY': 10 ** 9})
+class DatabaseTokenStoreTests(ChatTestCase):
+    REFRESH = "/api/v1/auth/token/refresh/"
+    REVOKE = "/api/v1/auth/token/revoke/"
+
+    def setUp(self):
+        super().setUp()
+        tokens._store = None
+        self.addCleanup(setattr, tokens, "_store", None)
+        self.user = self.make_user("resident")
+        self.client = APIClient()
+
+    def post(self, url, token):
+        return self.client.post(url, {"refresh": token}, format="json")
+
+    def test_revoked_token_cannot_refresh(self):
+        token = str(RefreshToken.for_user(self.user))
+        self.assertEqual(self.post(self.REVOKE, token).status_code, 200)
+        self.assertEqual(self.post(self.REFRESH, token).status_code, 401)
+        self.assertEqual(self.post(self.REVOKE, token).status_code, 401)
+
+    def test_rotation_revokes_the_old_token(self):
+        old = RefreshToken.for_user(self.user)
+        response = self.post(self.REFRESH, str(old))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(tokens.is_revoked(old))
+        self.assertEqual(self.post(self.REFRESH, str(old)).status_code, 401)
+        self.assertEqual(self.post(self.REFRESH, response.json()["refresh"]).status_code, 200)
+
+    def test_revoke_reports_a_second_revocation(self):
+        token = RefreshToken.for_user(self.user)
+        self.assertTrue(tokens.revoke(token))
+        self.assertFalse(tokens.revoke(token))
+
+    def test_purge_drops_expired(self):
+        live, expired = RefreshToken.for_user(self.user), RefreshToken.for_user(self.user)
+        tokens.revoke(live)
+        tokens.store().revoke(expired[api_settings.JTI_CLAIM], time.time() - 1)
+        self.assertEqual(RevokedToken.objects.count(), 2)
+        self.assertEqual(tokens.purge(), 1)
+        self.assertTrue(tokens.is_revoked(live))
+        self.assertFalse(tokens.is_revoked(expired))
+
+    def test_purge_in_batches(self):
+        past = time.time() - 1
+        RevokedToken.objects.bulk_create([RevokedToken(jti=bytes([i]) * 16, expires=past) for i in range(5)])
+        store = tokens.DatabaseStore(tokens._options(), batch=2)
+        self.assertEqual(store.purge(), 5)
+        self.assertFalse(RevokedToken.objects.exists())
+
+
+@override_settings(CHAT_TOKENS={'BACKEND': 'chat.tokens.CacheStore', 'OPTIONS': {'alias': 'default'}})
+class CacheTokenStoreTests(DatabaseTokenStoreTests):
+    def test_revoked_token_cannot_refresh(self):
+        super().test_revoked_token_cannot_refresh()
+        self.assertFalse(RevokedToken.objects.exists())
+
+    def test_purge_drops_expired(self):
+        live, expired = RefreshToken.for_user(self.user), RefreshToken.for_user(self.user)
+        tokens.revoke(live)
+        self.assertTrue(tokens.store().revoke(expired[api_settings.JTI_CLAIM], time.time() - 1))
+        self.assertEqual(tokens.purge(), 0)  # keys expire by themselves
+        self.assertTrue(tokens.is_revoked(live))
+        self.assertFalse(tokens.is_revoked(expired))
+
+
+class OnboardingTests(ChatTestCase):
+    URL = "/api/v1/residents/import/"
+    HEADER = "username,preferred_name,password,phone_number,region\n"
+
+    def setUp(self):
+        super().setUp()
+        self.admin = User.objects.create_user("admin", password="pw", is_staff=True)
+
+    def run_import(self, text, format="csv", **kwargs):
+        return onboarding.import_residents(onboarding.read_rows(io.StringIO(text, newline=""), format),
+                                           workers=1, **kwargs)
+
+    def test_imports_rows(self):
+        result = self.run_import(self.HEADER + "ann,Ann,secret,,\nbob,Bob,,,\n")
+        self.assertEqual((result["rows"], result["created"], result["errors"]), (2, 2, []))
+        ann = User.objects.get(username="ann")
+        self.assertTrue(ann.check_password("secret"))
+        self.assertEqual(ann.profile.preferred_name, "Ann")
+        self.assertFalse(User.objects.get(username="bob").has_usable_password())
+
+    def test_bad_rows_are_reported_and_skipped(self):
+        text = '{"username": "ann", "preferred_name": "Ann"}\n[1, 2]\nnot json\n{"username": "bob"}\n'
+        result = self.run_import(text, format="jsonl")
+        self.assertEqual((result["rows"], result["created"]), (4, 1))
+        self.assertEqual([(e["row"], list(e["errors"])) for e in result["errors"]],
+                         [(2, ["__all__"]), (3, ["__all__"]), (4, ["preferred_name"])])
+        self.assertEqual(result["errors"][2]["username"], "bob")
+        self.assertEqual(list(User.objects.exclude(pk=self.admin.pk).values_list("username", flat=True)), ["ann"])
+
+    def test_duplicate_usernames(self):
+        self.make_user("carol")
+        result = self.run_import(self.HEADER + "ann,Ann,,,\ncarol,Carol,,,\nann,Ann again,,,\n")
+        self.assertEqual(result["created"], 1)
+        self.assertEqual([(e["row"], e["username"], e["errors"]) for e in result["errors"]],
+                         [(3, "carol", {"username": ["Username already exists."]}),
+                          (4, "ann", {"username": ["Appears earlier in this file."]})])
+        self.assertEqual(User.objects.get(username="ann").profile.preferred_name, "Ann")
+
+    def test_duplicate_across_chunks(self):
+        result = self.run_import(self.HEADER + "ann,Ann,,,\nbob,Bob,,,\nann,Ann,,,\n", chunk=2)
+        self.assertEqual(result["created"], 2)
+        self.assertEqual([e["row"] for e in result["errors"]], [4])
+
+    def test_phone_normalization(self):
+        result = self.run_import(self.HEADER + "ann,Ann,,(617) 555-0123,\nbob,Bob,,020 7946 0958,GB\n"
+                                 "carol,Carol,,+44 20 7946 0958,\ndave,Dave,,12345,\n")
+        self.assertEqual(result["created"], 3)
+        self.assertEqual([(e["username"], e["errors"]) for e in result["errors"]],
+                         [("dave", {"phone_number": ["Invalid phone number format."]})])
+        phones = dict(UserProfile.objects.values_list("user__username", "phone_number"))
+        self.assertEqual(phones, {"ann": "+16175550123", "bob": "+442079460958", "carol": "+442079460958"})
+        self.assertEqual(onboarding.normalize_phone("020 7946 0958", region="gb"), "+442079460958")
+        self.assertIsNone(onboarding.normalize_phone("020 7946 0958"))  # not a US number
+
+    def test_dry_run_creates_nothing(self):
+        self.make_user("carol")
+        result = self.run_import(self.HEADER + "ann,Ann,secret,,\ncarol,Carol,,,\nbob,,,,\n", dry_run=True)
+        self.assertEqual(result["created"], 1)
+        self.assertEqual([e["username"] for e in result["errors"]], ["carol", "bob"])
+        self.assertFalse(User.objects.filter(username="ann").exists())
+
+    def test_api_hashes_in_process(self):
+        client = APIClient()
+        client.force_authenticate(self.admin)
+        with mock.patch.object(onboarding, "ProcessPoolExecutor") as pool, self.assertLogs("chat.views", "INFO"):
+            response = client.post(self.URL + "?type=csv", self.HEADER + "ann,Ann,secret,,\nann,Ann,,,\n",
+                                   content_type="text/csv")
+            dry = client.post(self.URL + "?dry_run=1", self.HEADER + "bob,Bob,secret,,\n", content_type="text/csv")
+        pool.assert_not_called()
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual((response.json()["created"], len(response.json()["errors"])), (1, 1))
+        self.assertTrue(User.objects.get(username="ann").check_password("secret"))
+        self.assertEqual((dry.status_code, dry.json()["created"]), (200, 1))
+        self.assertFalse(User.objects.filter(username="bob").exists())
+
+    def test_api_requires_staff(self):
+        client = APIClient()
+        client.force_authenticate(self.make_user("resident"))
+        self.assertEqual(client.post(self.URL, self.HEADER, content_type="text/csv").status_code, 403)
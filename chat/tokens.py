@@ -0,0 +1,139 @@
+import hashlib
+import math
+import random
+import time
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection
+from django.utils.module_loading import import_string
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import RefreshToken
+from . import jobs
+from .models import RevokedToken
+
+# Revoked refresh tokens, standing in for simplejwt's token_blacklist app: a
+# token is revoked when it is rotated (BLACKLIST_AFTER_ROTATION) or handed to
+# the revoke endpoint, and remembered only until it would have expired
+# anyway. Nothing is recorded for tokens merely issued. Lookups are by a
+# 16-byte digest of the token's jti.
+DEFAULTS = {
+    'BACKEND': 'chat.tokens.DatabaseStore',
+    'OPTIONS': {},
+    'PURGE_EVERY': 1000,  # DatabaseStore: revocations between purges of expired rows, on average
+}
+
+_store = None
+
+
+def _options():
+    return {**DEFAULTS, **getattr(settings, 'CHAT_TOKENS', {})}
+
+
+def _digest(jti):
+    return hashlib.blake2b(str(jti).encode(), digest_size=16).digest()
+
+
+class CacheStore:
+    '''
+    One cache key per revoked token, expiring with it. Only safe on a cache
+    that never evicts live keys early (Redis without an LRU maxmemory policy);
+    Django's file and locmem caches cull, which would un-revoke tokens.
+    '''
+
+    def __init__(self, options, alias='default'):
+        self.cache = caches[alias]
+
+    def _key(self, jti):
+        return f"jwt_revoked:{_digest(jti).hex()}"
+
+    def revoke(self, jti, expires):
+        ttl = math.ceil(expires - time.time())
+        return ttl <= 0 or self.cache.add(self._key(jti), 1, timeout=ttl)
+
+    def is_revoked(self, jti):
+        return self.cache.get(self._key(jti)) is not None
+
+    def purge(self):
+        return 0  # keys expire by themselves
+
+
+class DatabaseStore:
+    '''
+    The RevokedToken table: digest primary key, expiry index. Expired rows
+    are deleted by a deferred job every PURGE_EVERY revocations or so.
+    '''
+
+    def __init__(self, options, batch=10000):
+        self.purge_every = options['PURGE_EVERY']
+        self.batch = batch
+
+    def revoke(self, jti, expires):
+        # Raw for ON CONFLICT DO NOTHING: the rowcount says whether this call
+        # revoked it, which bulk_create(ignore_conflicts=True) doesn't
+        with connection.cursor() as cursor:
+            cursor.execute(f"INSERT INTO {RevokedToken._meta.db_table} (jti, expires) VALUES (%s, %s) "
+                           f"ON CONFLICT (jti) DO NOTHING", [_digest(jti), expires])
+            inserted = cursor.rowcount == 1
+        if random.random() * self.purge_every < 1:
+            jobs.defer('chat.tokens.purge')
+        return inserted
+
+    def is_revoked(self, jti):
+        return RevokedToken.objects.filter(jti=_digest(jti)).exists()
+
+    def purge(self):
+        deleted = 0
+        while True:
+            expired = RevokedToken.objects.filter(expires__lte=time.time()).values('jti')[:self.batch]
+            count, _ = RevokedToken.objects.filter(jti__in=expired).delete()
+            deleted += count
+            if count < self.batch:
+                return deleted
+
+
+def store():
+    '''
+    The configured backend (CHAT_TOKENS['BACKEND']).
+    '''
+    global _store
+    if _store is None:
+        options = _options()
+        _store = import_string(options['BACKEND'])(options, **options['OPTIONS'])
+    return _store
+
+
+def revoke(token):
+    '''
+    Revoke a refresh token until it expires. False if it already was.
+    '''
+    return store().revoke(token[api_settings.JTI_CLAIM], token['exp'])
+
+
+def is_revoked(token):
+    return store().is_revoked(token[api_settings.JTI_CLAIM])
+
+
+def purge():
+    '''
+    Forget revoked tokens that have expired. Returns how many.
+    '''
+    return store().purge()
+
+
+class RevocableRefreshToken(RefreshToken):
+    '''
+    RefreshToken checked against the revocation store when decoded; its
+    blacklist() (called on rotation and by the revoke endpoint) revokes it.
+    '''
+
+    def verify(self, *args, **kwargs):
+        super().verify(*args, **kwargs)
+        if is_revoked(self):
+            raise TokenError(_("Token is blacklisted"))
+
+    def blacklist(self):
+        # The insert is the check too: of two concurrent uses, one loses
+        if not revoke(self):
+            raise TokenError(_("Token is blacklisted"))
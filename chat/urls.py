@@ -1,10 +1,11 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import UserViewSet, UserProfileViewSet, ChatHistoryViewSet, talk, talk_api, weather_api, user_profile, RegisterView, PasswordResetView, PasswordChangeView, SecurityAnswerView
+from .views import UserViewSet, UserProfileViewSet, ChatHistoryViewSet, talk, talk_api, talk_api_async, breaker_stats, reply_stats, weather_api, weather_stats, user_profile, RegisterView, PasswordResetView, PasswordChangeView, SecurityAnswerView, ResidentImportView
+from .metrics import metrics_view
 from drf_yasg.views import get_schema_view
 from drf_yasg import openapi
 from rest_framework import permissions
-from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
+from rest_framework_simplejwt.views import TokenBlacklistView, TokenObtainPairView, TokenRefreshView
 
 # Swagger setup
 schema_view = get_schema_view(
@@ -30,8 +31,14 @@ urlpatterns = [
     path('chat/', talk, name='chat'),
     # APIs
     path('api/v1/talk/', talk_api, name='talk_api'),
+    path('api/v1/talk/async/', talk_api_async, name='talk_api_async'),
+    path('api/v1/talk/stats/', reply_stats, name='reply_stats'),
     path('api/v1/weather/', weather_api, name='weather_api'),
+    path('api/v1/weather/stats/', weather_stats, name='weather_stats'),
+    path('api/v1/breakers/', breaker_stats, name='breaker_stats'),
+    path('metrics', metrics_view, name='metrics'),
     path('api/v1/user_profile/', user_profile, name='user_profile'),
+    path('api/v1/residents/import/', ResidentImportView.as_view(), name='resident_import'),
     path('api/v1/', include(router.urls)),
     # JWT authentication
     path('api/v1/auth/register/', RegisterView.as_view(), name='register'),  # New
@@ -45,6 +52,8 @@ urlpatterns = [
          name='token_obtain_pair'),
     path('api/v1/auth/token/refresh/',
          TokenRefreshView.as_view(), name='token_refresh'),
+    path('api/v1/auth/token/revoke/',
+         TokenBlacklistView.as_view(), name='token_revoke'),
     # Swagger
     path('swagger/', schema_view.with_ui('swagger',
          cache_timeout=0), name='schema-swagger-ui'),
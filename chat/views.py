@@ -1,26 +1,70 @@
+import hashlib
+import io
 import json
+import logging
 from django.shortcuts import render
-from django.http import JsonResponse
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.cache import never_cache
-from django.core.cache import cache
+from django.views.decorators.http import require_POST
 from django.core.exceptions import ObjectDoesNotExist
+from django.db.models import BooleanField, ExpressionWrapper, Q
+from django.utils.http import parse_etags, quote_etag
 from rest_framework import viewsets
 from rest_framework.response import Response
 from rest_framework import status
-from rest_framework.permissions import IsAuthenticated
-from rest_framework.decorators import api_view, permission_classes
+from rest_framework.permissions import BasePermission, IsAuthenticated, IsAdminUser
+from rest_framework.decorators import action, api_view, permission_classes, renderer_classes
+from rest_framework.renderers import BaseRenderer, JSONRenderer, BrowsableAPIRenderer
 from rest_framework.views import APIView
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.exceptions import InvalidToken
+from asgiref.sync import sync_to_async
 from .models import User, UserProfile, ChatHistory
+from .auth import CachedJWTAuthentication
 from .serializers import UserSerializer, \
     UserProfileSerializer, UserProfileCreateSerializer, \
-    ChatHistorySerializer, RegisterSerializer, PasswordChangeSerializer, \
-    PasswordResetSerializer, SecurityAnswerSerializer
-from openai import OpenAI, OpenAIError, APIConnectionError, RateLimitError
-import requests
-from . import config
+    ChatHistorySerializer, ChatHistorySearchSerializer, RegisterSerializer, \
+    PasswordChangeSerializer, PasswordResetSerializer, SecurityAnswerSerializer
+from openai import OpenAIError, APIConnectionError, RateLimitError
+from . import archive
+from . import blobs
+from . import breaker
+from . import context
+from . import jobs
+from .fanout import Fanout
+from . import llm
+from . import memory
+from . import onboarding
+from . import prompt as prompts
+from . import replies
+from . import search as history_search
+from . import weather
+from . import writebehind
+from .ratelimit import ratelimit, hit, too_many
+from .pagination import ChatHistoryCursorPagination
 from . import message_analyst as ma
 
+logger = logging.getLogger(__name__)
+
+
+TALK_QUOTA = (120, 3600)  # LLM replies per user per hour
+HISTORY_TURNS = 20  # offered to the prompt builder, which keeps what fits its token budget
+# Answered without calling OpenAI while its circuit breaker is open
+BUSY_REPLY = "I'm having a little trouble thinking right now. Let's talk again in a few minutes!"
+# Seconds (from the start of the lookups) the talk page's LLM call waits for
+# each; a cached forecast or context window is back in a few milliseconds
+TALK_DEADLINES = {"weather": 0.1, "context": 0.25}
+
+
+class IsOwnerOrStaff(BasePermission):
+    '''
+    Object-level: the object's user (obj.user_id) or a staff member.
+    '''
+
+    def has_object_permission(self, request, view, obj):
+        return request.user.is_staff or obj.user_id == request.user.pk
+
 
 class UserViewSet(viewsets.ModelViewSet):
     queryset = User.objects.all()
@@ -28,8 +72,35 @@ class UserViewSet(viewsets.ModelViewSet):
     # permission_classes = [IsAuthenticated]
 
 
+def _byte_range(header, size):
+    '''
+    (start, end) (end exclusive) for a single-range "bytes=a-b", "bytes=a-" or
+    "bytes=-n" header; None if there is no usable one (send everything).
+    Raises ValueError if the range lies past the end.
+    '''
+    unit, _, spec = (header or "").partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        return None
+    first, dash, last = spec.strip().partition("-")
+    if not dash or not (first + last).isdigit():
+        return None
+    if not first:  # the last n bytes
+        if not int(last):
+            raise ValueError(header)
+        return max(0, size - int(last)), size
+    start, end = int(first), int(last) + 1 if last else size
+    if start >= size:
+        raise ValueError(header)
+    if end <= start:
+        return None
+    return start, min(end, size)
+
+
 class UserProfileViewSet(viewsets.ModelViewSet):
-    queryset = UserProfile.objects.all()
+    # voice_profile itself is deferred by the manager; the flag says whether
+    # a row still has legacy inline data without reading it
+    queryset = UserProfile.objects.select_related('user').annotate(
+        has_inline_voice=ExpressionWrapper(Q(voice_profile__isnull=False), output_field=BooleanField()))
     # permission_classes = [IsAuthenticated]
 
     def get_serializer_class(self):
@@ -44,6 +115,43 @@ class UserProfileViewSet(viewsets.ModelViewSet):
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+    @action(detail=True, methods=['get', 'put', 'delete'], url_path='voice', url_name='voice',
+            permission_classes=[IsAuthenticated, IsOwnerOrStaff])
+    def voice(self, request, pk=None):
+        '''
+        The profile's voice data as application/octet-stream. GET honours a
+        single-range Range header, If-Range and If-None-Match (the ETag is the
+        content hash); PUT stores the raw request body; DELETE clears it.
+        Only the profile's own user and staff may use it.
+        '''
+        profile = self.get_object()
+        if request.method in ('PUT', 'DELETE'):
+            profile.set_voice(request.body if request.method == 'PUT' else None)
+            profile.save(update_fields=['voice_key', 'voice_profile'])
+            return Response({"voice_key": profile.voice_key})
+
+        size = profile.voice_size()
+        if size is None:
+            raise Http404("No voice profile.")
+        key = profile.voice_key or blobs.key_for(profile.read_voice())
+        etag = quote_etag(key)
+        headers = {"ETag": etag, "Accept-Ranges": "bytes", "Cache-Control": "private, no-cache"}
+        if etag in parse_etags(request.headers.get("If-None-Match", "")):
+            return HttpResponse(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        span = None
+        if request.headers.get("If-Range", etag) == etag:
+            try:
+                span = _byte_range(request.headers.get("Range"), size)
+            except ValueError:
+                return HttpResponse(status=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+                                    headers={**headers, "Content-Range": f"bytes */{size}"})
+        if span is None:
+            return HttpResponse(profile.read_voice(), content_type="application/octet-stream", headers=headers)
+        start, end = span
+        return HttpResponse(profile.read_voice(start, end), content_type="application/octet-stream",
+                            status=status.HTTP_206_PARTIAL_CONTENT,
+                            headers={**headers, "Content-Range": f"bytes {start}-{end - 1}/{size}"})
+
 
 class RegisterView(APIView):
     def post(self, request):
@@ -55,19 +163,13 @@ class RegisterView(APIView):
 
 
 class PasswordResetView(APIView):
+    # Rate limiting (5 attempts per hour per IP, shared by all workers)
+    @ratelimit("password_reset", 5, 3600)
     def post(self, request):
-        # Rate limiting (e.g., 5 attempts per hour per IP)
-        ip = request.META.get('REMOTE_ADDR')
-        cache_key = f"password_reset_{ip}"
-        attempts = cache.get(cache_key, 0)
-        if attempts >= 5:
-            return Response({"error": "Too many attempts. Try again later."}, status=status.HTTP_429_TOO_MANY_REQUESTS)
         serializer = PasswordResetSerializer(data=request.data)
         if serializer.is_valid():
             serializer.save()
-            cache.set(cache_key, attempts + 1, timeout=3600)
             return Response({"message": "Password reset successful."}, status=status.HTTP_200_OK)
-        cache.set(cache_key, attempts + 1, timeout=3600)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
@@ -86,25 +188,55 @@ class PasswordChangeView(APIView):
 class SecurityAnswerView(APIView):
     permission_classes = [IsAuthenticated]
 
+    @ratelimit("security_answer", 5, 3600)
     def post(self, request):
-        ip = request.META.get('REMOTE_ADDR')
-        cache_key = f"security_answer_{ip}"
-        attempts = cache.get(cache_key, 0)
-        if attempts >= 5:
-            return Response({"error": "Too many attempts. Try again later."}, status=status.HTTP_429_TOO_MANY_REQUESTS)
         serializer = SecurityAnswerSerializer(data=request.data)
         if serializer.is_valid():
             serializer.save(request)
-            cache.set(cache_key, attempts + 1, timeout=3600)
             return Response({"message": "Security answer updated."}, status=status.HTTP_200_OK)
-        cache.set(cache_key, attempts + 1, timeout=3600)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
+class ResidentImportView(APIView):
+    '''
+    Bulk-create residents from a CSV (header row) or JSON lines upload: the
+    "file" part of a multipart form, or the raw request body. ?type=csv or
+    ?type=jsonl, csv by default; ?dry_run=1 validates without creating. See
+    chat.onboarding.import_residents for the columns and the response.
+    Passwords are hashed in the request's own process; large files belong
+    with the import_residents command and its process pool.
+    '''
+    permission_classes = [IsAdminUser]
+
+    def post(self, request):
+        format = request.query_params.get("type", "csv")  # ?format= is DRF's renderer override
+        if format not in ("csv", "jsonl"):
+            return Response({"error": "type must be csv or jsonl."}, status=status.HTTP_400_BAD_REQUEST)
+        if request.content_type.startswith("multipart/form-data"):
+            if "file" not in request.FILES:
+                return Response({"error": "No file part."}, status=status.HTTP_400_BAD_REQUEST)
+            data = request.FILES["file"].read()
+        else:
+            data = request.body  # text/csv, application/jsonl, ...: no parser involved
+        try:
+            text = data.decode("utf-8-sig")
+        except UnicodeDecodeError:
+            return Response({"error": "The file must be UTF-8 text."}, status=status.HTTP_400_BAD_REQUEST)
+        dry_run = request.query_params.get("dry_run") in ("1", "true")
+        result = onboarding.import_residents(
+            onboarding.read_rows(io.StringIO(text, newline=""), format),
+            region=request.query_params.get("region"), workers=1, dry_run=dry_run)
+        logger.info("resident import by %s: %d rows, %d %s", request.user.username,
+                    result["rows"], result["created"], "valid" if dry_run else "created")
+        created = result["created"] and not dry_run
+        return Response(result, status=status.HTTP_201_CREATED if created else status.HTTP_200_OK)
+
+
 class ChatHistoryViewSet(viewsets.ModelViewSet):
     queryset = ChatHistory.objects.all()
     serializer_class = ChatHistorySerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = ChatHistoryCursorPagination
 
     def get_queryset(self):
         return ChatHistory.objects.filter(user=self.request.user)
@@ -112,26 +244,72 @@ class ChatHistoryViewSet(viewsets.ModelViewSet):
     def perform_create(self, serializer):
         serializer.save(user=self.request.user)
 
+    def retrieve(self, request, *args, **kwargs):
+        # Archived messages are read-only, so only reads fall through
+        try:
+            return super().retrieve(request, *args, **kwargs)
+        except Http404:
+            try:
+                chat = archive.get(request.user.pk, int(kwargs['pk']))
+            except ValueError:
+                chat = None
+            if chat is None:
+                raise
+            return Response(self.get_serializer(chat).data)
+
+    @action(detail=False, methods=['get'])
+    def search(self, request):
+        '''
+        Full-text search over the user's own messages: ?q=<words>&limit=<n>.
+        '''
+        q = request.query_params.get('q', '').strip()
+        if not q:
+            return Response({"error": "Query parameter 'q' is required"}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            limit = max(1, min(int(request.query_params.get('limit', 20)), 100))
+        except ValueError:
+            limit = 20
+        results = history_search.search(q, user=request.user, limit=limit)
+        return Response(ChatHistorySearchSerializer(results, many=True).data)
+
 
 @api_view(['GET'])
 # @permission_classes([IsAuthenticated])
 def user_profile(request):
-    profile = request.user.profile
+    '''
+    Profile plus the latest ?limit= (default 10) messages, oldest first. The
+    history rows come from one descending scan of the (user, timestamp) index
+    with the profile joined in. Sends an ETag; a matching If-None-Match gets 304.
+    '''
     try:
-        return Response({
-            "username": request.user.username,
-            "preferred_name": profile.preferred_name or request.user.username,
-            "account_status": profile.account_status,
-            "city": profile.city or "",
-            "chat_history": [
-                {"message": chat.message, "is_user": chat.is_user_message,
-                    "time": chat.timestamp.isoformat()}
-                for chat in request.user.chat_history.all()[:10]
-            ]
-        })
+        limit = max(1, min(int(request.query_params.get("limit", 10)), 100))
+    except ValueError:
+        limit = 10
+    latest = list(ChatHistory.objects.filter(user=request.user)
+                  .select_related('user__profile').defer('user__profile__voice_profile')
+                  .order_by('-timestamp', '-id')[:limit])
+    try:
+        # No messages yet means nothing to piggyback on; fetch the profile alone
+        profile = latest[0].user.profile if latest else request.user.profile
     except ObjectDoesNotExist:
         return Response({"error": "User does not have a profile"})
 
+    data = {
+        "username": request.user.username,
+        "preferred_name": profile.preferred_name or request.user.username,
+        "account_status": profile.account_status,
+        "city": profile.city or "",
+        "chat_history": [
+            {"message": chat.message, "is_user": chat.is_user_message,
+                "time": chat.timestamp.isoformat()}
+            for chat in reversed(latest)
+        ]
+    }
+    etag = quote_etag(hashlib.md5(json.dumps(data, sort_keys=True).encode()).hexdigest())
+    if etag in parse_etags(request.headers.get("If-None-Match", "")):
+        return Response(status=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    return Response(data, headers={"ETag": etag})
+
 
 # @permission_classes([IsAuthenticated]) # not yet
 @api_view(['GET'])
@@ -161,34 +339,21 @@ def weather_api(request):
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        # Weather API call
-        weather_api_key = config.weather_api_key
-        try:
-            weather = requests.get(
-                f"https://api.openweathermap.org/data/2.5/weather?lat={lat}&lon={lon}&appid={weather_api_key}&units={units}"
-            ).json()
-
-            if weather.get("cod") != 200:
-                print("COD line")
-                return Response(
-                    {"error": f"Weather API error: {weather.get('message', 'Unknown')}"},
-                    status=status.HTTP_400_BAD_REQUEST
-                )
-
-            temp = int(weather["main"]["temp"])
-            print(f"The temp is {temp} degrees")
-            city = weather["name"]
-        except (requests.RequestException, KeyError, ValueError) as e:
+        # Only OpenWeatherMap's own values, so callers can't mint cache keys
+        if units not in weather.UNITS:
             return Response(
-                {"error": f"Failed to fetch weather: {str(e)}"},
-                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+                {"error": f"units must be one of: {', '.join(weather.UNITS)}"},
+                status=status.HTTP_400_BAD_REQUEST
             )
 
-        return Response({
-            "temperature": temp,
-            "city": city,
-            "units": units
-        }, status=status.HTTP_200_OK)
+        # Weather lookup (cached per grid cell, see chat/weather.py)
+        try:
+            data = weather.get_weather(lat, lon, units)
+        except weather.WeatherError as e:
+            return Response({"error": str(e)}, status=e.status)
+        logger.debug("The temp is %s degrees", data['temperature'])
+
+        return Response(data, status=status.HTTP_200_OK)
 
     except (TypeError, ValueError, KeyError) as e:
         return Response(
@@ -197,32 +362,238 @@ def weather_api(request):
         )
 
 
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def weather_stats(request):
+    return Response(weather.stats())
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def breaker_stats(request):
+    '''
+    Circuit breaker state and counters for each upstream API.
+    '''
+    return Response(breaker.stats())
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def reply_stats(request):
+    '''
+    How many talk messages the replies fast path answered without the LLM.
+    '''
+    return Response(replies.stats())
+
+
 # def starts_with_question_word(message):
 #    question_words = ("what", "when", "where", "how",
 #                      "why", "who", "can", "do", "if")
 #    return message.lower().startswith(question_words)
 
 
+def _special_reply(message):
+    '''
+    Canned replies that skip the LLM. Returns (reply, extra response fields) or None.
+    '''
+    if "help" in message.lower():
+        return "Uh oh. How can I help?", {"message": "What can I do?"}
+    if message.lower() == "hey":
+        return "Hey! What's up?", {}
+    return None
+
+
+def _response_style(message):
+    if ma.is_question(message):
+        logger.debug("Message is a question.")
+        return "brevity"
+    logger.debug("Message is a statement")
+    return "gallows humor"
+
+
+def _llm_headers(prompt):
+    headers = {"X-Prompt-Tokens": str(prompt.tokens)}
+    timing = llm.server_timing()
+    if timing:
+        headers["Server-Timing"] = timing
+    return headers
+
+
+def _log_prompt(prompt, completion=None):
+    usage = completion.usage if completion else None
+    llm.record_usage(usage)
+    logger.info("Prompt tokens=%s history_turns=%s", prompt.tokens, prompt.turns, extra={
+        "prompt_tokens": prompt.tokens,
+        "history_turns": prompt.turns,
+        "counted_prompt_tokens": usage.prompt_tokens if usage else None,
+    })
+
+
+class EventStreamRenderer(BaseRenderer):
+    '''
+    Lets talk_api negotiate "Accept: text/event-stream". The stream itself is a
+    StreamingHttpResponse; this only renders the plain (error/canned) replies.
+    '''
+    media_type = "text/event-stream"
+    format = "sse"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return _sse("message", data).encode()
+
+
+def _wants_stream(data, request):
+    '''
+    Streaming is opt-in: {"stream": true} in the body or an SSE Accept header.
+    '''
+    return data.get("stream") in (True, "true", "1", 1) or \
+        "text/event-stream" in request.headers.get("Accept", "")
+
+
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def _sse_response(events, prompt=None):
+    response = StreamingHttpResponse(events, content_type="text/event-stream")
+    if prompt:
+        response["X-Prompt-Tokens"] = str(prompt.tokens)
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"  # don't let nginx buffer the tokens
+    return response
+
+
+def _llm_error_reply(e):
+    '''
+    (reply, status) shown to the user when the OpenAI call fails.
+    '''
+    if llm.circuit_open(e):
+        return BUSY_REPLY, 503
+    if isinstance(e, APIConnectionError):
+        return "Sorry, I had trouble connecting!", 503
+    if isinstance(e, RateLimitError):
+        return "Too many chats right now—try again soon!", 429
+    if isinstance(e, OpenAIError):
+        return "Something’s off with the AI!", 500
+    return "Oops! Something unexpected happened.", 500
+
+
+def _retry_after(e):
+    open_circuit = llm.circuit_open(e)
+    return {"Retry-After": str(open_circuit.retry_after)} if open_circuit else {}
+
+
+def _fast_reply(data, request, reply, source, message, user_data):
+    '''
+    (body, headers, streaming response or None) for a reply served by the
+    replies fast path, shaped like an LLM reply.
+    '''
+    body = {
+        "response": reply,
+        "user": user_data,
+        "message": message,
+        "is_question": ma.is_question(reply)
+    }
+    headers = {"X-Reply-Source": source}
+    if _wants_stream(data, request):
+        response = _sse_response(iter([_sse("token", {"delta": reply}), _sse("done", body)]))
+        response["X-Reply-Source"] = source
+        return body, headers, response
+    return body, headers, None
+
+
+def _stream_reply(user, messages, message, user_data):
+    '''
+    SSE events for talk_api: one "token" per delta, then "done" with the usual
+    response body. The reply is saved once the stream has finished.
+    '''
+    chunks = []
+    try:
+        stream = llm.get_client().chat.completions.create(
+            model="gpt-3.5-turbo",
+            messages=messages,
+            max_tokens=100,
+            temperature=0.7,
+            stream=True,
+            stream_options={"include_usage": True}  # usage arrives in a last, choice-less chunk
+        )
+        for chunk in stream:
+            llm.record_usage(chunk.usage)
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if delta:
+                chunks.append(delta)
+                yield _sse("token", {"delta": delta})
+        ai_response = "".join(chunks)
+        writebehind.save_turn(user, ai_response, False)
+        replies.remember(user, message, ai_response)
+    except Exception as e:
+        logger.warning("Streaming error: %s", e)
+        reply, code = _llm_error_reply(e)
+        yield _sse("error", {"reply": reply, "status": code})
+        return
+
+    yield _sse("done", {
+        "response": ai_response,
+        "user": user_data,
+        "message": message,
+        "is_question": ma.is_question(ai_response)
+    })
+
+
+async def _astream_reply(user, messages, message, user_data):
+    '''
+    Async twin of _stream_reply for talk_api_async.
+    '''
+    chunks = []
+    try:
+        stream = await llm.get_async_client().chat.completions.create(
+            model="gpt-3.5-turbo",
+            messages=messages,
+            max_tokens=100,
+            temperature=0.7,
+            stream=True,
+            stream_options={"include_usage": True}  # usage arrives in a last, choice-less chunk
+        )
+        async for chunk in stream:
+            llm.record_usage(chunk.usage)
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if delta:
+                chunks.append(delta)
+                yield _sse("token", {"delta": delta})
+        ai_response = "".join(chunks)
+        await sync_to_async(writebehind.save_turn)(user, ai_response, False)
+        await sync_to_async(replies.remember)(user, message, ai_response)
+    except Exception as e:
+        logger.warning("Streaming error: %s", e)
+        reply, code = _llm_error_reply(e)
+        yield _sse("error", {"reply": reply, "status": code})
+        return
+
+    yield _sse("done", {
+        "response": ai_response,
+        "user": user_data,
+        "message": message,
+        "is_question": ma.is_question(ai_response)
+    })
+
+
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
+@renderer_classes([JSONRenderer, BrowsableAPIRenderer, EventStreamRenderer])
+@ratelimit("talk", *TALK_QUOTA, key='user')
 def talk_api(request):
     # Safely extract message and location data
     message = request.data.get("message")
     city = request.data.get("city")
     if not message:
         return Response({"error": "Message required"}, status=status.HTTP_400_BAD_REQUEST)
-    print(f"The city is {city}")
+    logger.debug("The city is %s", city)
 
     # Use authenticated user
     user = request.user
 
     # Save user message to ChatHistory
     try:
-        ChatHistory.objects.create(
-            user=user,
-            message=message,
-            is_user_message=True
-        )
+        writebehind.save_turn(user, message, True)
     except ValueError as e:
         return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
@@ -230,106 +601,76 @@ def talk_api(request):
     serializer = UserSerializer(user)
 
     # Special responses
-    if "help" in message.lower():
-        response = "Uh oh. How can I help?"
-        ChatHistory.objects.create(
-            user=user,
-            message=response,
-            is_user_message=False
-        )
+    special = _special_reply(message)
+    if special:
+        response, extra = special
+        writebehind.save_turn(user, response, False)
         return Response({
             "reply": response,
-            "message": "What can I do?",
+            **extra,
             "user": serializer.data
         })
 
-    if message.lower() == "hey":
-        response = "Hey! What's up?"
-        ChatHistory.objects.create(
-            user=user,
-            message=response,
-            is_user_message=False
-        )
-        return Response({
-            "reply": response,
-            "user": serializer.data
-        })
+    # Short repeated messages (greetings, check-ins) can skip the LLM
+    fast = replies.lookup(user, message)
+    if fast:
+        reply, source = fast
+        writebehind.save_turn(user, reply, False)
+        body, headers, streaming = _fast_reply(request.data, request, reply, source, message, serializer.data)
+        return streaming or Response(body, headers=headers)
 
     # Determine response style
-    if ma.starts_with_question_word(message):
-        print("Message starts with a question word.")
-        how_to_respond = "brevity"
-    else:
-        print("Message is a statement")
-        how_to_respond = "gallows humor"
-
-    # Fetch recent chat history (last 5 exchanges)
-    recent_history = ChatHistory.objects.filter(
-        user=user).order_by('-timestamp')[:5]
-    # Reverse to chronological order for prompt
-    recent_history = reversed(recent_history)
-
-    # Construct OpenAI messages array
-    messages = [
-        {
-            "role": "system",
-            "content": (
-                f"You are a friendly, empathetic roommate for an elderly person living in {city or 'an unspecified city'}. "
-                "Respond warmly, naturally, and with {how_to_respond}. Keep responses concise (1-2 sentences) and appropriate for seniors. "
-                "Use the conversation history to maintain context and refer to prior messages when relevant."
-            )
-        }
-    ]
-    # Add recent chat history
-    for chat in recent_history:
-        messages.append({
-            "role": "user" if chat.is_user_message else "assistant",
-            "content": chat.message
-        })
-    # Add current message
-    messages.append({"role": "user", "content": message})
+    how_to_respond = _response_style(message)
+
+    # Recent chat history (chronological), usually from cache
+    recent_history = context.recent_turns(user, HISTORY_TURNS)
+
+    # Older turns related to this message, from long-term memory
+    memories = memory.recall(user, message, exclude=[turn.message for turn in recent_history])
+
+    # OpenAI messages array, history packed to the token budget
+    prompt = prompts.build(city, how_to_respond, recent_history, message, memories)
+
+    if _wants_stream(request.data, request):
+        _log_prompt(prompt)
+        return _sse_response(_stream_reply(user, prompt.messages, message, serializer.data), prompt)
 
     # AI Response
     try:
-        client = OpenAI(api_key=config.openai_api_key)
-        ai_response = client.chat.completions.create(
+        completion = llm.get_client().chat.completions.create(
             model="gpt-3.5-turbo",
-            messages=messages,
+            messages=prompt.messages,
             max_tokens=100,  # Limit response length
             temperature=0.7  # Balanced creativity
-        ).choices[0].message.content
+        )
+        ai_response = completion.choices[0].message.content
+        _log_prompt(prompt, completion)
 
         # Save AI response to ChatHistory
-        ChatHistory.objects.create(
-            user=user,
-            message=ai_response,
-            is_user_message=False
-        )
+        writebehind.save_turn(user, ai_response, False)
+        replies.remember(user, message, ai_response)
 
     except APIConnectionError as e:
-        print("Connection error:", e)
-        return Response({"reply": "Sorry, I had trouble connecting!"}, status=503)
+        logger.warning("Connection error: %s", e)
+        reply, code = _llm_error_reply(e)
+        return Response({"reply": reply}, status=code, headers=_retry_after(e))
 
     except RateLimitError as e:
-        print("Rate limit reached:", e)
+        logger.warning("Rate limit reached: %s", e)
         return Response({"reply": "Too many chats right now—try again soon!"}, status=429)
 
     except OpenAIError as e:
-        print("General OpenAI error:", e)
+        logger.warning("General OpenAI error: %s", e)
         return Response({"reply": "Something’s off with the AI!"}, status=500)
 
     except Exception as e:
-        print("Unexpected error:", e)
+        logger.exception("Unexpected error: %s", e)
         return Response({"reply": "Oops! Something unexpected happened."}, status=500)
 
-    print(f"AI Response: {ai_response}")
-    print(f"Serializer Data: {serializer.data}")
-    print(f"Message: {message}")
+    logger.debug("Replied", extra={"user_id": user.pk, "user_message": message, "reply": ai_response})
 
     # Improved question detection
-    is_question = ai_response.strip().endswith('?') or any(
-        word in ai_response.lower() for word in ['what', 'when', 'where', 'how', 'why', 'who', 'can', 'do', 'if']
-    )
+    is_question = ma.is_question(ai_response)
 
     # Prepare response data
     response_data = {
@@ -338,8 +679,124 @@ def talk_api(request):
         "message": message,
         "is_question": is_question
     }
-    print(f"Response JSON: {json.dumps(response_data)}")
-    return Response(response_data)
+    return Response(response_data, headers=_llm_headers(prompt))
+
+
+async def _jwt_user(request):
+    '''
+    Resolve the Bearer token the way DRF's authentication would. None if missing/invalid.
+    '''
+    try:
+        result = await sync_to_async(CachedJWTAuthentication().authenticate)(request)
+    except (InvalidToken, AuthenticationFailed):
+        return None
+    return result[0] if result else None
+
+
+@csrf_exempt
+@require_POST
+async def talk_api_async(request):
+    '''
+    Same contract as talk_api, but the OpenAI round trip is awaited instead of
+    holding a worker thread. Only pays off when served through companion/asgi.py.
+    '''
+    user = await _jwt_user(request)
+    if user is None:
+        return JsonResponse({"detail": "Authentication credentials were not provided."}, status=401)
+    # Same per-user LLM quota bucket as talk_api
+    allowed, retry_after = await sync_to_async(hit)("talk", f"u{user.pk}", *TALK_QUOTA)
+    if not allowed:
+        return too_many(request, retry_after)
+
+    try:
+        data = json.loads(request.body or b"{}")
+    except ValueError:
+        data = request.POST
+    if not isinstance(data, dict):
+        return JsonResponse({"error": "Request body must be a JSON object"}, status=status.HTTP_400_BAD_REQUEST)
+    message = data.get("message")
+    city = data.get("city")
+    if not message:
+        return JsonResponse({"error": "Message required"}, status=status.HTTP_400_BAD_REQUEST)
+    logger.debug("The city is %s", city)
+
+    # Save user message to ChatHistory
+    try:
+        await sync_to_async(writebehind.save_turn)(user, message, True)
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    serializer = UserSerializer(user)
+
+    special = _special_reply(message)
+    if special:
+        response, extra = special
+        await sync_to_async(writebehind.save_turn)(user, response, False)
+        return JsonResponse({
+            "reply": response,
+            **extra,
+            "user": serializer.data
+        })
+
+    fast = await sync_to_async(replies.lookup)(user, message)
+    if fast:
+        reply, source = fast
+        await sync_to_async(writebehind.save_turn)(user, reply, False)
+        body, headers, streaming = _fast_reply(data, request, reply, source, message, serializer.data)
+        return streaming or JsonResponse(body, headers=headers)
+
+    how_to_respond = _response_style(message)
+
+    recent_history = await sync_to_async(context.recent_turns)(user, HISTORY_TURNS)
+    memories = await sync_to_async(memory.recall)(
+        user, message, exclude=[turn.message for turn in recent_history])
+    prompt = prompts.build(city, how_to_respond, recent_history, message, memories)
+
+    if _wants_stream(data, request):
+        _log_prompt(prompt)
+        return _sse_response(_astream_reply(user, prompt.messages, message, serializer.data), prompt)
+
+    try:
+        completion = await llm.get_async_client().chat.completions.create(
+            model="gpt-3.5-turbo",
+            messages=prompt.messages,
+            max_tokens=100,
+            temperature=0.7
+        )
+        ai_response = completion.choices[0].message.content
+        _log_prompt(prompt, completion)
+
+        await sync_to_async(writebehind.save_turn)(user, ai_response, False)
+        await sync_to_async(replies.remember)(user, message, ai_response)
+
+    except APIConnectionError as e:
+        logger.warning("Connection error: %s", e)
+        reply, code = _llm_error_reply(e)
+        return JsonResponse({"reply": reply}, status=code, headers=_retry_after(e))
+
+    except RateLimitError as e:
+        logger.warning("Rate limit reached: %s", e)
+        return JsonResponse({"reply": "Too many chats right now—try again soon!"}, status=429)
+
+    except OpenAIError as e:
+        logger.warning("General OpenAI error: %s", e)
+        return JsonResponse({"reply": "Something’s off with the AI!"}, status=500)
+
+    except Exception as e:
+        logger.exception("Unexpected error: %s", e)
+        return JsonResponse({"reply": "Oops! Something unexpected happened."}, status=500)
+
+    return JsonResponse({
+        "response": ai_response,
+        "user": serializer.data,
+        "message": message,
+        "is_question": ma.is_question(ai_response)
+    }, headers=_llm_headers(prompt))
+
+
+def _talk_context(user, message):
+    recent_history = context.recent_turns(user, HISTORY_TURNS)
+    return recent_history, memory.recall(user, message, exclude=[turn.message for turn in recent_history])
 
 
 @csrf_exempt
@@ -357,53 +814,55 @@ def talk(request):
         # user, _ = User.objects.get_or_create(
         #    username="BigMike", defaults={"first_name": "Test", "last_name": "User"}
         # )
-        # weather support
-        # Save user message
-        ChatHistory.objects.create(
-            user=user, message=message, is_user_message=True)
-
-        weather_api_key = config.weather_api_key
-        try:
-            weather = requests.get(
-                f"https://api.openweathermap.org/data/2.5/weather?lat={lat}&lon={lon}&appid={weather_api_key}&units=imperial"
-            ).json()
-            temp = int(weather["main"]["temp"]) if weather.get(
-                "main") and "temp" in weather["main"] else None
-            city = weather["name"]
-        except (requests.RequestException, KeyError):
-            temp = "unknown"
+        # The resident's own message is stored before anything else can fail
+        writebehind.save_turn(user, message, True)
+
+        # Weather and conversation context are looked up at once; the LLM
+        # call goes ahead with whatever is back by each one's deadline.
+        lookups = Fanout()
+        lookups.start("weather", weather.get_weather, lat, lon, deadline=TALK_DEADLINES["weather"],
+                      errors=(weather.WeatherError, ValueError))
+        lookups.start("context", _talk_context, user, message, deadline=TALK_DEADLINES["context"],
+                      fallback=([], []))
+        current = lookups.result("weather")
+        recent_history, memories = lookups.result("context")
+        prompt = prompts.build(current and current["city"], _response_style(message), recent_history,
+                               message, memories, temperature=current and current["temperature"])
 
         # AI Response
         # Get from openai.com
+        reply = None
         try:
-            client = OpenAI(
-                api_key=config.openai_api_key)
-            prompt = f"Act as a friendly companion for an elderly person. They said: '{message}'. It’s {temp}°F outside. Respond warmly and naturally."
-            ai_response = client.chat.completions.create(
+            completion = llm.get_client().chat.completions.create(
                 model="gpt-3.5-turbo",
-                messages=[{"role": "user", "content": prompt}]
-            ).choices[0].message.content
-            ChatHistory.objects.create(
-                user=user, message=ai_response, is_user_message=False)
+                messages=prompt.messages
+            )
+            reply = ai_response = completion.choices[0].message.content
+            _log_prompt(prompt, completion)
         except APIConnectionError as e:
-            print("Connection error:", e)
-            ai_response = "Sorry, I had trouble connecting to the AI service."
+            logger.warning("Connection error: %s", e)
+            ai_response = BUSY_REPLY if llm.circuit_open(e) else "Sorry, I had trouble connecting to the AI service."
 
         except RateLimitError as e:
-            print("Rate limit reached:", e)
+            logger.warning("Rate limit reached: %s", e)
             ai_response = "Sorry, I'm being asked too many questions right now. Please try again shortly."
 
         except OpenAIError as e:
-            print("General OpenAI error:", e)
+            logger.warning("General OpenAI error: %s", e)
             ai_response = "Sorry, something went wrong with the AI service."
 
         except Exception as e:
-            print("Unexpected error:", e)
+            logger.exception("Unexpected error: %s", e)
             ai_response = "Oops! Something unexpected happened."
 
-        # response = f"You said: {message}. I remember you, {user.first_name}! It is {temp} degrees today."
-        user.last_chat = message
-        user.save()
+        # Storing the reply doesn't hold up the page
+        if reply is not None:
+            jobs.defer("chat.tasks.save_reply", user.pk, reply)
+
+        # A forecast that came back while the LLM was answering still makes the page
+        current = current or lookups.result("weather") or {"temperature": "unknown", "city": "unknown"}
+        temp = current["temperature"]
+        city = current["city"]
 
         # serialization
         serializer = UserSerializer(user)
@@ -415,6 +874,8 @@ def talk(request):
             "temp": temp,
             "city": city,
         }
-        return render(request, "chat/talk.html", context)
+        response = render(request, "chat/talk.html", context)
+        response["Server-Timing"] = ", ".join(filter(None, [lookups.server_timing(), llm.server_timing()]))
+        return response
 
     return render(request, "chat/talk.html")
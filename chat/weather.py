@@ -0,0 +1,126 @@
+import threading
+import time
+import requests
+from django.conf import settings
+from django.core.cache import cache
+from . import breaker
+from . import config
+from . import metrics
+
+DEFAULTS = {
+    'GRID': 0.05,         # degrees (~5 km), residents of one facility share a cell
+    'TTL': 600,           # serve from cache without refreshing
+    'STALE_TTL': 1800,    # after TTL, keep serving while one worker refreshes
+    'NEGATIVE_TTL': 60,   # remember upstream failures this long
+    'TIMEOUT': 5,
+}
+WEATHER_URL = "https://api.openweathermap.org/data/2.5/weather"
+UNITS = ("standard", "metric", "imperial")
+STATS = ("hit", "stale", "miss", "negative_hit")
+
+_session = requests.Session()
+
+
+class WeatherError(Exception):
+    def __init__(self, message, status=500):
+        super().__init__(message)
+        self.status = status
+
+
+def _options():
+    return {**DEFAULTS, **getattr(settings, 'WEATHER_CACHE', {})}
+
+
+def _bucket(lat, lon, grid):
+    return round(round(lat / grid) * grid, 4), round(round(lon / grid) * grid, 4)
+
+
+def _count(name):
+    key = f"weather:stats:{name}"
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, 0, timeout=None)
+        cache.incr(key)
+
+
+def stats():
+    '''
+    Hit/miss counters shared by every worker using the same cache.
+    '''
+    values = cache.get_many([f"weather:stats:{name}" for name in STATS])
+    return {name: values.get(f"weather:stats:{name}", 0) for name in STATS}
+
+
+def _unavailable(response):
+    return response.status_code == 429 or response.status_code >= 500
+
+
+def _fetch(lat, lon, units, options):
+    try:
+        weather = breaker.get("weather").call(
+            _session.get, WEATHER_URL, params={
+                "lat": lat, "lon": lon, "appid": config.weather_api_key, "units": units,
+            }, timeout=options['TIMEOUT'],
+            errors=(requests.RequestException,), is_failure=_unavailable,
+            on_retry=lambda response: response.close(),
+        ).json()
+        if weather.get("cod") != 200:
+            return {"error": f"Weather API error: {weather.get('message', 'Unknown')}", "status": 400}
+        return {"data": {
+            "temperature": int(weather["main"]["temp"]),
+            "city": weather["name"],
+            "units": units,
+        }}
+    except breaker.CircuitOpen as e:
+        return {"error": f"Weather service unavailable: {e}", "status": 503}
+    except (requests.RequestException, KeyError, ValueError) as e:
+        return {"error": f"Failed to fetch weather: {str(e)}", "status": 500}
+
+
+def _store(key, entry, options):
+    entry["fetched_at"] = time.time()
+    if "error" in entry:
+        cache.set(key, entry, timeout=options['NEGATIVE_TTL'])
+    else:
+        cache.set(key, entry, timeout=options['TTL'] + options['STALE_TTL'])
+    return entry
+
+
+def _refresh(key, lat, lon, units, options):
+    try:
+        entry = _fetch(lat, lon, units, options)
+        if "error" not in entry:  # keep serving the stale reading over an error
+            _store(key, entry, options)
+    finally:
+        cache.delete(f"{key}:refreshing")
+
+
+@metrics.timed("weather")
+def get_weather(lat, lon, units="imperial"):
+    '''
+    Current weather for the grid cell around (lat, lon):
+    {"temperature": int, "city": str, "units": units}. Raises WeatherError.
+    '''
+    options = _options()
+    lat, lon = _bucket(float(lat), float(lon), options['GRID'])
+    key = f"weather:{units}:{lat}:{lon}"
+
+    entry = cache.get(key)
+    if entry is None:
+        _count("miss")
+        entry = _store(key, _fetch(lat, lon, units, options), options)
+    elif "error" in entry:
+        _count("negative_hit")
+    elif time.time() - entry["fetched_at"] > options['TTL']:
+        _count("stale")
+        # Only one worker refreshes; the rest keep answering from the stale copy
+        if cache.add(f"{key}:refreshing", 1, timeout=options['TIMEOUT'] * 2):
+            threading.Thread(target=_refresh, args=(key, lat, lon, units, options),
+                             daemon=True).start()
+    else:
+        _count("hit")
+
+    if "error" in entry:
+        raise WeatherError(entry["error"], entry["status"])
+    return entry["data"]
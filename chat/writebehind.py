@@ -0,0 +1,163 @@
+import atexit
+import logging
+import os
+import threading
+import time
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from .models import ChatHistory
+from . import context
+from . import memory
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'ENABLED': False,
+    'MAX_BATCH': 50,     # flush as soon as this many rows are waiting
+    'MAX_DELAY': 0.5,    # ...or when the oldest row has waited this long (seconds)
+    'MAX_PENDING': 10000,  # past this many waiting rows, save_turn inserts directly
+    'MAX_ATTEMPTS': 5,   # failed flushes a row survives before it is dropped
+    'EXIT_TIMEOUT': 10,  # at exit, wait this long for an in-flight flush (seconds)
+}
+
+_pending = []
+_cond = threading.Condition()
+_stop = threading.Event()
+_flusher = None
+_flusher_pid = None
+
+
+def _options():
+    return {**DEFAULTS, **getattr(settings, 'CHAT_WRITE_BEHIND', {})}
+
+
+def save_turn(user, message, is_user_message):
+    '''
+    Store one ChatHistory turn. With write-behind enabled the row is buffered
+    and INSERTed later in a batch; the user's context window is updated right
+    away so their next prompt still sees it.
+    '''
+    options = _options()
+    if not options['ENABLED'] or len(_pending) >= options['MAX_PENDING']:
+        return ChatHistory.objects.create(
+            user=user, message=message, is_user_message=is_user_message)
+
+    chat = ChatHistory(user=user, message=message, is_user_message=is_user_message)
+    context.recent_turns(user, 0)  # make sure the shared window exists before appending
+    with _cond:
+        _start_flusher()
+        _pending.append(chat)
+        _cond.notify()
+    # bulk_create sends no post_save, so do the context write-through here
+    context.append(user.pk, message, is_user_message)
+    return chat
+
+
+def pending(user_id):
+    '''
+    This process's buffered (not yet INSERTed) turns for a user, oldest first.
+    '''
+    with _cond:
+        return [chat for chat in _pending if chat.user_id == user_id]
+
+
+def flush():
+    with _cond:
+        batch = _pending[:]
+        del _pending[:]
+    if not batch:
+        return 0
+    try:
+        ChatHistory.objects.bulk_create(batch)
+        saved = batch
+    except IntegrityError:
+        saved = _insert_each(batch)
+    except Exception as e:
+        _requeue(batch, e)
+        return 0
+    try:
+        memory.add(saved)  # bulk_create sent no post_save
+    except Exception as e:
+        logger.exception("Memory indexing failed")
+    return len(saved)
+
+
+def _insert_each(batch):
+    # Some row in the batch can never go in (its user was deleted meanwhile,
+    # say): insert one at a time, dropping those, so it can't hold up the rest
+    saved = []
+    failed = []
+    error = None
+    for chat in batch:
+        try:
+            with transaction.atomic():
+                ChatHistory.objects.bulk_create([chat])  # no post_save: context already has it
+            saved.append(chat)
+        except IntegrityError as e:
+            logger.error("Dropped a ChatHistory row that can't be inserted: %s", e, extra={"user_id": chat.user_id})
+        except Exception as e:
+            failed.append(chat)
+            error = e
+    if failed:
+        _requeue(failed, error)
+    return saved
+
+
+def _requeue(rows, error):
+    # Put rows back at the front of the queue for the next flush, except
+    # those that have already failed MAX_ATTEMPTS times
+    max_attempts = _options()['MAX_ATTEMPTS']
+    retry = []
+    for chat in rows:
+        chat._flush_attempts = getattr(chat, '_flush_attempts', 0) + 1
+        if chat._flush_attempts < max_attempts:
+            retry.append(chat)
+    if len(retry) < len(rows):
+        logger.error("Dropped %d ChatHistory rows after %d failed flushes: %s", len(rows) - len(retry),
+                     max_attempts, error, extra={"rows": len(rows) - len(retry)})
+    if retry:
+        logger.warning("ChatHistory flush failed, will retry: %s", error, extra={"rows": len(retry)})
+        with _cond:
+            _pending[:0] = retry
+
+
+def _start_flusher():
+    # Called with _cond held. Re-checks the pid so forked workers get their own thread.
+    global _flusher, _flusher_pid
+    if _flusher_pid != os.getpid():
+        _flusher_pid = os.getpid()
+        _flusher = threading.Thread(target=_run_flusher, daemon=True)
+        _flusher.start()
+
+
+def _run_flusher():
+    options = _options()
+    try:
+        while not _stop.is_set():
+            with _cond:
+                _cond.wait_for(lambda: _pending or _stop.is_set())
+                deadline = time.monotonic() + options['MAX_DELAY']
+                _cond.wait_for(lambda: len(_pending) >= options['MAX_BATCH'] or _stop.is_set(),
+                               timeout=max(0, deadline - time.monotonic()))
+            if _stop.is_set():
+                break
+            if not flush():  # DB trouble; don't spin on it
+                _stop.wait(options['MAX_DELAY'])
+    finally:
+        connection.close()
+
+
+def _shutdown():
+    # Stop the flusher and let any batch it is inserting finish (up to
+    # EXIT_TIMEOUT) before the final flush, so the two don't run side by side
+    with _cond:
+        _stop.set()
+        _cond.notify_all()
+    if _flusher is not None and _flusher_pid == os.getpid():
+        _flusher.join(_options()['EXIT_TIMEOUT'])
+    flush()
+    if _pending:
+        logger.error("Lost %d unflushed ChatHistory rows at exit", len(_pending), extra={"rows": len(_pending)})
+
+
+atexit.register(_shutdown)
@@ -3,6 +3,10 @@ ASGI config for companion project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+Serve this (e.g. ``uvicorn companion.asgi:application``) rather than the WSGI
+app to get the non-blocking ``/api/v1/talk/async/`` endpoint; under WSGI the
+async view still works but each call holds a worker thread again.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
 """
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 from datetime import timedelta
 
@@ -46,6 +47,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'chat.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -80,12 +82,50 @@ WSGI_APPLICATION = 'companion.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# DB_ENGINE picks the profile. SQLite (default) runs in WAL mode so readers
+# don't block the writer, waits up to `timeout` seconds for the write lock
+# (busy_timeout) instead of failing, and takes the lock at BEGIN so
+# read-then-write transactions can't deadlock. PostgreSQL keeps connections
+# open between requests (checked before reuse), or uses a psycopg pool when
+# DB_POOL_SIZE is set.
+DB_ENGINE = os.environ.get('DB_ENGINE', 'sqlite')
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 0))
+
+if DB_ENGINE == 'postgresql':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('POSTGRES_DB', 'companion'),
+            'USER': os.environ.get('POSTGRES_USER', 'companion'),
+            'PASSWORD': os.environ.get('POSTGRES_PASSWORD', ''),
+            'HOST': os.environ.get('POSTGRES_HOST', 'localhost'),
+            'PORT': os.environ.get('POSTGRES_PORT', '5432'),
+            # A pool replaces persistent connections; Django rejects both at once.
+            'CONN_MAX_AGE': 0 if DB_POOL_SIZE else int(os.environ.get('DB_CONN_MAX_AGE', 600)),
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {
+                'pool': {'min_size': min(2, DB_POOL_SIZE), 'max_size': DB_POOL_SIZE, 'timeout': 10},
+            } if DB_POOL_SIZE else {},
+        }
+    }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / 'db.sqlite3',
+            'CONN_MAX_AGE': int(os.environ.get('DB_CONN_MAX_AGE', 600)),
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {
+                'init_command': (
+                    'PRAGMA journal_mode=WAL;'
+                    'PRAGMA synchronous=NORMAL;'
+                    'PRAGMA mmap_size=268435456;'
+                ),
+                'transaction_mode': 'IMMEDIATE',
+                'timeout': 20,
+            },
+        }
     }
-}
 
 
 # Password validation
@@ -131,7 +171,8 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 REST_FRAMEWORK = {
     "DEFAULT_AUTHENTICATION_CLASSES": (
-        "rest_framework_simplejwt.authentication.JWTAuthentication",
+        # simplejwt's JWTAuthentication, with the user and profile cached
+        "chat.auth.CachedJWTAuthentication",
     ),
 }
 
@@ -141,6 +182,12 @@ SIMPLE_JWT = {
     "ROTATE_REFRESH_TOKENS": True,
     "BLACKLIST_AFTER_ROTATION": True,
     "AUTH_HEADER_TYPES": ("Bearer",),
+    # Tokens carry a digest of the password hash, so a password change
+    # (or reset) ends every session issued before it
+    "CHECK_REVOKE_TOKEN": True,
+    # Revoked tokens live in chat.tokens, not the token_blacklist app
+    "TOKEN_REFRESH_SERIALIZER": "chat.serializers.TokenRefreshSerializer",
+    "TOKEN_BLACKLIST_SERIALIZER": "chat.serializers.TokenRevokeSerializer",
 }
 
 CORS_ALLOW_ALL_ORIGINS = True
@@ -149,9 +196,215 @@ CORS_ALLOW_ALL_ORIGINS = True
 #    "http://localhost:3000",   # (optional if you're using React, etc.)
 # ]
 
-CACHES = {
-    'default': {
-        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
-        'LOCATION': 'unique-snowflake',
+# Breaker state, stats counters, token users and the speaker index version
+# live in the cache and must be shared by every worker process, with atomic
+# incr():
+#   REDIS_URL            Redis (multi-process deployments)
+#   MEMCACHED_LOCATION   Memcached, comma-separated host:port list
+#   neither              LocMemCache: one process only (runserver, or a
+#                        single gunicorn worker with threads)
+# CACHE_BACKEND=file selects a FileBasedCache under .django_cache instead, as
+# a fallback for several processes on one box without Redis/Memcached. It is
+# slow: every set() past MAX_ENTRIES lists the whole directory to cull it,
+# and incr() is a non-atomic read-modify-write, so concurrent counters can
+# lose updates.
+REDIS_URL = os.environ.get('REDIS_URL')
+MEMCACHED_LOCATION = os.environ.get('MEMCACHED_LOCATION')
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+        }
+    }
+elif MEMCACHED_LOCATION:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.memcached.PyMemcacheCache',
+            'LOCATION': MEMCACHED_LOCATION.split(','),
+        }
+    }
+elif os.environ.get('CACHE_BACKEND') == 'file':
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': BASE_DIR / '.django_cache',
+            # Big enough that culling (which evicts a third of the entries,
+            # counters included) is rare, small enough that the directory
+            # listing it does stays cheap
+            'OPTIONS': {'MAX_ENTRIES': 10000},
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            # Django's default of 300 entries would cull the counters and
+            # breaker state alongside cached contexts
+            'OPTIONS': {'MAX_ENTRIES': 100000},
+        }
+    }
+
+# Rate limiting (chat/ratelimit.py) needs atomic counters shared by all
+# workers: the Redis or Memcached cache when there is one, flock'd files
+# otherwise.
+if REDIS_URL or MEMCACHED_LOCATION:
+    RATELIMIT = {
+        'BACKEND': 'chat.ratelimit.CacheBackend',
+        'OPTIONS': {'alias': 'default'},
+    }
+else:
+    RATELIMIT = {
+        'BACKEND': 'chat.ratelimit.FileBackend',
+        'OPTIONS': {'location': BASE_DIR / '.ratelimit'},
+    }
+
+# Revoked refresh tokens (chat/tokens.py), kept until they expire. Cache keys
+# need a cache that never evicts them early; otherwise an indexed table.
+if REDIS_URL:
+    CHAT_TOKENS = {
+        'BACKEND': 'chat.tokens.CacheStore',
+        'OPTIONS': {'alias': 'default'},
+    }
+else:
+    CHAT_TOKENS = {
+        'BACKEND': 'chat.tokens.DatabaseStore',
+        'PURGE_EVERY': 1000,
     }
+
+# Weather lookups (chat/weather.py): grid cell in degrees, lifetimes in seconds
+WEATHER_CACHE = {
+    'GRID': 0.05,
+    'TTL': 600,
+    'STALE_TTL': 1800,
+    'NEGATIVE_TTL': 60,
+    'TIMEOUT': 5,
+}
+
+# Shared OpenAI client (chat/llm.py): keep-alive pool, timeouts (seconds)
+LLM_CLIENT = {
+    'MAX_CONNECTIONS': 100,
+    'MAX_KEEPALIVE_CONNECTIONS': 20,
+    'KEEPALIVE_EXPIRY': 30,
+    'CONNECT_TIMEOUT': 5,
+    'TIMEOUT': 30,
+}
+
+# Circuit breakers around upstream APIs (chat/breaker.py), state shared
+# through the cache. Times in seconds; retries use jittered exponential backoff.
+CHAT_BREAKERS = {
+    'openai': {'FAILURES': 5, 'OPEN_FOR': 10, 'MAX_OPEN_FOR': 300, 'RETRIES': 2},
+    'weather': {'FAILURES': 3, 'OPEN_FOR': 30, 'MAX_OPEN_FOR': 600, 'RETRIES': 1},
+}
+
+# Buffer ChatHistory INSERTs and flush them with bulk_create (chat/writebehind.py)
+CHAT_WRITE_BEHIND = {
+    'ENABLED': os.environ.get('CHAT_WRITE_BEHIND') == '1',
+    'MAX_BATCH': 50,
+    'MAX_DELAY': 0.5,  # seconds
+    'MAX_PENDING': 10000,  # beyond this, turns are inserted directly
+    'MAX_ATTEMPTS': 5,
+}
+
+# Cold storage for old ChatHistory rows (chat/archive.py, `manage.py archive_chat_history`)
+CHAT_ARCHIVE = {
+    'LOCATION': BASE_DIR / '.chat_archive',
+    'AGE_DAYS': 90,
+    'KEEP': 20,     # newest turns per user that always stay in the table
+}
+
+# Prompt assembly (chat/prompt.py): token budgets; exact counts need tiktoken
+CHAT_PROMPT = {
+    'ENCODING': 'cl100k_base',
+    'HISTORY_TOKENS': 1000,
+    'TURN_TOKENS': 250,
+    'MEMORY_TOKENS': 200,
+}
+
+# Fast-path replies for short repeated messages (chat/replies.py)
+CHAT_REPLIES = {
+    'ENGINES': ['chat.replies.CannedReplies', 'chat.replies.RecentAnswers'],
+    'TTL': 6 * 3600,
+    'MIN_VARIANTS': 3,
+    'REUSE_INTENTS': ['greeting', 'checkin', 'farewell', 'gratitude'],
+}
+
+# Long-term memory (chat/memory.py): per-user vector index of past turns.
+# 'chat.memory.OpenAIEmbedder' embeds by meaning instead of wording.
+CHAT_MEMORY = {
+    'ENABLED': True,
+    'EMBEDDER': 'chat.memory.HashingEmbedder',
+    'OPTIONS': {'dim': 256},
+    'LOCATION': BASE_DIR / '.chat_memory',
+    'TOP_K': 3,
+}
+
+# Content-addressed storage for UserProfile voice data (chat/blobs.py)
+CHAT_BLOBS = {
+    'BACKEND': 'chat.blobs.FileSystemStore',
+    'LOCATION': BASE_DIR / '.blobs',
+}
+
+# Speaker identification over voice profiles (chat/speakers.py): embeddings
+# of DIM float32s; cosine-similarity thresholds
+CHAT_SPEAKERS = {
+    'DIM': 192,
+    'MIN_SCORE': 0.6,
+    'MARGIN': 0.05,
+    'REFRESH': 60,  # seconds between reloads after another worker's change
+}
+
+# Token users cached by chat.auth.CachedJWTAuthentication; saving a User or
+# UserProfile drops the entry
+CHAT_AUTH = {
+    'TTL': 300,  # seconds
+}
+
+# Bulk resident imports (chat/onboarding.py): the import_residents command and
+# POST /api/v1/residents/import/
+CHAT_ONBOARDING = {
+    'CHUNK': 500,  # rows validated and inserted together
+    'WORKERS': os.cpu_count(),  # password-hashing processes (import_residents command; the API uses 1)
+    'DEFAULT_REGION': 'US',  # for phone numbers without a country code
+}
+
+# Background work off the request path (chat/jobs.py). 'chat.jobs.DatabaseQueue'
+# keeps deferred jobs in a table, so they survive restarts.
+CHAT_JOBS = {
+    'BACKEND': os.environ.get('CHAT_JOBS_BACKEND', 'chat.jobs.ThreadQueue'),
+    'WORKERS': 2,
+    'POOL_SIZE': 16,
+    'MAX_ATTEMPTS': 3,
+}
+
+# Request metrics served at /metrics in the Prometheus format (chat/metrics.py)
+CHAT_METRICS = {
+    'ENABLED': True,
+    'LOCATION': BASE_DIR / '.metrics',
+    'FLUSH_INTERVAL': 5,
+    # Staff users, or a scraper with "Authorization: Bearer $METRICS_TOKEN".
+    # METRICS_ALLOWED_IPS (comma-separated) also lets addresses in; behind a
+    # reverse proxy every request comes from the proxy, so leave it unset there.
+    'TOKEN': os.environ.get('METRICS_TOKEN'),
+    'ALLOWED_IPS': [ip for ip in os.environ.get('METRICS_ALLOWED_IPS', '').split(',') if ip],
+}
+
+# JSON lines on stderr, written by a background thread (chat/log.py).
+# CHAT_LOG_LEVEL=DEBUG adds per-request detail (messages, replies).
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'json': {'()': 'chat.log.JsonFormatter'},
+    },
+    'handlers': {
+        'background': {'class': 'chat.log.BackgroundHandler', 'formatter': 'json'},
+    },
+    'loggers': {
+        'chat': {
+            'handlers': ['background'],
+            'level': os.environ.get('CHAT_LOG_LEVEL', 'INFO'),
+            'propagate': False,
+        },
+    },
 }